@@ -0,0 +1,279 @@
+import json
+import platform
+import time
+from pathlib import Path
+
+import cv2 as cv
+import numpy as np
+
+import features
+import rendering
+
+"""
+The following parameters are used for the benchmark.
+"""
+PERCENTILES = (50, 95, 99)
+WARMUP = 2  # calls of every stage that are not measured
+TOLERANCE = 0.2  # relative slowdown of a stage that counts as a regression
+REGRESSION_METRICS = ("mean", "p95")
+
+
+def read_frames(videos, max_frames=100):
+    """
+    Reads the first frames of the given videos.
+
+    Args:
+        videos (list[str]): Paths to the videos.
+        max_frames (int, optional): The maximum number of frames per video. Defaults
+            to 100.
+
+    Returns:
+        list[list[np.ndarray]]: The consecutive frames of every video that could be
+        read.
+    """
+    clips = []
+    for video in videos:
+        capture = cv.VideoCapture(video)
+        frames = []
+        while len(frames) < max_frames:
+            grabbed, frame = capture.read()
+            if not grabbed:
+                break
+            frames.append(frame)
+        capture.release()
+        if len(frames) > 0:
+            clips.append(frames)
+        else:
+            print(f"[WARNING] Failed to read frames from {video}.")
+    return clips
+
+
+def summarize(latencies):
+    """
+    Summarizes the latencies of a stage.
+
+    Args:
+        latencies (list[float]): The latencies in seconds.
+
+    Returns:
+        dict: The number of calls and the mean and percentile latencies in ms.
+    """
+    latencies = 1000 * np.asarray(latencies)
+    summary = dict(n=len(latencies), mean=round(float(latencies.mean()), 3))
+    for p, value in zip(PERCENTILES, np.percentile(latencies, PERCENTILES)):
+        summary[f"p{p}"] = round(float(value), 3)
+    return summary
+
+
+def time_calls(function, inputs):
+    """
+    Measures the latency of the function for every input, after WARMUP calls.
+
+    Args:
+        function (callable): The stage.
+        inputs (list): The arguments of the calls, one tuple per call.
+
+    Returns:
+        list[float]: The latencies in seconds.
+    """
+    for args in inputs[:WARMUP]:
+        function(*args)
+    latencies = []
+    for args in inputs:
+        start = time.time()
+        function(*args)
+        latencies.append(time.time() - start)
+    return latencies
+
+
+def run_benchmark(clips, models, tracker, overlays, overlay_pos, frame_width):
+    """
+    Runs every stage of the realtime loop in isolation on the frames of the clips, and
+    the whole loop end-to-end.
+
+    Args:
+        clips (list[list[np.ndarray]]): The consecutive frames of every video.
+        models (macaw.Recognition): The masks and recognition models.
+        tracker (tracking.BuildingTracker): The tracker for the end-to-end run.
+        overlays (dict): The overlays, for the compositing.
+        overlay_pos (np.ndarray): The position of the overlays.
+        frame_width (int): The processing width of the frames.
+
+    Returns:
+        dict: The latency summary of every stage, see summarize.
+    """
+    frames = [frame for clip in clips for frame in clip]
+    prepared = [features.PreparedFrame(frame, width=frame_width) for frame in frames]
+    pairs = []
+    start = 0
+    for clip in clips:
+        pairs += [(start + i, start + i + 1) for i in range(len(clip) - 1)]
+        start += len(clip)
+    stages = {}
+
+    stages["resize_blur"] = time_calls(
+        lambda frame: features.PreparedFrame(frame, width=frame_width),
+        [(frame,) for frame in frames],
+    )
+
+    stages["feature_extraction"] = time_calls(
+        models.compute_feature, [(p.gray,) for p in prepared]
+    )
+
+    # Track good features of a frame into the next frame
+    tracking_inputs = []
+    for i, j in pairs:
+        pts = cv.goodFeaturesToTrack(
+            features.to_array(prepared[i].gray),
+            features.MAX_TRACKED_POINTS,
+            qualityLevel=0.01,
+            minDistance=features.MIN_POINT_DISTANCE,
+        )
+        if pts is not None:
+            pts = np.float32(pts)
+            matches = features.Matches.unmatched(len(pts))
+            tracking_inputs.append(
+                (prepared[i].gray, prepared[j].gray, pts, pts, matches, None)
+            )
+    if tracking_inputs:
+        stages["lk_tracking"] = time_calls(features.track, tracking_inputs)
+
+    # Match every frame with the masks of the label that fits best
+    labels = list(models.masks)
+    matching_inputs = []
+    homography_inputs = []
+    for p in prepared:
+        pts, des = p.features(models.compute_feature)
+        if des is None or len(des) < 2:
+            continue
+        best = None
+        for label in labels:
+            for mask_id, matches in enumerate(models.matcher.match_masks(des, label)):
+                if best is None or len(matches) > len(best[2]):
+                    best = (label, mask_id, matches)
+        label, mask_id, matches = best
+        matching_inputs.append((des, label))
+        if len(matches) >= 4:
+            homography_inputs.append(
+                features.get_points_from_matches(
+                    matches, pts, models.masks[label][mask_id].pts
+                )
+            )
+    if matching_inputs:
+        stages["flann_matching"] = time_calls(
+            models.matcher.match_masks, matching_inputs
+        )
+    if homography_inputs:
+        stages["homography"] = time_calls(
+            features.estimate_homography, homography_inputs
+        )
+
+    if models.model_predictor is not None:
+        stages["detector_inference"] = time_calls(
+            lambda frame: models.model_predictor.predict([frame]),
+            [(p.frame,) for p in prepared],
+        )
+
+    # The whole loop, frame by frame as in macaw(), restarting for every clip. The
+    # compositor draws in place, so it gets a copy of the frames, which are reused.
+    compositor = rendering.Compositor(overlays, overlay_pos)
+    results = []
+    end_to_end = []
+    for clip in clips:
+        tracker.reset()
+        for frame in clip:
+            start = time.time()
+            p = features.PreparedFrame(frame, width=frame_width)
+            result = tracker(p)
+            compositor(frame.copy(), result, p.ratio)
+            end_to_end.append(time.time() - start)
+            results.append((frame, result, p.ratio))
+
+    stages["compositing"] = time_calls(
+        lambda frame, result, ratio: compositor(frame.copy(), result, ratio), results
+    )
+    stages["end_to_end"] = end_to_end
+
+    return {stage: summarize(latencies) for stage, latencies in stages.items()}
+
+
+def check_regressions(report, baseline, tolerance=TOLERANCE):
+    """
+    Compares the stages of the report with a baseline report.
+
+    Args:
+        report (dict): The benchmark report.
+        baseline (dict): The baseline report.
+        tolerance (float, optional): The relative slowdown of a stage that counts as a
+            regression. Defaults to TOLERANCE.
+
+    Returns:
+        list[str]: A description of every regression.
+    """
+    regressions = []
+    for stage, summary in report["stages"].items():
+        reference = baseline["stages"].get(stage)
+        if reference is None:
+            continue
+        for metric in REGRESSION_METRICS:
+            limit = reference[metric] * (1 + tolerance)
+            if summary[metric] > limit:
+                regressions.append(
+                    f"{stage}: {metric} {summary[metric]:.2f}ms > {limit:.2f}ms "
+                    f"(baseline {reference[metric]:.2f}ms + {tolerance:.0%})"
+                )
+    return regressions
+
+
+def create_report(stages, **meta):
+    """
+    Creates the benchmark report with a description of the environment.
+
+    Args:
+        stages (dict): The latency summary of every stage.
+        **meta: Further information on the run, e.g. the feature type.
+
+    Returns:
+        dict: The report.
+    """
+    return dict(
+        meta=dict(
+            opencv=cv.__version__,
+            python=platform.python_version(),
+            machine=platform.machine(),
+            **meta,
+        ),
+        stages=stages,
+    )
+
+
+def load_report(file):
+    """
+    Loads a benchmark report.
+
+    Args:
+        file (str): Path to the JSON file.
+
+    Returns:
+        dict: The report, or None if the file does not exist.
+    """
+    if file is None or not Path(file).is_file():
+        return None
+    with open(file) as f:
+        return json.load(f)
+
+
+def save_report(report, file):
+    """
+    Saves a benchmark report.
+
+    Args:
+        report (dict): The report.
+        file (str): Path to the JSON file.
+
+    Returns:
+        None
+    """
+    Path(file).parent.mkdir(parents=True, exist_ok=True)
+    with open(file, "w") as f:
+        json.dump(report, f, indent=2)
@@ -0,0 +1,169 @@
+"""
+The following parameters are used by the budget controller.
+"""
+WIDTH_RANGE = (240, 720)  # processing width, in pixels
+WIDTH_STEP = 30
+MATCHING_RATE_RANGE = (10, 90)  # frames between two forced re-detections
+MATCHING_RATE_STEP = 10
+POINTS_RANGE = (60, 500)  # point budget of the tracker
+POINTS_STEP = 40
+SMOOTHING = 0.1  # weight of the newest frame in the moving averages
+ADJUST_INTERVAL = 15  # frames between two adjustments
+HEADROOM = 0.75  # below this share of the target frame time the quality is raised
+MAX_LOST_RATIO = 0.2  # share of frames without the building that is poor tracking
+CONTROLLED_STAGES = ("track",)  # stages whose cost depends on the settings
+
+
+class BudgetController:
+    """
+    Keeps the frame time of the realtime loop within a target by adjusting the
+    processing width, the forced re-detection interval and the point budget of the
+    tracker at runtime. Over budget, the settings that cost the least accuracy are
+    reduced first (point budget, then re-detection rate, then width); with headroom,
+    the re-detection rate and the width are raised first, the width before the rate
+    if the tracking is poor. The frame time is the moving average of the slowest
+    controlled stage, as the stages of the frame pipeline run in parallel. Of the
+    stages of macaw() (capture, track, composite), only the tracking depends on the
+    settings: the frames are reduced to the processing width by the reader on its
+    own thread, and the capture time is mostly the wait for the next frame.
+    """
+
+    def __init__(
+        self,
+        target_frame_time,
+        frame_width=450,
+        matching_rate=30,
+        max_tracked_points=300,
+        stages=CONTROLLED_STAGES,
+    ):
+        """
+        Initializes the BudgetController with the initial settings.
+
+        Args:
+            target_frame_time (float): The target frame time in seconds.
+            frame_width (int, optional): The initial processing width. Defaults to 450.
+            matching_rate (int, optional): The initial number of frames between two
+                forced re-detections. Defaults to 30.
+            max_tracked_points (int, optional): The initial point budget of the
+                tracker. Defaults to 300.
+            stages (tuple[str], optional): The stages of the frame pipeline whose
+                timings are controlled. Defaults to CONTROLLED_STAGES.
+
+        Returns:
+            None
+        """
+        self.target_frame_time = target_frame_time
+        self.width = frame_width
+        self.matching_rate = matching_rate
+        self.max_tracked_points = max_tracked_points
+        self.stages = stages
+        self.frame_time = None
+        self.lost_ratio = 0.0
+        self.frames = 0
+        self.adjustments = 0
+
+    def update(self, timings, result):
+        """
+        Adds the measurements of a frame and adjusts the settings every
+        ADJUST_INTERVAL frames.
+
+        Args:
+            timings (dict[str, float]): The time (in seconds) every stage of the frame
+                pipeline spent on the frame, see pipeline.Packet.
+            result (tracking.TrackingResult): The result of the tracker for the frame.
+
+        Returns:
+            bool: Whether the settings were changed.
+        """
+        stage_times = [timings[stage] for stage in self.stages if stage in timings]
+        if not stage_times:
+            return False
+        frame_time = max(stage_times)
+        lost = 1.0 if result.bbox is None else 0.0
+        if self.frame_time is None:
+            self.frame_time = frame_time
+        else:
+            self.frame_time += SMOOTHING * (frame_time - self.frame_time)
+        self.lost_ratio += SMOOTHING * (lost - self.lost_ratio)
+
+        self.frames += 1
+        if self.frames % ADJUST_INTERVAL != 0:
+            return False
+        if self.frame_time > self.target_frame_time:
+            changed = self.decrease()
+        elif self.frame_time < HEADROOM * self.target_frame_time:
+            changed = self.increase()
+        else:
+            changed = False
+        self.adjustments += changed
+        return changed
+
+    def decrease(self):
+        """
+        Reduces the cost of a frame by one step.
+
+        Returns:
+            bool: False if all settings are at their minimum, True otherwise.
+        """
+        if self.max_tracked_points > POINTS_RANGE[0]:
+            self.max_tracked_points = max(
+                self.max_tracked_points - POINTS_STEP, POINTS_RANGE[0]
+            )
+        elif self.matching_rate < MATCHING_RATE_RANGE[1]:
+            self.matching_rate = min(
+                self.matching_rate + MATCHING_RATE_STEP, MATCHING_RATE_RANGE[1]
+            )
+        elif self.width > WIDTH_RANGE[0]:
+            self.width = max(self.width - WIDTH_STEP, WIDTH_RANGE[0])
+        else:
+            return False
+        return True
+
+    def increase(self):
+        """
+        Raises the accuracy by one step: the building is re-detected more often, to
+        correct the drift of the tracking, unless it is often lost, in which case a
+        higher resolution is preferred.
+
+        Returns:
+            bool: False if all settings are at their maximum, True otherwise.
+        """
+        if self.lost_ratio > MAX_LOST_RATIO and self.width < WIDTH_RANGE[1]:
+            self.width = min(self.width + WIDTH_STEP, WIDTH_RANGE[1])
+        elif self.matching_rate > MATCHING_RATE_RANGE[0]:
+            self.matching_rate = max(
+                self.matching_rate - MATCHING_RATE_STEP, MATCHING_RATE_RANGE[0]
+            )
+        elif self.width < WIDTH_RANGE[1]:
+            self.width = min(self.width + WIDTH_STEP, WIDTH_RANGE[1])
+        elif self.max_tracked_points < POINTS_RANGE[1]:
+            self.max_tracked_points = min(
+                self.max_tracked_points + POINTS_STEP, POINTS_RANGE[1]
+            )
+        else:
+            return False
+        return True
+
+    def apply(self, tracker):
+        """
+        Sets the re-detection interval and the point budget of the tracker. The width
+        is applied by the reader, see video_player.VideoReaderAsync.
+
+        Args:
+            tracker (tracking.BuildingTracker): The tracker.
+
+        Returns:
+            None
+        """
+        tracker.matching_rate = self.matching_rate
+        tracker.max_tracked_points = self.max_tracked_points
+
+    def describe(self):
+        """
+        Returns:
+            str: The current settings, e.g. for the HUD.
+        """
+        return (
+            f"width: {self.width}px | re-detect: {self.matching_rate} frames "
+            f"| points: {self.max_tracked_points}"
+        )
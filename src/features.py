@@ -1,5 +1,10 @@
+import os
 import cv2 as cv
 import numpy as np
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+
+import tracing
 
 """
 The following parameters are used for the feature detection and matching.
@@ -7,6 +12,18 @@ The following parameters are used for the feature detection and matching.
 TRACKING_THRESHOLD = 0.95
 MATCHING_THRESHOLD = 15
 MATCH_DISTANCE = 0.7
+FLANN_MIN_DESCRIPTORS = 2000  # below this number of descriptors brute-force is faster
+CASCADE_SUBSET = 64  # number of descriptors used to rank the masks before matching
+REPROJECTION_THRESHOLD = 5.0  # in pixels of the mask
+TRACKING_REPROJECTION_THRESHOLD = 3.0  # in pixels of the processed frame
+HOMOGRAPHY_INLIER_RATIO = 0.9  # below this ratio the homography is estimated with RANSAC
+LK_MIN_EIG_THRESHOLD = 1e-3  # the forward-backward check filters unreliable points
+FB_THRESHOLD = 1.0  # maximum forward-backward error of a tracked point, in pixels
+LK_ERROR_THRESHOLD = 20.0  # maximum optical flow error of a tracked point
+MIN_TRACKED_POINTS = 15
+MAX_TRACKED_POINTS = 300  # point budget of the tracker
+REPLENISH_RATIO = 0.75  # replenish points when fewer than this ratio of the budget is left
+MIN_POINT_DISTANCE = 7  # minimum distance between tracked points, in pixels
 
 """
 The threshold lists for the different buildings.
@@ -50,8 +67,263 @@ MATCHING_THRESHOLDS = {
 }
 
 
-def compute_features_sift(img: np.ndarray) -> tuple[cv.KeyPoint, np.ndarray]:
+class FeatureExtractor(ABC):
+    """
+    Base class of the feature extractors. The detector is created once and reused for
+    every image, the matcher that fits the descriptors is created with create_matcher.
+    A backend sets its name and implements create.
+    """
+
+    name = None
+    binary = False
+
+    def __init__(self, nfeatures=None, octaves=None, octave_layers=None, threshold=None):
+        """
+        Initializes the FeatureExtractor and creates the detector. Parameters that are
+        None use the default of the backend, parameters a backend does not support are
+        ignored.
+
+        Args:
+            nfeatures (int, optional): The maximum number of features to retain.
+            octaves (int, optional): The number of octaves (pyramid levels).
+            octave_layers (int, optional): The number of layers per octave.
+            threshold (float, optional): The contrast/detection threshold.
+
+        Returns:
+            None
+        """
+        self.params = dict(
+            nfeatures=nfeatures,
+            octaves=octaves,
+            octave_layers=octave_layers,
+            threshold=threshold,
+        )
+        self.nfeatures = nfeatures
+        self.detector = self.create(**self.params)
+
+    @property
+    def cache_key(self):
+        """
+        Returns:
+            str: Description of the backend and its parameters, for the descriptor cache.
+        """
+        params = ",".join(f"{k}={v}" for k, v in sorted(self.params.items()))
+        return f"{self.name}({params})"
+
+    @abstractmethod
+    def create(self, nfeatures, octaves, octave_layers, threshold):
+        """
+        Creates the OpenCV detector of the backend. Parameters that are None use the
+        default of the backend.
+
+        Args:
+            nfeatures (int): The maximum number of features to retain.
+            octaves (int): The number of octaves (pyramid levels).
+            octave_layers (int): The number of layers per octave.
+            threshold (float): The contrast/detection threshold.
+
+        Returns:
+            cv.Feature2D: The detector.
+        """
+
+    def __call__(self, img, mask=None) -> tuple[cv.KeyPoint, np.ndarray]:
+        """
+        Computes the features of the given image.
+
+        Args:
+            img (np.ndarray): The image to compute the features of.
+            mask (np.ndarray, optional): Region of interest, features are only detected
+                where the mask is non-zero. Defaults to None.
+
+        Returns:
+            tuple[cv.KeyPoint, np.ndarray]: The keypoints and descriptors of the image.
+        """
+        return self.detector.detectAndCompute(img, mask)
+
+
+class RetainBestExtractor(FeatureExtractor):
+    """
+    Base class for backends without an own limit on the number of features. The
+    strongest nfeatures keypoints are kept before the descriptors are computed.
+    """
+
+    def __call__(self, img, mask=None) -> tuple[cv.KeyPoint, np.ndarray]:
+        if not self.nfeatures:
+            return self.detector.detectAndCompute(img, mask)
+        kp = self.detector.detect(img, mask)
+        if len(kp) > self.nfeatures:
+            kp = sorted(kp, key=lambda k: k.response, reverse=True)[: self.nfeatures]
+        return self.detector.compute(img, kp)
+
+
+class SiftExtractor(FeatureExtractor):
     # SIFT: https://docs.opencv.org/4.x/da/df5/tutorial_py_sift_intro.html
+    name = "SIFT"
+
+    def create(self, nfeatures, octaves, octave_layers, threshold):
+        params = dict(
+            nfeatures=nfeatures, nOctaveLayers=octave_layers, contrastThreshold=threshold
+        )
+        return cv.SIFT_create(**{k: v for k, v in params.items() if v is not None})
+
+
+class OrbExtractor(FeatureExtractor):
+    # ORB: https://docs.opencv.org/3.4/d1/d89/tutorial_py_orb.html
+    name = "ORB"
+    binary = True
+
+    def create(self, nfeatures, octaves, octave_layers, threshold):
+        params = dict(
+            nfeatures=nfeatures,
+            nlevels=octaves,
+            fastThreshold=None if threshold is None else int(threshold),
+        )
+        return cv.ORB_create(**{k: v for k, v in params.items() if v is not None})
+
+
+class AkazeExtractor(RetainBestExtractor):
+    # AKAZE: https://docs.opencv.org/4.x/db/d70/tutorial_akaze_matching.html
+    name = "AKAZE"
+    binary = True
+
+    def create(self, nfeatures, octaves, octave_layers, threshold):
+        params = dict(threshold=threshold, nOctaves=octaves, nOctaveLayers=octave_layers)
+        return cv.AKAZE_create(**{k: v for k, v in params.items() if v is not None})
+
+
+class BriskExtractor(RetainBestExtractor):
+    # BRISK: https://docs.opencv.org/4.x/de/dbf/classcv_1_1BRISK.html
+    name = "BRISK"
+    binary = True
+
+    def create(self, nfeatures, octaves, octave_layers, threshold):
+        params = dict(thresh=None if threshold is None else int(threshold), octaves=octaves)
+        return cv.BRISK_create(**{k: v for k, v in params.items() if v is not None})
+
+
+FEATURE_EXTRACTORS = {
+    "SIFT": SiftExtractor,
+    "ORB": OrbExtractor,
+    "AKAZE": AkazeExtractor,
+    "BRISK": BriskExtractor,
+}
+
+_default_extractors = {}
+
+
+def create_feature_extractor(feature_type, **params) -> FeatureExtractor:
+    """
+    Creates the feature extractor of the given type.
+
+    Args:
+        feature_type (str): The feature type, one of FEATURE_EXTRACTORS.
+        **params: The parameters of the extractor, see FeatureExtractor.
+
+    Returns:
+        FeatureExtractor: The feature extractor.
+    """
+    if feature_type not in FEATURE_EXTRACTORS:
+        print("UNKNOWN_FEATURE_TYPE: Defaulting to SIFT features!")
+        feature_type = "SIFT"
+    return FEATURE_EXTRACTORS[feature_type](**params)
+
+
+def is_binary(feature_type):
+    """
+    Returns:
+        bool: Whether the descriptors of the given feature type are binary strings.
+    """
+    return FEATURE_EXTRACTORS.get(feature_type, SiftExtractor).binary
+
+
+def default_extractor(feature_type) -> FeatureExtractor:
+    """
+    Returns the feature extractor of the given type with default parameters. The
+    extractor is only created once.
+
+    Args:
+        feature_type (str): The feature type, one of FEATURE_EXTRACTORS.
+
+    Returns:
+        FeatureExtractor: The feature extractor.
+    """
+    if feature_type not in _default_extractors:
+        _default_extractors[feature_type] = create_feature_extractor(feature_type)
+    return _default_extractors[feature_type]
+
+
+class PreparedFrame:
+    """
+    The images of a frame at processing resolution. They are reduced exactly once per
+    frame and shared by the tracker, the feature extraction and the detector; the
+    object is carried over as the previous frame of the next iteration. The features of
+    the frame are cached as well, so every consumer extracts them at most once.
+    """
+
+    def __init__(self, frame, width=None):
+        """
+        Initializes the PreparedFrame: resizes the frame to the processing width,
+        converts it to grayscale and blurs it.
+
+        Args:
+            frame (np.ndarray): The (BGR) frame at full resolution.
+            width (int, optional): The processing width. Defaults to None, i.e. the
+                frame is not resized.
+
+        Returns:
+            None
+        """
+        h, w = frame.shape[:2]
+        if width is not None and width != w:
+            size = (width, int(h * width / w))
+            frame = cv.resize(frame, size, interpolation=cv.INTER_AREA)
+        else:
+            # The full frame is drawn on in place, see rendering.Compositor
+            frame = frame.copy()
+        self.frame = frame
+        self.ratio = h / frame.shape[0]  # between full and processing resolution
+        gray = cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
+        self.gray = cv.UMat(cv.GaussianBlur(gray, (5, 5), 0))
+        self._features = {}
+
+    def features(self, extractor, box=None):
+        """
+        Returns the features of the frame, computed at most once per extractor. Features
+        inside a box reuse the features of the whole frame, if they were already
+        computed, and are otherwise detected with a ROI mask.
+
+        Args:
+            extractor (FeatureExtractor): The feature extractor.
+            box (list[int], optional): The box (XYXY) to restrict the features to.
+                Defaults to None.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The points (N, 2) and descriptors of the
+            features.
+        """
+        key = id(extractor)
+        if box is None or key in self._features:
+            if key not in self._features:
+                kp, des = extractor(self.gray)
+                self._features[key] = (keypoints_to_points(kp), to_array(des))
+            pts, des = self._features[key]
+            if box is None or des is None:
+                return pts, des
+            inside = (
+                (pts[:, 0] >= box[0])
+                & (pts[:, 0] < box[2])
+                & (pts[:, 1] >= box[1])
+                & (pts[:, 1] < box[3])
+            )
+            return pts[inside], des[inside]
+
+        roi = np.zeros(self.frame.shape[:2], dtype=np.uint8)
+        roi[box[1] : box[3], box[0] : box[2]] = 255
+        kp, des = extractor(self.gray, roi)
+        return keypoints_to_points(kp), to_array(des)
+
+
+def compute_features_sift(img: np.ndarray) -> tuple[cv.KeyPoint, np.ndarray]:
     """
     Computes the SIFT features of the given image.
 
@@ -61,11 +333,7 @@ def compute_features_sift(img: np.ndarray) -> tuple[cv.KeyPoint, np.ndarray]:
     Returns:
         tuple[cv.KeyPoint, np.ndarray]: The keypoints and descriptors of the image.
     """
-    sift = cv.SIFT_create()
-    pic = cv.normalize(img, None, 0, 255, cv.NORM_MINMAX)
-    kp, des = sift.detectAndCompute(pic, None)
-
-    return kp, des
+    return default_extractor("SIFT")(img)
 
 
 def compute_features_harris(img: np.ndarray, threshold=0.01):
@@ -92,7 +360,6 @@ def compute_features_harris(img: np.ndarray, threshold=0.01):
 
 
 def compute_features_orb(img: np.ndarray) -> tuple[cv.KeyPoint, np.ndarray]:
-    # ORB: https://docs.opencv.org/3.4/d1/d89/tutorial_py_orb.html
     """
     Computes the ORB features of the given image.
 
@@ -102,16 +369,97 @@ def compute_features_orb(img: np.ndarray) -> tuple[cv.KeyPoint, np.ndarray]:
     Returns:
         tuple[cv.KeyPoint, np.ndarray]: The keypoints and descriptors of the image.
     """
-    # Initiate ORB detector
-    orb = cv.ORB_create()
+    return default_extractor("ORB")(img)
 
-    # find the keypoints with ORB
-    kp = orb.detect(img, None)
 
-    # compute the descriptors with ORB
-    kp, des = orb.compute(img, kp)
-    # kp, des = orb.detectAndCompute(img, None)
-    return kp, des
+class Matches:
+    """
+    Accepted matches, stored as contiguous arrays instead of a list of cv.DMatch, so
+    they can be filtered and indexed without per-match Python work.
+    """
+
+    __slots__ = ("query_idx", "train_idx", "distance")
+
+    def __init__(self, query_idx, train_idx, distance):
+        """
+        Initializes the Matches.
+
+        Args:
+            query_idx (np.ndarray): The indices of the keypoints in the query image.
+            train_idx (np.ndarray): The indices of the keypoints in the train image/mask.
+            distance (np.ndarray): The descriptor distances.
+
+        Returns:
+            None
+        """
+        self.query_idx = np.ascontiguousarray(query_idx, dtype=np.int32)
+        self.train_idx = np.ascontiguousarray(train_idx, dtype=np.int32)
+        self.distance = np.ascontiguousarray(distance, dtype=np.float32)
+
+    @classmethod
+    def empty(cls):
+        return cls(np.empty(0), np.empty(0), np.empty(0))
+
+    @classmethod
+    def unmatched(cls, n):
+        """
+        Returns:
+            Matches: n placeholders for points without a descriptor match (index -1).
+        """
+        return cls(np.full(n, -1), np.full(n, -1), np.full(n, np.inf))
+
+    def concatenate(self, other):
+        """
+        Returns:
+            Matches: These matches followed by the other matches.
+        """
+        return Matches(
+            np.concatenate((self.query_idx, other.query_idx)),
+            np.concatenate((self.train_idx, other.train_idx)),
+            np.concatenate((self.distance, other.distance)),
+        )
+
+    def __len__(self):
+        return len(self.query_idx)
+
+    def __getitem__(self, selection):
+        """
+        Returns the matches selected by the given boolean mask or indices.
+        """
+        return Matches(
+            self.query_idx[selection],
+            self.train_idx[selection],
+            self.distance[selection],
+        )
+
+    def to_dmatches(self):
+        """
+        Returns:
+            list[cv.DMatch]: The matches as DMatch objects, e.g. for render_matches.
+        """
+        return [
+            cv.DMatch(q, t, d)
+            for q, t, d in zip(
+                self.query_idx.tolist(), self.train_idx.tolist(), self.distance.tolist()
+            )
+        ]
+
+
+def keypoints_to_points(kp):
+    """
+    Returns the coordinates of the given keypoints.
+
+    Args:
+        kp (list[cv.KeyPoint] | np.ndarray): The keypoints, or already their coordinates.
+
+    Returns:
+        np.ndarray: The points with shape (N, 2).
+    """
+    if isinstance(kp, np.ndarray):
+        return kp.reshape(-1, 2)
+    if len(kp) == 0:
+        return np.empty((0, 2), dtype=np.float32)
+    return cv.KeyPoint_convert(kp).reshape(-1, 2)
 
 
 def get_points_from_matches(matches_accepted, kp, kp2):
@@ -119,16 +467,16 @@ def get_points_from_matches(matches_accepted, kp, kp2):
     Returns the accepted points from the matches.
 
     Args:
-        matches_accepted (list[cv.DMatch]): The accepted matches.
-        kp (list[cv.KeyPoint]): The keypoints of the first image.
-        kp2 (list[cv.KeyPoint]): The keypoints of the second image.
+        matches_accepted (Matches): The accepted matches.
+        kp (np.ndarray | list[cv.KeyPoint]): The points/keypoints of the first image.
+        kp2 (np.ndarray | list[cv.KeyPoint]): The points/keypoints of the second image.
 
     Returns:
         tuple[np.ndarray, np.ndarray]: The points of the first and second image.
     """
-    pts1 = np.float32([kp[m.queryIdx].pt for m in matches_accepted]).reshape(-1, 1, 2)
-    pts2 = np.float32([kp2[m.trainIdx].pt for m in matches_accepted]).reshape(-1, 1, 2)
-    return pts1, pts2
+    pts1 = keypoints_to_points(kp)[matches_accepted.query_idx]
+    pts2 = keypoints_to_points(kp2)[matches_accepted.train_idx]
+    return np.float32(pts1).reshape(-1, 1, 2), np.float32(pts2).reshape(-1, 1, 2)
 
 
 def bounding_box(pts: list[np.array((2, 1))]) -> np.array((-1, 1, 2)):
@@ -162,6 +510,23 @@ def convex_hull(pts: list[np.array((2, 1))]) -> np.array((-1, 1, 2)):
     )  # .reshape((-1, 2))
 
 
+def ratio_test(idx, dist):
+    """
+    Applies Lowe's ratio test to the two nearest neighbours of every query descriptor.
+
+    Args:
+        idx (np.ndarray): The indices of the two nearest neighbours, shape (N, 2).
+        dist (np.ndarray): The distances of the two nearest neighbours, shape (N, 2).
+
+    Returns:
+        Matches: The accepted matches.
+    """
+    # store all the good matches as per Lowe's ratio test.
+    accepted = (idx[:, 1] >= 0) & (dist[:, 0] < MATCH_DISTANCE * dist[:, 1])
+    query_idx = np.flatnonzero(accepted)
+    return Matches(query_idx, idx[query_idx, 0], dist[query_idx, 0])
+
+
 # https://docs.opencv.org/3.4/d1/de0/tutorial_py_feature_homography.html
 def match_flann_SIFT(des, des2):
     """
@@ -172,21 +537,9 @@ def match_flann_SIFT(des, des2):
         des2 (np.ndarray): The descriptors of the second image.
 
     Returns:
-        list[cv.DMatch]: The accepted matches.
+        Matches: The accepted matches.
     """
-    FLANN_INDEX_KDTREE = 1
-    index_params = dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
-    search_params = dict(checks=50)
-
-    flann = cv.FlannBasedMatcher(index_params, search_params)
-    matches_accepted = []
-
-    matches = flann.knnMatch(des, des2, k=2)
-    # store all the good matches as per Lowe's ratio test.
-    for m, n in matches:
-        if m.distance < MATCH_DISTANCE * n.distance:
-            matches_accepted.append(m)
-    return matches_accepted
+    return ratio_test(*DescriptorIndex("SIFT", des2).knn(des, 2))
 
 
 def match_flann_ORB(des, des2):
@@ -198,28 +551,9 @@ def match_flann_ORB(des, des2):
         des2 (np.ndarray): The descriptors of the second image.
 
     Returns:
-        list[cv.DMatch]: The accepted matches.
+        Matches: The accepted matches.
     """
-    search_params = {}
-    index_params = dict(
-        algorithm=6,
-        table_number=6,  # was 12
-        key_size=12,  # was 20
-        multi_probe_level=1,
-    )  # was 2
-
-    flann = cv.FlannBasedMatcher(index_params, search_params)
-    matches_accepted = []
-
-    matches = flann.knnMatch(des, des2, k=2)
-    # store all the good matches as per Lowe's ratio test.
-    for tmp in matches:
-        if len(tmp) != 2:
-            continue
-        m, n = tmp
-        if m.distance < MATCH_DISTANCE * n.distance:
-            matches_accepted.append(m)
-    return matches_accepted
+    return ratio_test(*DescriptorIndex("ORB", des2).knn(des, 2))
 
 
 def estimate_homography(pts_src, points_st):
@@ -234,51 +568,396 @@ def estimate_homography(pts_src, points_st):
         tuple[np.ndarray, np.ndarray]: The homography and the mask.
     """
     m, mask = cv.findHomography(
-        pts_src, points_st, cv.RANSAC, 5.0, confidence=0.95
+        pts_src, points_st, cv.RANSAC, REPROJECTION_THRESHOLD, confidence=0.95
     )  # returns M, mask
     return m, mask
 
 
-def match(des, masks, feature_type):
+def reprojection_errors(homography, pts_src, pts_dst):
     """
-    Matches the given descriptors with the given masks depending on the feature type.
+    Returns the distances between the projected source points and the destination points.
 
     Args:
-        des (np.ndarray): The descriptors of the image.
-        masks (list[Mask]): The masks to match with.
-        feature_type (str): The feature type to use.
+        homography (np.ndarray): The homography from the source to the destination.
+        pts_src (np.ndarray): The source points.
+        pts_dst (np.ndarray): The destination points.
+
+    Returns:
+        np.ndarray: The reprojection error of every point.
+    """
+    projected = cv.perspectiveTransform(np.float32(pts_src), homography)
+    return np.linalg.norm(projected - pts_dst, axis=2).ravel()
+
+
+def update_homography(pts_src, pts_mask, homography_prev):
+    """
+    Updates the homography of a tracked template from the tracked correspondences.
+    The previous homography selects the points it still (roughly) explains, a
+    least-squares fit on these points is accepted, as long as it keeps the inlier
+    ratio high. Otherwise, or without a previous homography, RANSAC is used. The
+    reprojection errors are measured in the frame, where the points are tracked, as
+    the masks are several times larger than the processed frame.
+
+    Args:
+        pts_src (np.ndarray): The tracked points (of frame).
+        pts_mask (np.ndarray): The corresponding points of the template.
+        homography_prev (np.ndarray): The homography of the previous frame, or None.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: The homography from the frame to the template and
+        the boolean inlier mask of the points (both None if there are too few points).
+    """
+    if len(pts_src) < 4:
+        return None, None
+
+    threshold = TRACKING_REPROJECTION_THRESHOLD
+    if homography_prev is not None:
+        # The motion between two frames is small, so the prior gets a looser threshold
+        errors = reprojection_errors(np.linalg.inv(homography_prev), pts_mask, pts_src)
+        support = errors < 4 * threshold
+        if np.count_nonzero(support) >= 4:
+            m, _ = cv.findHomography(pts_src[support], pts_mask[support], 0)
+            if m is not None:
+                errors = reprojection_errors(np.linalg.inv(m), pts_mask, pts_src)
+                inliers = errors < threshold
+                if np.count_nonzero(inliers) >= HOMOGRAPHY_INLIER_RATIO * len(pts_src):
+                    return m, inliers
+
+    # Estimated from the template to the frame, so the threshold is in frame pixels
+    m, mask = cv.findHomography(
+        pts_mask, pts_src, cv.RANSAC, threshold, confidence=0.95
+    )
+    if m is None:
+        return None, None
+    return np.linalg.inv(m), mask.ravel().astype(bool)
 
+
+def to_array(arr):
+    """
     Returns:
-        tuple[list[cv.DMatch], int]: The accepted matches and the id of the mask.
+        np.ndarray: The given array or UMat as contiguous numpy array.
     """
-    matches_best = None
-    matches_best_nr = -1
-    mask_id = 0
+    if isinstance(arr, cv.UMat):
+        arr = arr.get()
+    return None if arr is None else np.ascontiguousarray(arr)
 
-    for idx, mask in enumerate(masks):
-        if feature_type == "SIFT":
-            matches_accepted = match_flann_SIFT(des, mask.des)
+
+class DescriptorIndex:
+    """
+    Nearest-neighbour index over a set of train descriptors, which returns its results
+    as arrays. For small numbers of descriptors, building a Flann index does not pay
+    off, so brute-force matching is used.
+    """
+
+    def __init__(self, feature_type, train):
+        """
+        Initializes the DescriptorIndex and builds the index, depending on the feature
+        type and the number of descriptors.
+
+        Args:
+            feature_type (str): The feature type of the descriptors.
+            train (np.ndarray): The train descriptors.
+
+        Returns:
+            None
+        """
+        self.binary = is_binary(feature_type)
+        self.train = to_array(train)
+        self.index = None
+        self.search_params = {}
+        if len(self.train) < FLANN_MIN_DESCRIPTORS:
+            return
+        if self.binary:
+            index_params = dict(
+                algorithm=6,
+                table_number=6,  # was 12
+                key_size=12,  # was 20
+                multi_probe_level=1,
+            )  # was 2
+        else:
+            FLANN_INDEX_KDTREE = 1
+            index_params = dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
+            self.search_params = dict(checks=50)
+        self.index = cv.flann_Index(self.train, index_params)
+
+    def __len__(self):
+        return len(self.train)
+
+    def knn(self, des, k):
+        """
+        Searches the k nearest neighbours of the given descriptors.
+
+        Args:
+            des (np.ndarray): The query descriptors.
+            k (int): The number of neighbours.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The indices (-1 if there is no neighbour) and
+            distances (inf if there is no neighbour) of the neighbours, shape (N, k).
+        """
+        des = to_array(des)
+        k_found = min(k, len(self.train))
+        if k_found == 0:
+            return (
+                np.full((len(des), k), -1, dtype=np.int32),
+                np.full((len(des), k), np.inf, dtype=np.float32),
+            )
+        if self.index is not None:
+            idx, dist = self.index.knnSearch(des, k_found, params=self.search_params)
+            dist = np.float32(dist)
+            if not self.binary:
+                dist = np.sqrt(dist)  # Flann returns squared euclidean distances
+        else:
+            norm = cv.NORM_HAMMING if self.binary else cv.NORM_L2
+            dtype = cv.CV_32S if self.binary else cv.CV_32F
+            dist, idx = cv.batchDistance(des, self.train, dtype, normType=norm, K=k_found)
+            dist = np.float32(dist)
+        idx = np.int32(idx).reshape(len(des), k_found)
+        dist = dist.reshape(len(des), k_found)
+        if k_found < k:
+            idx = np.pad(idx, ((0, 0), (0, k - k_found)), constant_values=-1)
+            dist = np.pad(dist, ((0, 0), (0, k - k_found)), constant_values=np.inf)
+        dist[idx < 0] = np.inf
+        return idx, dist
+
+
+class MaskMatcher:
+    """
+    Holds one trained index per label, built once over the descriptors of all masks of
+    that label. A single knn search per label then scores every mask of the label.
+    Masks are matched as a cascade: they are ranked with a small subset of the
+    descriptors, then fully matched and verified with a homography in rank order, until
+    a mask has enough inliers. Labels and candidate masks of one step of the cascade are
+    processed on a thread pool, since OpenCV releases the GIL.
+    """
+
+    def __init__(self, masks, feature_type, workers=None):
+        """
+        Initializes the MaskMatcher and builds the index of every label.
+
+        Args:
+            masks (dict): The masks per label, as returned by load_masks.
+            feature_type (str): The feature type of the descriptors.
+            workers (int, optional): The number of matching threads, which is also the
+                number of masks verified per step of the cascade. Defaults to the number
+                of CPUs.
+
+        Returns:
+            None
+        """
+        self.feature_type = feature_type
+        self.masks = masks
+        self.indexes = {}
+        self.offsets = {}
+        for label, label_masks in masks.items():
+            descriptors = [to_array(mask.des) for mask in label_masks]
+            sizes = [len(d) for d in descriptors]
+            self.indexes[label] = DescriptorIndex(feature_type, np.vstack(descriptors))
+            # the first descriptor of every mask, to recover which mask a neighbour came from
+            self.offsets[label] = np.concatenate(([0], np.cumsum(sizes)))
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = ThreadPoolExecutor(max_workers=self.workers)
+
+    def __contains__(self, label):
+        return label in self.indexes
+
+    def match_masks(self, des, label):
+        """
+        Matches the given descriptors with all masks of the given label at once. The
+        offsets of the masks in the index record which mask each neighbour came from, so
+        Lowe's ratio test is applied to the two nearest neighbours of every mask
+        separately.
+
+        Args:
+            des (np.ndarray): The descriptors of the image.
+            label (str): The label of the masks to match with.
+
+        Returns:
+            list[Matches]: The accepted matches of every mask of the label.
+        """
+        index = self.indexes[label]
+        offsets = self.offsets[label]
+        nr_masks = len(offsets) - 1
+
+        # The k nearest neighbours over all masks contain (mostly) the two nearest
+        # neighbours of each single mask
+        idx, dist = index.knn(des, 2 * nr_masks)
+        mask_idx = np.searchsorted(offsets, idx, side="right") - 1
+        mask_idx[idx < 0] = -1
+
+        matches = []
+        queries = np.arange(len(des))
+        for i in range(nr_masks):
+            in_mask = mask_idx == i
+            rank = np.cumsum(in_mask, axis=1) * in_mask
+            col_first = np.argmax(rank == 1, axis=1)
+            col_second = np.argmax(rank == 2, axis=1)
+            has_second = (rank == 2).any(axis=1)
+            knn_idx = np.stack(
+                (
+                    idx[queries, col_first] - offsets[i],
+                    np.where(has_second, idx[queries, col_second], -1),
+                ),
+                axis=1,
+            )
+            knn_dist = np.stack(
+                (dist[queries, col_first], dist[queries, col_second]), axis=1
+            )
+            matches.append(ratio_test(knn_idx, knn_dist))
+        return matches
+
+    def rank_masks(self, des, labels):
+        """
+        Ranks the masks of the given labels by the number of accepted matches of a small,
+        evenly spaced subset of the descriptors.
+
+        Args:
+            des (np.ndarray): The descriptors of the image.
+            labels (list[str]): The labels of the masks to rank.
+
+        Returns:
+            list[tuple[str, int]]: The label and mask id of all masks, best first.
+        """
+        subset = des[:: max(1, len(des) // CASCADE_SUBSET)]
+        if len(labels) == 1:
+            scores = [self.match_masks(subset, labels[0])]
         else:
-            matches_accepted = match_flann_ORB(des, mask.des)
+            scores = self.pool.map(lambda label: self.match_masks(subset, label), labels)
+        ranked = [
+            (len(matches), label, mask_id)
+            for label, label_matches in zip(labels, scores)
+            for mask_id, matches in enumerate(label_matches)
+        ]
+        # stable sort, so ties keep the order of the labels
+        ranked.sort(key=lambda r: -r[0])
+        return [(label, mask_id) for _, label, mask_id in ranked]
+
+    def verify(self, pts, label, mask_id, matches):
+        """
+        Verifies the matches of a mask with a homography. Masks with too few matches to
+        pass the matching threshold of their label are not verified.
+
+        Args:
+            pts (np.ndarray): The points of the keypoints of the image.
+            label (str): The label of the mask.
+            mask_id (int): The id of the mask.
+            matches (Matches): The accepted matches of the mask.
+
+        Returns:
+            tuple[int, np.ndarray, np.ndarray]: The number of inliers, the homography
+            and the inlier mask of the matches.
+        """
+        if len(matches) <= max(MATCHING_THRESHOLDS.get(label, MATCHING_THRESHOLD), 4):
+            return 0, None, None
+        src_pts, mask_pts = get_points_from_matches(
+            matches, pts, self.masks[label][mask_id].pts
+        )
+        m, msk = estimate_homography(src_pts, mask_pts)
+        if m is None:
+            return 0, None, None
+        inliers = msk.ravel().astype(bool)
+        return int(np.count_nonzero(inliers)), m, inliers
+
+    def match(self, des, labels, kp=None):
+        """
+        Matches the given descriptors with the masks of the given labels. If the
+        keypoints are given, the masks are matched as a cascade: in the order of
+        rank_masks, a batch of masks is fully matched and verified in parallel, until
+        one of them has more homography inliers than the matching threshold of its label.
+        Only the inliers of the selected mask are returned, together with the homography,
+        so it does not have to be estimated again. If no mask passes the verification,
+        no matches are returned. Without keypoints, all masks are matched and the mask
+        with the most matches is selected.
+
+        Args:
+            des (np.ndarray): The descriptors of the image.
+            labels (str | list[str]): The label(s) of the masks to match with.
+            kp (list[cv.KeyPoint] | np.ndarray, optional): The keypoints of the image.
+                Defaults to None.
+
+        Returns:
+            tuple[Matches, int, str, np.ndarray]: The accepted matches, the id of the
+            mask, its label and the verified homography. If no mask passed, the
+            matches are empty, the homography is None and the mask is the best one.
+        """
+        if isinstance(labels, str):
+            labels = [labels]
+        labels = [label for label in labels if label in self.indexes]
+        des = to_array(des)
+        if des is None or len(des) < 2 or len(labels) == 0:
+            return Matches.empty(), 0, labels[0] if labels else None, None
+
+        if kp is None:
+            best = (Matches.empty(), 0, labels[0], None)
+            for label in labels:
+                for mask_id, matches in enumerate(self.match_masks(des, label)):
+                    if len(matches) > len(best[0]):
+                        best = (matches, mask_id, label, None)
+            return best
+
+        pts = keypoints_to_points(kp)
+        ranked = self.rank_masks(des, labels)
+        full = {}
+        best = None
+        best_score = None
+        for start in range(0, len(ranked), self.workers):
+            batch = ranked[start : start + self.workers]
+            missing = list(dict.fromkeys(l for l, _ in batch if l not in full))
+            full.update(
+                zip(missing, self.pool.map(lambda l: self.match_masks(des, l), missing))
+            )
+            results = self.pool.map(
+                lambda c: self.verify(pts, *c, full[c[0]][c[1]]), batch
+            )
+            for (label, mask_id), (inliers, m, msk) in zip(batch, results):
+                matches = full[label][mask_id]
+                score = (inliers, len(matches))
+                if best_score is None or score > best_score:
+                    best_score = score
+                    best = (label, mask_id, matches, inliers, m, msk)
+
+            label, mask_id, matches, inliers, m, msk = best
+            if inliers > MATCHING_THRESHOLDS.get(label, MATCHING_THRESHOLD):
+                return matches[msk], mask_id, label, m
+
+        # No mask passed the verification, its matches must not be used
+        label, mask_id, _, _, _, _ = best
+        return Matches.empty(), mask_id, label, None
+
+
+def match(des, matcher, labels, kp=None):
+    """
+    Matches the given descriptors with the masks of the given label(s), using the
+    prebuilt indexes of the matcher.
 
-        if len(matches_accepted) > matches_best_nr:
-            matches_best = matches_accepted
-            matches_best_nr = len(matches_accepted)
-            mask_id = idx
+    Args:
+        des (np.ndarray): The descriptors of the image.
+        matcher (MaskMatcher): The matcher holding the indexes of all labels.
+        labels (str | list[str]): The label(s) of the masks to match with, e.g. the
+            top-k labels of the detector.
+        kp (list[cv.KeyPoint] | np.ndarray, optional): The keypoints of the image, to
+            verify the masks with a homography. Defaults to None.
 
-    return matches_best, mask_id  # Support for list of masks -> return best match
+    Returns:
+        tuple[Matches, int, str, np.ndarray]: The accepted matches, the id of the mask,
+        its label and the verified homography (or None).
+    """
+    with tracing.span("match"):
+        return matcher.match(des, labels, kp)  # Support for list of masks -> return best match
 
 
-def calc_bounding_box(matches_accepted, mask, src_pts, mask_pts, label):
+def calc_bounding_box(matches_accepted, mask, src_pts, mask_pts, label, homography=None):
     """
     Calculates the bounding box of the accepted matches.
 
     Args:
-        matches_accepted (list[cv.DMatch]): The accepted matches.
+        matches_accepted (Matches): The accepted matches.
         mask (Mask): The template to use for the homography.
         src_pts (np.ndarray): The matched points (of frame).
         mask_pts (np.ndarray): The matched points of the template.
         label (str): The label of the template.
+        homography (np.ndarray, optional): A homography from the frame to the template,
+            that was already verified, e.g. by the matching cascade. Defaults to None.
 
     Returns:
         np.ndarray: The bounding box of the accepted matches.
@@ -288,11 +967,16 @@ def calc_bounding_box(matches_accepted, mask, src_pts, mask_pts, label):
     if label in MATCHING_THRESHOLDS:
         threshold = MATCHING_THRESHOLDS[label]
 
+    # With a verified homography: Project the template without estimating it again
+    if homography is not None:
+        return cv.perspectiveTransform(mask.box_points, np.linalg.pinv(homography))
+
     # With enough matches: Estimate Homography
     if len(matches_accepted) > 2 * threshold:
         m, msk = estimate_homography(src_pts, mask_pts)
-        dst = cv.perspectiveTransform(mask.box_points, np.linalg.pinv(m))
-        return dst
+        if m is not None:
+            dst = cv.perspectiveTransform(mask.box_points, np.linalg.pinv(m))
+            return dst
 
     # TODO: If there is no homography use detector
     # With slightly fewer hits: Fit bounding box
@@ -303,20 +987,37 @@ def calc_bounding_box(matches_accepted, mask, src_pts, mask_pts, label):
     return None
 
 
-def track(img_old, img_new, pts_old, pts_mask_old, matches_old, label):
+def track(
+    img_old,
+    img_new,
+    pts_old,
+    pts_mask_old,
+    matches_old,
+    label,
+    max_points=MAX_TRACKED_POINTS,
+):
     """
-    Tracks the given points from the old image to the new image.
+    Tracks the given points from the old image to the new image. Points are only kept
+    if tracking them back to the old image ends close to where they started
+    (forward-backward check) and their optical flow error is small. At most max_points
+    points are kept, the ones with the smallest forward-backward error. The tracking
+    is valid if enough points are kept and the tracking threshold of the label is
+    reached by the points that carry a match from the last verification (all points,
+    if none of them do).
 
     Args:
         img_old (np.ndarray): The old image.
         img_new (np.ndarray): The new image.
         pts_old (np.ndarray): The points to track.
         pts_mask_old (np.ndarray): The old points of the template.
+        matches_old (Matches): The matches belonging to the points.
         label (str): The label of the template.
+        max_points (int, optional): The point budget. Defaults to MAX_TRACKED_POINTS.
 
     Returns:
-        tuple[np.ndarray, np.ndarray, bool]: The tracked points in the new frame, the tracked points
-        in the template and if there is enough points for the tracking to be valid.
+        tuple[np.ndarray, np.ndarray, Matches, bool]: The tracked points in the new frame,
+        the tracked points in the template, their matches and if there is enough points
+        for the tracking to be valid.
     """
     threshold = TRACKING_THRESHOLD
 
@@ -324,7 +1025,7 @@ def track(img_old, img_new, pts_old, pts_mask_old, matches_old, label):
         threshold = TRACKING_THRESHOLDS[label]
 
     pts_new, st, err = cv.calcOpticalFlowPyrLK(
-        img_old, img_new, pts_old, None, minEigThreshold=0.1
+        img_old, img_new, pts_old, None, minEigThreshold=LK_MIN_EIG_THRESHOLD
     )
     good_new = None
     mask_new = None
@@ -332,14 +1033,185 @@ def track(img_old, img_new, pts_old, pts_mask_old, matches_old, label):
 
     valid = False  # Check if enough points are tracked
     if pts_new is not None:
-        good_new = pts_new.get()[st.get()[:, 0] == 1]
-        mask_new = pts_mask_old[st.get()[:, 0] == 1]
-        matches_new = np.array(matches_old)[st.get()[:, 0] == 1]
-        matches_new = [i for i in matches_new]
-
-    # TODO: Check succesfull tracking condition  again
-    # TODO: Maybe try to track detector results as well!
-    if float(len(good_new)) / float(len(pts_old)) >= threshold and len(good_new) > 15:
-        valid = True
+        pts_new = to_array(pts_new)
+        tracked = to_array(st).ravel() == 1
+        pts_back, st_back, _ = cv.calcOpticalFlowPyrLK(
+            img_new, img_old, pts_new, None, minEigThreshold=LK_MIN_EIG_THRESHOLD
+        )
+        fb_error = np.linalg.norm(to_array(pts_back) - pts_old, axis=2).ravel()
+        good = (
+            tracked
+            & (to_array(st_back).ravel() == 1)
+            & (fb_error < FB_THRESHOLD)
+            & (to_array(err).ravel() < LK_ERROR_THRESHOLD)
+        )
+        keep = np.flatnonzero(good)
+        if len(keep) > max_points:
+            keep = keep[np.argsort(fb_error[keep], kind="stable")[:max_points]]
+            keep.sort()
+        good_new = pts_new[keep]
+        mask_new = pts_mask_old[keep]
+        matches_new = matches_old[keep]
+
+        # The ratio is taken over the points matched at the last verification, as
+        # points that were just replenished often fail to track
+        matched = matches_old.train_idx >= 0
+        if not np.any(matched):
+            matched = np.ones(len(pts_old), dtype=bool)
+        ratio = np.count_nonzero(tracked & matched) / np.count_nonzero(matched)
+        # TODO: Maybe try to track detector results as well!
+        if ratio >= threshold and len(good_new) > MIN_TRACKED_POINTS:
+            valid = True
 
     return good_new, mask_new, matches_new, valid
+
+
+def replenish(
+    img,
+    pts_src,
+    pts_mask,
+    matches,
+    homography,
+    region,
+    max_points=MAX_TRACKED_POINTS,
+):
+    """
+    Adds new points to track, once fewer than REPLENISH_RATIO of the point budget are
+    left. New good features are detected inside the region of the template in the frame,
+    away from the tracked points, and back-projected into the template with the
+    homography.
+
+    Args:
+        img (np.ndarray): The (gray) frame.
+        pts_src (np.ndarray): The tracked points (of frame).
+        pts_mask (np.ndarray): The corresponding points of the template.
+        matches (Matches): The matches belonging to the points.
+        homography (np.ndarray): The homography from the frame to the template.
+        region (np.ndarray): The outline of the template in the frame.
+        max_points (int, optional): The point budget. Defaults to MAX_TRACKED_POINTS.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, Matches]: The points of the frame, the points of
+        the template and the matches, with the new points (without a match) appended.
+    """
+    missing = max_points - len(pts_src)
+    if homography is None or region is None:
+        return pts_src, pts_mask, matches
+    if missing <= (1 - REPLENISH_RATIO) * max_points:
+        return pts_src, pts_mask, matches
+
+    img = to_array(img)
+    mask = np.zeros(img.shape[:2], dtype=np.uint8)
+    cv.fillPoly(mask, [np.int32(region).reshape(-1, 2)], 255)
+    for x, y in np.int32(pts_src).reshape(-1, 2).tolist():
+        cv.circle(mask, (x, y), MIN_POINT_DISTANCE, 0, -1)
+
+    pts_new = cv.goodFeaturesToTrack(
+        img, missing, qualityLevel=0.01, minDistance=MIN_POINT_DISTANCE, mask=mask
+    )
+    if pts_new is None:
+        return pts_src, pts_mask, matches
+
+    pts_new = np.float32(pts_new).reshape(-1, 1, 2)
+    pts_mask_new = cv.perspectiveTransform(pts_new, homography)
+    return (
+        np.concatenate((pts_src, pts_new)),
+        np.concatenate((pts_mask, pts_mask_new)),
+        matches.concatenate(Matches.unmatched(len(pts_new))),
+    )
+
+
+class FlowAccumulator:
+    """
+    Follows the motion of a frame over the next frames with sparse optical flow. Boxes
+    that were found in the frame later, e.g. by a slow detector, can then be mapped
+    into the current frame.
+    """
+
+    def __init__(self, img, max_points=MAX_TRACKED_POINTS):
+        """
+        Initializes the FlowAccumulator with good features to track of the frame.
+
+        Args:
+            img (np.ndarray): The (gray) frame.
+            max_points (int, optional): The number of points to follow. Defaults to
+                MAX_TRACKED_POINTS.
+
+        Returns:
+            None
+        """
+        pts = cv.goodFeaturesToTrack(
+            to_array(img), max_points, qualityLevel=0.01, minDistance=MIN_POINT_DISTANCE
+        )
+        if pts is None:
+            pts = np.empty((0, 1, 2))
+        self.origin = np.float32(pts).reshape(-1, 1, 2)
+        self.pts = self.origin.copy()
+
+    def update(self, img_old, img_new):
+        """
+        Follows the points from the old to the new frame. Points that fail the
+        forward-backward check are dropped.
+
+        Args:
+            img_old (np.ndarray): The old (gray) frame.
+            img_new (np.ndarray): The new (gray) frame.
+
+        Returns:
+            None
+        """
+        if len(self.pts) == 0:
+            return
+        pts_new, st, _ = cv.calcOpticalFlowPyrLK(
+            img_old, img_new, self.pts, None, minEigThreshold=LK_MIN_EIG_THRESHOLD
+        )
+        if pts_new is None:
+            self.origin, self.pts = self.origin[:0], self.pts[:0]
+            return
+        pts_new = to_array(pts_new)
+        pts_back, st_back, _ = cv.calcOpticalFlowPyrLK(
+            img_new, img_old, pts_new, None, minEigThreshold=LK_MIN_EIG_THRESHOLD
+        )
+        fb_error = np.linalg.norm(to_array(pts_back) - self.pts, axis=2).ravel()
+        good = (
+            (to_array(st).ravel() == 1)
+            & (to_array(st_back).ravel() == 1)
+            & (fb_error < FB_THRESHOLD)
+        )
+        self.origin, self.pts = self.origin[good], pts_new[good]
+
+    def propagate(self, box):
+        """
+        Maps a box of the first frame into the current frame, with the similarity
+        transform of the points inside the box (or of all points, if too few are
+        inside).
+
+        Args:
+            box (np.ndarray): The box (XYXY) in the first frame.
+
+        Returns:
+            np.ndarray: The box (XYXY) in the current frame. If the motion cannot be
+            estimated, the box is returned unchanged.
+        """
+        box = np.float32(box)
+        origin = self.origin.reshape(-1, 2)
+        inside = (
+            (origin[:, 0] >= box[0])
+            & (origin[:, 0] < box[2])
+            & (origin[:, 1] >= box[1])
+            & (origin[:, 1] < box[3])
+        )
+        if np.count_nonzero(inside) < MIN_TRACKED_POINTS:
+            inside[:] = True
+        if np.count_nonzero(inside) < 3:
+            return box
+        m, _ = cv.estimateAffinePartial2D(
+            self.origin[inside], self.pts[inside], ransacReprojThreshold=3.0
+        )
+        if m is None:
+            return box
+        corners = np.float32(
+            [[box[0], box[1]], [box[2], box[1]], [box[2], box[3]], [box[0], box[3]]]
+        )
+        corners = cv.transform(corners.reshape(-1, 1, 2), m).reshape(-1, 2)
+        return np.concatenate((corners.min(axis=0), corners.max(axis=0)))
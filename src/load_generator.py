@@ -0,0 +1,110 @@
+import argparse
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+
+def send(url, data, content_type):
+    """
+    Sends one image to the recognition service.
+
+    Args:
+        url (str): The URL of the service.
+        data (bytes): The image.
+        content_type (str): The content type of the image.
+
+    Returns:
+        tuple[int, float]: The HTTP status code and the latency in seconds.
+    """
+    request = urllib.request.Request(
+        url, data=data, headers={"Content-Type": content_type}, method="POST"
+    )
+    start = time.time()
+    try:
+        with urllib.request.urlopen(request) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except urllib.error.URLError:
+        status = 0
+    return status, time.time() - start
+
+
+def generate_load(url, images, requests=200, concurrency=8):
+    """
+    Sends the images to the recognition service from several concurrent clients and
+    measures the latency of every request.
+
+    Args:
+        url (str): The URL of the service.
+        images (list[str]): Paths to the JPEG/PNG images, sent in turn.
+        requests (int, optional): The number of requests. Defaults to 200.
+        concurrency (int, optional): The number of concurrent clients. Defaults to 8.
+
+    Returns:
+        dict: The number of requests per status code, the latency percentiles (p50,
+        p95, p99, in ms) of the successful requests, the throughput of all requests
+        and of the successful ones (requests per second). Rejected requests (503) are
+        answered immediately, so only the successful throughput is the capacity of
+        the service.
+    """
+    payloads = []
+    for image in images:
+        content_type = "image/png" if image.lower().endswith(".png") else "image/jpeg"
+        payloads.append((Path(image).read_bytes(), content_type))
+
+    start = time.time()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(
+            executor.map(
+                lambda i: send(url, *payloads[i % len(payloads)]), range(requests)
+            )
+        )
+    elapsed = time.time() - start
+
+    statuses = Counter(status for status, _ in results)
+    latencies = np.array([latency for status, latency in results if status == 200])
+    report = dict(
+        requests=requests,
+        statuses=dict(statuses),
+        requests_per_second=round(requests / elapsed, 2),
+        successful_per_second=round(len(latencies) / elapsed, 2),
+    )
+    if len(latencies) > 0:
+        p50, p95, p99 = np.percentile(1000 * latencies, [50, 95, 99])
+        report.update(p50=round(p50, 1), p95=round(p95, 1), p99=round(p99, 1))
+    return report
+
+
+if __name__ == "__main__":
+    """
+    Load generator for the recognition service.
+    """
+    parser = argparse.ArgumentParser("load_generator")
+    parser.add_argument("images", nargs="+", help="The JPEG/PNG images to send.")
+    parser.add_argument(
+        "--url", default="http://127.0.0.1:8080/recognise", help="The service URL."
+    )
+    parser.add_argument("--requests", type=int, default=200, help="Number of requests.")
+    parser.add_argument(
+        "--concurrency", type=int, default=8, help="Number of concurrent clients."
+    )
+    args = parser.parse_args()
+
+    report = generate_load(args.url, args.images, args.requests, args.concurrency)
+    print(f"Requests:     {report['requests']} {report['statuses']}")
+    print(
+        f"Throughput:   {report['successful_per_second']} successful requests/s "
+        f"({report['requests_per_second']} requests/s in total)"
+    )
+    if "p50" in report:
+        print(
+            f"Latency (ms): p50 {report['p50']} | p95 {report['p95']} "
+            f"| p99 {report['p99']}"
+        )
@@ -1,247 +1,1041 @@
+import time
+
+START_TIME = time.time()  # before the other imports, for the start-up report
+
 import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
 import sys
 
-import methods.object_detection as object_detection
-import methods.labeling as labeling
 import utils_macaw as utils
+import benchmark
+import budget
 import features
+import pipeline
+import recognition
 import rendering
+import service
+import streams
+import tracing
+import tracking
 import video_player
 
 import numpy as np
 import cv2 as cv
-import time
 
-from methods.viewing import ImageViewer
-from methods.eval import TorchImageProvider, PredictionsProvider
-from utils.weights_loader import WeightsLoader
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
 
+# torch, torchvision, wandb, matplotlib and the labeling UI are only imported by the
+# methods that need them, see load_detector and the methods in __main__
+IMPORT_TIME = time.time() - START_TIME
 
-def macaw(
-    input_file,
+# TODO: Add parameters to the yaml file.
+FRAME_WIDTH = 450
+MATCHING_RATE = 30
+DETECTOR_LOGGING = True
+TRACKING_PARAMS = ("homography_tracking", "max_tracked_points", "async_detection")
+MIN_SEGMENT_FRAMES = 150  # shorter segments are not worth a process of their own
+
+
+"""
+The models used to recognise the buildings, shared by all trackers of a process.
+"""
+Recognition = namedtuple(
+    "Recognition",
+    ["masks", "matcher", "compute_feature", "vocabulary", "model_predictor"],
+)
+
+
+def load_recognition(
     path_masks,
-    path_overlays,
     feature_type,
     model_checkpoint,
     device,
     root,
     annotations_path,
     num_classes,
+    cache_path=None,
+    recognition_mode="detector",
+    feature_params=None,
+    match_top_k=1,
+    timings=None,
 ):
     """
-    Main function of the MACAW project. This function is called from the main.py file.
+    Loads the masks and the recognition models. The detector is loaded on a second
+    thread, while the features of the masks are computed.
 
     Args:
-        input_file (str): Path to the input video file.
         path_masks (str): Path to the masks folder.
-        path_overlays (str): Path to the overlays folder.
-        feature_type (str): Type of features to be used. Either "ORB" or "SIFT".
+        feature_type (str): Type of features to be used. One of "SIFT", "ORB", "AKAZE"
+            or "BRISK".
         model_checkpoint (str): Path to the model checkpoint.
         device (str): Device to run the model on. Either "cpu" or "cuda".
         root (str): Path to the dataset.
         annotations_path (str): Path to the annotations.
         num_classes (int): Number of classes used during training.
+        cache_path (str, optional): Path to the descriptor cache of the masks. Defaults
+            to None, in which case the features of the masks are computed on every start.
+        recognition_mode (str, optional): How buildings are recognised. Either "detector"
+            (Faster R-CNN), "vocabulary" (visual-vocabulary index, no neural detector) or
+            "hybrid" (visual-vocabulary index with the detector as fallback). Defaults
+            to "detector".
+        feature_params (dict, optional): Parameters of the feature extractor (nfeatures,
+            octaves, octave_layers, threshold). Defaults to None.
+        match_top_k (int, optional): Number of the detector's best labels, whose masks
+            are matched in parallel. Defaults to 1.
+        timings (dict, optional): If given, the loading times of the masks and the
+            detector are stored in it, in seconds. Defaults to None.
+
+    Returns:
+        Recognition: The masks, the matcher, the feature extractor, the visual
+        vocabulary (or None) and the detector (or None).
+    """
+    timings = {} if timings is None else timings
+    detector = None
+    if recognition_mode != "vocabulary":
+        executor = ThreadPoolExecutor(1)
+        detector = executor.submit(
+            timed,
+            timings,
+            "detector",
+            load_detector,
+            root,
+            annotations_path,
+            num_classes,
+            model_checkpoint,
+            device,
+            match_top_k,
+        )
+        executor.shutdown(wait=False)
+
+    start = time.time()
+    compute_feature = features.create_feature_extractor(
+        feature_type, **(feature_params or {})
+    )
+    feature_type = compute_feature.name
+
+    # Load Masks
+    masks = utils.load_masks(
+        path_masks,
+        compute_feature,
+        cache_path=cache_path,
+        cache_key=compute_feature.cache_key,
+    )
+    matcher = features.MaskMatcher(masks, feature_type)
+    vocabulary = None
+    if recognition_mode != "detector":
+        vocabulary = recognition.VocabularyIndex.from_masks(
+            masks,
+            path_masks,
+            compute_feature,
+            cache_path=cache_path,
+            check_width=FRAME_WIDTH,
+        )
+    timings["masks"] = time.time() - start
+
+    model_predictor = None if detector is None else detector.result()
+    return Recognition(masks, matcher, compute_feature, vocabulary, model_predictor)
+
+
+def load_detector(
+    root, annotations_path, num_classes, model_checkpoint, device, match_top_k=1
+):
+    """
+    Loads the detector. torch is imported here, so the methods and modes that do not
+    use the detector start without it.
+
+    Args:
+        root (str): Path to the dataset.
+        annotations_path (str): Path to the annotations.
+        num_classes (int): Number of classes used during training.
+        model_checkpoint (str): Path to the model checkpoint.
+        device (str): Device to run the model on. Either "cpu" or "cuda".
+        match_top_k (int, optional): Number of the detector's best labels, that are
+            kept as candidates for matching. Defaults to 1.
+
+    Returns:
+        PredictionsProvider: The detector.
+    """
+    from methods.eval import PredictionsProvider
+
+    return PredictionsProvider(
+        root,
+        annotations_path,
+        num_classes,
+        model_checkpoint,
+        device,
+        top_k=match_top_k,
+    )
+
+
+def timed(timings, name, function, *args, **kwargs):
+    """
+    Calls the function and stores its duration.
+
+    Args:
+        timings (dict): The durations in seconds, is updated in place.
+        name (str): The name of the duration.
+        function (callable): The function.
+        *args: The positional arguments of the function.
+        **kwargs: The keyword arguments of the function.
+
+    Returns:
+        Any: The result of the function.
+    """
+    start = time.time()
+    result = function(*args, **kwargs)
+    timings[name] = time.time() - start
+    return result
+
+
+def download_weights(model_checkpoint):
+    """
+    Downloads the weights of the detector, unless they exist already.
+
+    Args:
+        model_checkpoint (str): The name of the model checkpoint file.
 
     Returns:
         None
     """
-    # TODO: Add parameters to the yaml file.
-    detector_logging = True
-    frame_width = 450
-    matching_rate = 30
+    from utils.weights_loader import WeightsLoader
 
-    if type(input_file) is int:
-        fvs = utils.webcam_handler(input_file)  #
-    else:
-        fvs = utils.vid_handler(input_file)
+    weights_loader = WeightsLoader(model_checkpoint)
+    weights_loader()
 
-    match feature_type:
-        case "ORB":
-            compute_feature = features.compute_features_orb
-        case "SIFT":
-            compute_feature = features.compute_features_sift
-        case _:
-            print("UNKNOWN_FEATURE_TYPE: Defaulting to SIFT features!")
-            compute_feature = features.compute_features_sift
 
-    # Load Masks
-    masks = utils.load_masks(path_masks, compute_feature)
-    frame_shape = fvs.read().shape
+def report_startup(timings):
+    """
+    Prints how long the start-up took, up to the first rendered frame.
+
+    Args:
+        timings (dict): The durations of the start-up steps in seconds.
+
+    Returns:
+        None
+    """
+    steps = " | ".join(f"{name} {duration:.2f}s" for name, duration in timings.items())
+    print(f"[INFO] Start-up: {steps}")
+    print(f"[INFO] First frame rendered {time.time() - START_TIME:.2f}s after start")
 
-    # Load and rescale Overlays
+
+def create_tracker(
+    models,
+    model_predictor=None,
+    homography_tracking="incremental",
+    max_tracked_points=features.MAX_TRACKED_POINTS,
+    async_detection=False,
+):
+    """
+    Creates a tracker that uses the given recognition models. Trackers that run at the
+    same time get their own feature extractor, as the extractors are not thread-safe.
+
+    Args:
+        models (Recognition): The recognition models, as returned by load_recognition.
+        model_predictor (PredictionsProvider, optional): The detector of the tracker.
+            Defaults to None, i.e. the detector of the models.
+        homography_tracking (str, optional): How the homography is updated while
+            tracking. Either "incremental" (previous homography as prior, outliers are
+            pruned) or "ransac" (RANSAC on every frame). Defaults to "incremental".
+        max_tracked_points (int, optional): Point budget of the tracker. Defaults to
+            features.MAX_TRACKED_POINTS.
+        async_detection (bool, optional): Whether the detector runs on a background
+            thread, while the tracker continues on the newer frames. Defaults to False.
+
+    Returns:
+        tracking.BuildingTracker: The tracker.
+    """
+    compute_feature = features.create_feature_extractor(
+        models.compute_feature.name, **models.compute_feature.params
+    )
+    return tracking.BuildingTracker(
+        models.masks,
+        models.matcher,
+        compute_feature,
+        vocabulary=models.vocabulary,
+        model_predictor=model_predictor or models.model_predictor,
+        homography_tracking=homography_tracking,
+        max_tracked_points=max_tracked_points,
+        matching_rate=MATCHING_RATE,
+        detector_logging=DETECTOR_LOGGING,
+        async_detection=async_detection,
+    )
+
+
+def split_tracker_params(params):
+    """
+    Splits the parameters of a tracker into the parameters of load_recognition and
+    of create_tracker.
+
+    Args:
+        params (dict): The parameters, as returned by read_tracker_cfg.
+
+    Returns:
+        tuple[dict, dict]: The parameters of load_recognition and create_tracker.
+    """
+    tracking_params = {k: v for k, v in params.items() if k in TRACKING_PARAMS}
+    recognition_params = {k: v for k, v in params.items() if k not in TRACKING_PARAMS}
+    return recognition_params, tracking_params
+
+
+def prepare_overlays(path_overlays, frame_shape):
+    """
+    Loads the overlays and rescales them to the frame size.
+
+    Args:
+        path_overlays (str): Path to the overlays folder.
+        frame_shape (tuple): The shape of the frames at full resolution.
+
+    Returns:
+        tuple[dict, np.ndarray]: The overlays and their position in the frame.
+    """
     overlays = utils.load_overlays(
         path_overlays, width=int(0.75 * frame_shape[1])
     )  # width=int(0.75 * frame_width)
     overlay_shape = list(overlays.values())[0].shape
-    if overlay_shape[0] > 0.25 * fvs.read().shape[0]:
+    if overlay_shape[0] > 0.25 * frame_shape[0]:
         for i in overlays:
-            overlays[i] = utils.resize(
-                overlays[i], height=int(0.25 * fvs.read().shape[0])
-            )
-
-    # Initialize and start the VideoPlayer
-    vid_out = video_player.VideoPlayerAsync(
-        default_size=frame_shape[:2], target_fps=60
-    ).start()
-
-    # Initialize the detector
-    model_predictor = PredictionsProvider(
-        root, annotations_path, num_classes, model_checkpoint, device
-    )
-
-    # Ratio between full and computation resolution
-    new_shape = utils.resize(fvs.read(), width=frame_width).shape
-    ratio = frame_shape[0] / new_shape[0]
+            overlays[i] = utils.resize(overlays[i], height=int(0.25 * frame_shape[0]))
+        overlay_shape = list(overlays.values())[0].shape
     overlay_pos = np.int32(
         (
             frame_shape[0] - overlay_shape[0] - 40,
             0.5 * frame_shape[1] - 0.5 * overlay_shape[1],
         )
     )
+    return overlays, overlay_pos
 
-    # variables need across iterations
-    last_frame_gray = None  # gray  # cv.UMat((1, 1))
-    pts_f = None
-    pts_m = None
-    mask_id = None
-    matches = None
-    label = None
-    count = -1
-
-    # loop over frames from the video file stream
-    while vid_out.running:
-        count += 1
-        bbox = None
-        crop_offset = np.array([[[0, 0]]])
-
-        # grab the frame from the threaded video file stream, resize
-        # it, and convert it to grayscale (while still retaining 3
-        # channels)
-        time_start = time.time()
-
-        frame = fvs.read()
-        if frame is None:
-            break
-
-        render_target = cv.UMat(frame)
-        frame = utils.resize(frame, width=frame_width)
-        frame_gray = cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
-        frame_gray = cv.UMat(cv.GaussianBlur(frame_gray, (5, 5), 0))
-
-        valid = False
-
-        # tracking:
-        if count != matching_rate and pts_f is not None and len(pts_f) > 0:
-            pts_f, pts_m, matches, valid = features.track(
-                last_frame_gray, frame_gray, pts_f, pts_m, matches, label
-            )
-        else:
-            count = 0
 
-        # Calculate the new bounding box after successful tracking
-        if valid:
-            bbox = features.calc_bounding_box(
-                matches, masks[label][mask_id], pts_f, pts_m, label
-            )
+def preprocess(packet, width=FRAME_WIDTH):
+    """
+    Preprocessing stage of the frame pipeline: resizes the frame and converts it to
+    grayscale once, for all later stages.
+
+    Args:
+        packet (pipeline.Packet): The captured frame.
+        width (int, optional): The processing width. Defaults to FRAME_WIDTH.
+
+    Returns:
+        tuple[np.ndarray, features.PreparedFrame]: The frame and the prepared frame.
+    """
+    return packet.data, features.PreparedFrame(packet.data, width=width)
+
 
-        last_frame_gray = frame_gray
-
-        contours = []
-        # Boxes are in the format XYXY
-        if not valid or bbox is None:
-            l = label
-            pred = model_predictor(frame, silent=detector_logging)
-            hit = pred[0]
-            box_pixel = pred[1]
-            label = pred[2]
-            score = pred[3]
-
-            if label is None:
-                label = l
-            if (
-                hit
-                and label in masks
-                and (box_pixel[2] - box_pixel[0]) * (box_pixel[3] - box_pixel[1]) > 0
-            ):
-                # hit and non-zero patch
-                # Add the predicted bounding box from the model to the list for rendering
-                contours.append(
-                    (
-                        np.int32(
-                            [
-                                [[box_pixel[0] * ratio, box_pixel[1] * ratio]],
-                                [[box_pixel[2] * ratio, box_pixel[1] * ratio]],
-                                [[box_pixel[2] * ratio, box_pixel[3] * ratio]],
-                                [[box_pixel[0] * ratio, box_pixel[3] * ratio]],
-                            ]
-                        ),
-                        (255, 0, 0),
-                    )
-                )
-
-                # Crop the img
-                crop_offset = np.array([[[box_pixel[0], box_pixel[1]]]])
-                cropped = utils.crop_img(frame, *box_pixel)  # Test cropping and apply
-                cropped = cv.UMat(
-                    cv.GaussianBlur(cv.cvtColor(cropped, cv.COLOR_BGR2GRAY), (5, 5), 0)
-                )
-
-                # match the features of the cropped img
-                kp, des = compute_feature(cropped)
-                matches, mask_id = features.match(des, masks[label], feature_type)
-                pts_f, pts_m = features.get_points_from_matches(
-                    matches, kp, masks[label][mask_id].kp
-                )
-
-                # get the bounding box (None, with/without homography -> depends on number of hits)
-                bbox = features.calc_bounding_box(
-                    matches, masks[label][mask_id], pts_f, pts_m, label
-                )
-
-        if bbox is not None:
-            bbox += crop_offset  # bbox is calculated of the cropped image -> global coordinates by adding the offset
-            contours.append((np.int32(bbox * ratio), (255, 255, 210)))
-            # frame = rendering.render_fill_contours(render_target, np.int32(bbox))
-
-        # Render all contours
-        # for c in contours:
-        #     render_target = rendering.render_contours(render_target, c[0], color=c[1])
-        #     render_target = rendering.render_fill_contours(render_target, c[0], color=c[1])
-
-        if len(contours) > 0:
-            c = contours[-1]
-            render_target = rendering.render_contours(render_target, c[0], color=c[1])
-            render_target = rendering.render_fill_contours(
-                render_target, c[0], color=c[1]
+def macaw(
+    input_file,
+    path_masks,
+    path_overlays,
+    feature_type,
+    model_checkpoint,
+    device,
+    root,
+    annotations_path,
+    num_classes,
+    cache_path=None,
+    recognition_mode="detector",
+    feature_params=None,
+    match_top_k=1,
+    homography_tracking="incremental",
+    max_tracked_points=features.MAX_TRACKED_POINTS,
+    pipeline_queue_size=2,
+    async_detection=True,
+    trace_file=None,
+    trace_hud=False,
+    target_frame_time=None,
+    display_sinks=("window",),
+    display_file=None,
+    shared_memory_name="macaw",
+    reader_queue_bytes=64 * 1024**2,
+    realtime=False,
+):
+    """
+    Main function of the MACAW project. This function is called from the main.py file.
+
+    Args:
+        input_file (str): Path to the input video file.
+        path_masks (str): Path to the masks folder.
+        path_overlays (str): Path to the overlays folder.
+        feature_type (str): Type of features to be used. One of "SIFT", "ORB", "AKAZE"
+            or "BRISK".
+        model_checkpoint (str): Path to the model checkpoint.
+        device (str): Device to run the model on. Either "cpu" or "cuda".
+        root (str): Path to the dataset.
+        annotations_path (str): Path to the annotations.
+        num_classes (int): Number of classes used during training.
+        cache_path (str, optional): Path to the descriptor cache of the masks. Defaults
+            to None, in which case the features of the masks are computed on every start.
+        recognition_mode (str, optional): How buildings are recognised. Either "detector"
+            (Faster R-CNN), "vocabulary" (visual-vocabulary index, no neural detector) or
+            "hybrid" (visual-vocabulary index with the detector as fallback). Defaults
+            to "detector".
+        feature_params (dict, optional): Parameters of the feature extractor (nfeatures,
+            octaves, octave_layers, threshold). Defaults to None.
+        match_top_k (int, optional): Number of the detector's best labels, whose masks
+            are matched in parallel. Defaults to 1.
+        homography_tracking (str, optional): How the homography is updated while
+            tracking. Either "incremental" (previous homography as prior, outliers are
+            pruned) or "ransac" (RANSAC on every frame). Defaults to "incremental".
+        max_tracked_points (int, optional): Point budget of the tracker. Defaults to
+            features.MAX_TRACKED_POINTS.
+        pipeline_queue_size (int, optional): Size of the queues between the stages of
+            the frame pipeline. Defaults to 2.
+        async_detection (bool, optional): Whether the detector runs on a background
+            thread, while the tracker continues on the newer frames. Defaults to True.
+        trace_file (str, optional): Path to a Chrome trace (JSON) of the hot path, that
+            is written on exit. Defaults to None, i.e. no trace.
+        trace_hud (bool, optional): Whether the mean timings of the hot path and the
+            capture-to-display latency are shown on the video. Defaults to False.
+        target_frame_time (float, optional): The target frame time in seconds. If
+            given, the processing width, the re-detection interval and the point budget
+            are adjusted at runtime to keep it, see budget.BudgetController. Defaults to
+            None, i.e. fixed settings.
+        display_sinks (list[str], optional): The outputs of the displayed frames, any
+            of "window", "video", "shared_memory" and "null". Defaults to
+            ("window",).
+        display_file (str, optional): Path to the video file of the "video" sink.
+            Defaults to None.
+        shared_memory_name (str, optional): Name of the shared memory block of the
+            "shared_memory" sink. Defaults to "macaw".
+        reader_queue_bytes (int, optional): Size of the queue of decoded frames in
+            bytes. Defaults to 64 MiB.
+        realtime (bool, optional): Whether a video file is played in real time: once
+            the queue of decoded frames is full, the reader skips frames instead of
+            waiting for the processing. Defaults to False, i.e. every frame is
+            processed.
+
+    Returns:
+        None
+    """
+    tracing.enable(trace_file is not None or trace_hud)
+    startup = {"imports": IMPORT_TIME}
+
+    def open_video():
+        # A webcam is asked for the processing resolution and only its newest frame
+        # is kept. The reader of a file prepares the frames for the tracker on its
+        # own thread and reads the file completely, unless it is played in realtime.
+        if type(input_file) is int:
+            reader = video_player.WebcamReaderAsync(input_file, width=FRAME_WIDTH)
+        else:
+            reader = video_player.VideoReaderAsync(
+                input_file,
+                width=FRAME_WIDTH,
+                realtime=realtime,
+                max_bytes=reader_queue_bytes,
             )
+        reader.start()
+        frame_shape = reader.frame_shape()
+        if frame_shape is None:
+            raise IOError(f"Failed to read a frame from {input_file}.")
+        startup["video"] = time.time() - start
 
-        # Add Meta data:
-        if len(contours) > 0:
-            render_target = rendering.render_metadata(
-                render_target, label, overlays, pos=overlay_pos, alpha=0.9
-            )  # label
+        # Load and rescale Overlays
+        overlays = timed(
+            startup, "overlays", prepare_overlays, path_overlays, frame_shape
+        )
+        return reader, frame_shape, overlays
 
-        # show the frame and update the FPS counter
+    # The video and the overlays are opened while the masks and the detector load
+    start = time.time()
+    with ThreadPoolExecutor(1) as executor:
+        video = executor.submit(open_video)
+        models = load_recognition(
+            path_masks,
+            feature_type,
+            model_checkpoint,
+            device,
+            root,
+            annotations_path,
+            num_classes,
+            cache_path=cache_path,
+            recognition_mode=recognition_mode,
+            feature_params=feature_params,
+            match_top_k=match_top_k,
+            timings=startup,
+        )
+        reader, frame_shape, (overlays, overlay_pos) = video.result()
+    tracker = create_tracker(
+        models,
+        homography_tracking=homography_tracking,
+        max_tracked_points=max_tracked_points,
+        async_detection=async_detection,
+    )
+    startup["loading"] = time.time() - start
+
+    controller = None
+    if target_frame_time is not None:
+        controller = budget.BudgetController(
+            target_frame_time,
+            frame_width=FRAME_WIDTH,
+            matching_rate=MATCHING_RATE,
+            max_tracked_points=max_tracked_points,
+        )
+
+    # Initialize and start the VideoPlayer
+    sinks = video_player.create_sinks(
+        display_sinks,
+        frame_shape[:2],
+        filename=display_file,
+        shared_memory_name=shared_memory_name,
+    )
+    vid_out = video_player.VideoPlayerAsync(
+        default_size=frame_shape[:2], target_fps=60, sinks=sinks
+    ).start()
+
+    def track(packet):
+        frame, prepared = packet.data
+        return frame, prepared.ratio, tracker(prepared)
+
+    compositor = rendering.Compositor(overlays, overlay_pos)
+    last_output = None
+    startup_reported = False
+
+    def composite(packet):
+        nonlocal last_output
+        frame, ratio, result = packet.data
+        if controller is not None and controller.update(packet.timings, result):
+            controller.apply(tracker)
+            reader.width = controller.width
+        render_target = compositor(frame, result, ratio)
+
+        # The pipeline's throughput is the rate at which frames leave the last stage
+        now = time.monotonic()
+        elapsed = now - (last_output or packet.timestamp)
+        last_output = now
         rendering.render_text(
             render_target,
-            "FPS: {:.2f}".format(1.0 / (time.time() - time_start)),
+            "FPS: {:.2f}".format(1.0 / max(elapsed, 1e-6)),
             (10, frame_shape[0] - 10),
         )
-        # cv.imshow("Frame", render_target)
-        # cv.waitKey(1)
+        if trace_hud:
+            lines = tracing.hud_lines()
+            if controller is not None:
+                lines.insert(0, controller.describe())
+            rendering.render_hud(render_target, lines, (10, 30))
+        return render_target
 
-        vid_out.add(render_target)
+    def sink(packet):
+        nonlocal startup_reported
         # Add Frame to the render Queue
-        # while not vid_out.add(render_target) and vid_out.running:
-        #     pass
+        vid_out.add(packet.data, packet.seq, packet.timestamp)
+        if not startup_reported:
+            report_startup(startup)
+            startup_reported = True
 
-    # do a bit of cleanup
-    fvs.stop()
-    vid_out.stop()
-    cv.destroyAllWindows()
+    # Decoding and preprocessing, tracking, compositing and display run in their own
+    # threads. A live stream drops its oldest frames when a stage falls behind, a
+    # video file is processed completely.
+    frame_pipeline = pipeline.Pipeline(
+        reader.read,
+        [("track", track), ("composite", composite)],
+        sink,
+        queue_size=pipeline_queue_size,
+        drop_oldest=type(input_file) is int,
+    )
+    try:
+        frame_pipeline.start()
+        # join raises the error of a stage
+        while vid_out.running and not frame_pipeline.join(timeout=0.1):
+            pass
+    finally:
+        # do a bit of cleanup
+        frame_pipeline.stop()
+        tracker.close()
+        reader.stop()
+        vid_out.stop()  # closes the sinks, a window is destroyed by its WindowSink
+        print(
+            f"[INFO] Displayed {vid_out.shown} frames, dropped {vid_out.dropped} "
+            f"(display), {sum(frame_pipeline.dropped.values())} (pipeline), "
+            f"skipped {reader.skipped} (reader)"
+        )
+        if vid_out.mean_latency is not None:
+            print(
+                "[INFO] Mean capture-to-display latency: "
+                f"{1000 * vid_out.mean_latency:.1f}ms"
+            )
+        if trace_file is not None:
+            tracing.export_chrome_trace(trace_file)
+            print(f"[INFO] Wrote the trace to {trace_file}")
     sys.exit(0)
 
 
+def process(
+    input_file,
+    output_file,
+    results_file,
+    path_overlays,
+    pipeline_queue_size=8,
+    workers=1,
+    **tracker_params,
+):
+    """
+    Processes a video file without a window, as fast as possible. Every frame is
+    recognised/tracked, annotated and encoded to the output video; the label, the
+    outline of the building, the mode and the timings of every frame are written to a
+    JSON-lines file. With several workers, the video is split into segments that are
+    processed in parallel processes and stitched back together in order.
+
+    Args:
+        input_file (str): Path to the input video file.
+        output_file (str): Path to the annotated output video (MP4).
+        results_file (str): Path to the JSON-lines file with the per-frame results.
+        path_overlays (str): Path to the overlays folder.
+        pipeline_queue_size (int, optional): Size of the queues between the stages of
+            the frame pipeline. Defaults to 8.
+        workers (int, optional): Number of processes. Defaults to 1, None uses all
+            cores.
+        **tracker_params: The parameters of the tracker, see load_recognition and
+            create_tracker. The detector always runs synchronously, so the results
+            are reproducible.
+
+    Returns:
+        int: The number of processed frames.
+    """
+    capture = cv.VideoCapture(input_file)
+    if not capture.isOpened():
+        raise IOError(f"Failed to open {input_file}.")
+    frame_count = int(capture.get(cv.CAP_PROP_FRAME_COUNT))
+    capture.release()
+
+    workers = workers or os.cpu_count()
+    workers = max(1, min(workers, frame_count // MIN_SEGMENT_FRAMES))
+    if workers == 1:
+        records = process_segment(
+            input_file,
+            0,
+            None,
+            output_file,
+            path_overlays,
+            pipeline_queue_size,
+            tracker_params,
+        )
+    else:
+        # Every worker processes one segment with its own tracker, which starts with
+        # a detection at the segment boundary. The last segment runs to the end of
+        # the video, as the frame count of the container may be inaccurate.
+        bounds = np.linspace(0, frame_count, workers + 1).astype(int).tolist()
+        ends = bounds[1:-1] + [None]
+        parts = [f"{output_file}.part{i}.mp4" for i in range(workers)]
+        with ProcessPoolExecutor(
+            workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=cv.setNumThreads,
+            initargs=(1,),
+        ) as executor:
+            segments = executor.map(
+                process_segment,
+                [input_file] * workers,
+                bounds[:-1],
+                ends,
+                parts,
+                [path_overlays] * workers,
+                [pipeline_queue_size] * workers,
+                [tracker_params] * workers,
+            )
+            records = [record for segment in segments for record in segment]
+        concatenate_videos(parts, output_file)
+
+    with open(results_file, "w") as results:
+        for record in records:
+            results.write(json.dumps(record) + "\n")
+    return len(records)
+
+
+def process_segment(
+    input_file,
+    start,
+    end,
+    output_file,
+    path_overlays,
+    pipeline_queue_size,
+    tracker_params,
+):
+    """
+    Processes the frames [start, end) of a video file with a new tracker and encodes
+    them to the output video.
+
+    Args:
+        input_file (str): Path to the input video file.
+        start (int): The index of the first frame.
+        end (int): The index after the last frame, None for the end of the video.
+        output_file (str): Path to the annotated output video (MP4).
+        path_overlays (str): Path to the overlays folder.
+        pipeline_queue_size (int): Size of the queues between the stages of the frame
+            pipeline.
+        tracker_params (dict): The parameters of the tracker, see load_recognition
+            and create_tracker.
+
+    Returns:
+        list[dict]: The results of the frames, in order.
+    """
+    capture = cv.VideoCapture(input_file)
+    if not capture.isOpened():
+        raise IOError(f"Failed to open {input_file}.")
+    if start > 0:
+        capture.set(cv.CAP_PROP_POS_FRAMES, start)
+    fps = capture.get(cv.CAP_PROP_FPS) or 30.0
+    frame_shape = (
+        int(capture.get(cv.CAP_PROP_FRAME_HEIGHT)),
+        int(capture.get(cv.CAP_PROP_FRAME_WIDTH)),
+    )
+
+    recognition_params, tracking_params = split_tracker_params(tracker_params)
+    tracking_params["async_detection"] = False
+    tracker = create_tracker(load_recognition(**recognition_params), **tracking_params)
+    overlays, overlay_pos = prepare_overlays(path_overlays, frame_shape)
+    vid_out = video_player.VideoWriterAsync(output_file, fps, frame_shape).start()
+
+    remaining = None if end is None else end - start
+
+    def read():
+        nonlocal remaining
+        if remaining is not None:
+            if remaining <= 0:
+                return None
+            remaining -= 1
+        grabbed, frame = capture.read()
+        return frame if grabbed else None
+
+    def track(packet):
+        frame, prepared = packet.data
+        return frame, prepared.ratio, tracker(prepared)
+
+    compositor = rendering.Compositor(overlays, overlay_pos)
+
+    def composite(packet):
+        frame, ratio, result = packet.data
+        return compositor(frame, result, ratio), ratio, result
+
+    records = []
+
+    def sink(packet):
+        render_target, ratio, result = packet.data
+        vid_out.add(render_target)
+        records.append(result_record(start + packet.seq, packet, ratio, result))
+
+    # No frame is dropped: the queues block until the next stage catches up
+    frame_pipeline = pipeline.Pipeline(
+        read,
+        [("preprocess", preprocess), ("track", track), ("composite", composite)],
+        sink,
+        queue_size=pipeline_queue_size,
+        drop_oldest=False,
+    ).start()
+    try:
+        frame_pipeline.join()
+    finally:
+        frame_pipeline.stop()
+        tracker.close()
+        vid_out.stop()
+        capture.release()
+    return records
+
+
+def result_record(frame, packet, ratio, result):
+    """
+    Returns the record of a processed frame for the JSON-lines results.
+
+    Args:
+        frame (int): The index of the frame in the video.
+        packet (pipeline.Packet): The frame.
+        ratio (float): The ratio between the full and the processing resolution.
+        result (tracking.TrackingResult): The result of the tracker for the frame.
+
+    Returns:
+        dict: The label, the outline of the building (in full resolution), the mode
+        and the timings (in ms) of the frame.
+    """
+    polygon = None
+    if result.bbox is not None:
+        polygon = (np.float64(result.bbox).reshape(-1, 2) * ratio).round(1).tolist()
+    return dict(
+        frame=frame,
+        label=result.label if result.bbox is not None else None,
+        polygon=polygon,
+        mode=result.mode,
+        timings={stage: round(1000 * t, 3) for stage, t in packet.timings.items()},
+    )
+
+
+def process_streams(
+    input_files,
+    output_path,
+    path_overlays,
+    max_batch=4,
+    batch_window=0.01,
+    pipeline_queue_size=2,
+    async_detection=True,
+    **tracker_params,
+):
+    """
+    Processes several streams (video files or webcams) at the same time without a
+    window. Every stream has its own tracker, the detection requests of all streams are
+    batched on a single shared detector. The annotated video and the per-frame results
+    of every stream are written to the output folder.
+
+    Args:
+        input_files (list[str | int]): Paths to the video files or webcam sources.
+        output_path (str): Path to the output folder.
+        path_overlays (str): Path to the overlays folder.
+        max_batch (int, optional): The maximum number of images per detector batch.
+            Defaults to 4.
+        batch_window (float, optional): The time in seconds a detection request waits
+            for further requests to batch with. Defaults to 0.01.
+        pipeline_queue_size (int, optional): Size of the queues between the stages of
+            the frame pipelines. Defaults to 2.
+        async_detection (bool, optional): Whether the trackers continue on the newer
+            frames while their detection runs. Defaults to True.
+        **tracker_params: The parameters of the trackers, see load_recognition and
+            create_tracker.
+
+    Returns:
+        list[int]: The number of processed frames per stream.
+    """
+    recognition_params, tracking_params = split_tracker_params(tracker_params)
+    tracking_params["async_detection"] = async_detection
+    models = load_recognition(**recognition_params)
+    detector = None
+    if models.model_predictor is not None:
+        detector = streams.BatchedDetector(
+            models.model_predictor,
+            max_batch=max_batch,
+            batch_window=batch_window,
+            silent=DETECTOR_LOGGING,
+        ).start()
+
+    Path(output_path).mkdir(parents=True, exist_ok=True)
+    sources, trackers, outputs = [], [], []
+    for i, input_file in enumerate(input_files):
+        # The readers prepare the frames for the trackers on their own threads
+        if type(input_file) is int:
+            reader = video_player.WebcamReaderAsync(input_file, width=FRAME_WIDTH)
+            name = f"{i}-webcam{input_file}"
+        else:
+            reader = video_player.VideoReaderAsync(input_file, width=FRAME_WIDTH)
+            name = f"{i}-{Path(input_file).stem}"
+        capture = reader.capture
+        frame_shape = (
+            int(capture.get(cv.CAP_PROP_FRAME_HEIGHT)),
+            int(capture.get(cv.CAP_PROP_FRAME_WIDTH)),
+            3,
+        )
+        overlays, overlay_pos = prepare_overlays(path_overlays, frame_shape)
+        vid_out = video_player.VideoWriterAsync(
+            str(Path(output_path) / f"{name}.mp4"),
+            capture.get(cv.CAP_PROP_FPS) or 30.0,
+            frame_shape,
+        ).start()
+        results = open(Path(output_path) / f"{name}.jsonl", "w")
+        predictor = None if detector is None else streams.StreamPredictor(detector)
+        sources.append(reader.start())
+        trackers.append(
+            create_tracker(models, model_predictor=predictor, **tracking_params)
+        )
+        outputs.append((vid_out, results, rendering.Compositor(overlays, overlay_pos)))
+
+    frames = [0] * len(input_files)
+
+    def sink(stream, packet):
+        frame, ratio, result = packet.data
+        vid_out, results, compositor = outputs[stream]
+        vid_out.add(compositor(frame, result, ratio))
+        record = result_record(packet.seq, packet, ratio, result)
+        results.write(json.dumps(record) + "\n")
+        frames[stream] += 1
+
+    # Live streams drop their oldest frames when they fall behind, files do not
+    runner = streams.MultiStreamRunner(
+        [reader.read for reader in sources],
+        trackers,
+        sink,
+        queue_size=pipeline_queue_size,
+        drop_oldest=[type(input_file) is int for input_file in input_files],
+    ).start()
+    try:
+        runner.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        runner.stop()
+        if detector is not None:
+            detector.stop()
+        for reader in sources:
+            reader.stop()
+        for vid_out, results, _ in outputs:
+            vid_out.stop()
+            results.close()
+    return frames
+
+
+def benchmark_pipeline(
+    videos,
+    path_overlays,
+    output_file=None,
+    baseline_file=None,
+    tolerance=benchmark.TOLERANCE,
+    max_frames=100,
+    update_baseline=False,
+    **tracker_params,
+):
+    """
+    Benchmarks every stage of the realtime loop in isolation and end-to-end on the
+    first frames of the given videos, and compares the latencies with a baseline.
+
+    Args:
+        videos (list[str]): Paths to the videos.
+        path_overlays (str): Path to the overlays folder.
+        output_file (str, optional): Path to the JSON report. Defaults to None.
+        baseline_file (str, optional): Path to the JSON report of the baseline.
+            Defaults to None.
+        tolerance (float, optional): The relative slowdown of a stage that counts as a
+            regression. Defaults to benchmark.TOLERANCE.
+        max_frames (int, optional): The maximum number of frames per video. Defaults
+            to 100.
+        update_baseline (bool, optional): Whether the report replaces the baseline.
+            Defaults to False.
+        **tracker_params: The parameters of the tracker, see load_recognition and
+            create_tracker.
+
+    Returns:
+        list[str]: A description of every stage that regressed past the baseline.
+    """
+    clips = benchmark.read_frames(videos, max_frames)
+    if len(clips) == 0:
+        raise IOError("None of the videos could be read.")
+    recognition_params, tracking_params = split_tracker_params(tracker_params)
+    tracking_params["async_detection"] = False
+    models = load_recognition(**recognition_params)
+    tracker = create_tracker(models, **tracking_params)
+    overlays, overlay_pos = prepare_overlays(path_overlays, clips[0][0].shape)
+
+    stages = benchmark.run_benchmark(
+        clips, models, tracker, overlays, overlay_pos, FRAME_WIDTH
+    )
+    report = benchmark.create_report(
+        stages,
+        videos=videos,
+        frames=sum(len(clip) for clip in clips),
+        feature_type=models.compute_feature.cache_key,
+        recognition_mode=recognition_params.get("recognition_mode", "detector"),
+    )
+    print(json.dumps(report, indent=2))
+    if output_file is not None:
+        benchmark.save_report(report, output_file)
+
+    regressions = []
+    baseline = benchmark.load_report(baseline_file)
+    if update_baseline and baseline_file is not None:
+        benchmark.save_report(report, baseline_file)
+    elif baseline is not None:
+        regressions = benchmark.check_regressions(report, baseline, tolerance)
+    return regressions
+
+
+def concatenate_videos(parts, output_file):
+    """
+    Concatenates the given videos into one video and removes them. If ffmpeg is
+    installed, the parts are joined at the container level (concat demuxer, stream
+    copy), without decoding them. Otherwise they are decoded and encoded again, which
+    is a second lossy encode and a serial pass over the whole video.
+
+    Args:
+        parts (list[str]): Paths to the videos, in order, with the same encoding.
+        output_file (str): Path to the concatenated video.
+
+    Returns:
+        None
+    """
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is not None and concatenate_streams(ffmpeg, parts, output_file):
+        for part in parts:
+            os.remove(part)
+        return
+
+    vid_out = None
+    for part in parts:
+        capture = cv.VideoCapture(part)
+        if vid_out is None:
+            vid_out = video_player.VideoWriterAsync(
+                output_file,
+                capture.get(cv.CAP_PROP_FPS) or 30.0,
+                (
+                    int(capture.get(cv.CAP_PROP_FRAME_HEIGHT)),
+                    int(capture.get(cv.CAP_PROP_FRAME_WIDTH)),
+                ),
+            ).start()
+        grabbed, frame = capture.read()
+        while grabbed:
+            vid_out.add(frame)
+            grabbed, frame = capture.read()
+        capture.release()
+        os.remove(part)
+    if vid_out is not None:
+        vid_out.stop()
+
+
+def concatenate_streams(ffmpeg, parts, output_file):
+    """
+    Concatenates the given videos with ffmpeg's concat demuxer, copying the encoded
+    streams.
+
+    Args:
+        ffmpeg (str): Path to the ffmpeg executable.
+        parts (list[str]): Paths to the videos, in order, with the same encoding.
+        output_file (str): Path to the concatenated video.
+
+    Returns:
+        bool: Whether ffmpeg succeeded.
+    """
+    list_file = f"{output_file}.parts.txt"
+    with open(list_file, "w") as f:
+        for part in parts:
+            path = str(Path(part).resolve()).replace("'", "'\\''")
+            f.write(f"file '{path}'\n")
+    try:
+        completed = subprocess.run(
+            [ffmpeg, "-y", "-loglevel", "error", "-f", "concat", "-safe", "0"]
+            + ["-i", list_file, "-c", "copy", output_file]
+        )
+    finally:
+        os.remove(list_file)
+    return completed.returncode == 0
+
+
+def read_tracker_cfg(cfg):
+    """
+    Reads the parameters of the tracker from the config.
+
+    Args:
+        cfg (dict): The config.
+
+    Returns:
+        dict: The parameters of load_recognition and create_tracker.
+    """
+    return dict(
+        path_masks=cfg["VIDEO"]["MASKS_PATH"],
+        feature_type=cfg["VIDEO"]["FEATURE_TYPE"],
+        model_checkpoint=cfg["VIDEO"]["MODEL_CHECKPOINT"],
+        device=cfg["VIDEO"]["DEVICE"],
+        root=cfg["DATA"]["PATH"],
+        annotations_path=cfg["DATA"]["ANNOTATIONS_PATH"],
+        num_classes=cfg["TRAINING"]["NUM_CLASSES"],
+        cache_path=cfg["VIDEO"].get("CACHE_PATH"),
+        recognition_mode=cfg["VIDEO"].get("RECOGNITION", "detector"),
+        feature_params={
+            k.lower(): v for k, v in cfg["VIDEO"].get("FEATURES", {}).items()
+        },
+        match_top_k=cfg["VIDEO"].get("MATCH_TOP_K", 1),
+        homography_tracking=cfg["VIDEO"].get("HOMOGRAPHY_TRACKING", "incremental"),
+        max_tracked_points=cfg["VIDEO"].get(
+            "MAX_TRACKED_POINTS", features.MAX_TRACKED_POINTS
+        ),
+    )
+
+
 if __name__ == "__main__":
     """
     Main function of the macaw project.
@@ -256,26 +1050,90 @@ if __name__ == "__main__":
     match cfg["METHOD"]["NAME"]:
         case "execute":
             if cfg["VIDEO"]["DOWNLOAD"]:
-                weights_loader = WeightsLoader(cfg["VIDEO"]["MODEL_CHECKPOINT"])
-                weights_loader()
+                download_weights(cfg["VIDEO"]["MODEL_CHECKPOINT"])
             execute_cfg = dict(
                 input_file=cfg["VIDEO"]["FILE_NAME"],
-                path_masks=cfg["VIDEO"]["MASKS_PATH"],
                 path_overlays=cfg["VIDEO"]["OVERLAYS_PATH"],
-                feature_type=cfg["VIDEO"]["FEATURE_TYPE"],
-                model_checkpoint=cfg["VIDEO"]["MODEL_CHECKPOINT"],
-                device=cfg["VIDEO"]["DEVICE"],
-                root=cfg["DATA"]["PATH"],
-                annotations_path=cfg["DATA"]["ANNOTATIONS_PATH"],
-                num_classes=cfg["TRAINING"]["NUM_CLASSES"],
+                pipeline_queue_size=cfg["VIDEO"].get("PIPELINE_QUEUE_SIZE", 2),
+                async_detection=cfg["VIDEO"].get("ASYNC_DETECTION", True),
+                trace_file=cfg["VIDEO"].get("TRACE_FILE"),
+                trace_hud=cfg["VIDEO"].get("TRACE_HUD", False),
+                target_frame_time=cfg["VIDEO"].get("TARGET_FRAME_TIME"),
+                display_sinks=cfg["VIDEO"].get("DISPLAY_SINKS", ["window"]),
+                display_file=cfg["VIDEO"].get("DISPLAY_FILE"),
+                shared_memory_name=cfg["VIDEO"].get("SHARED_MEMORY", "macaw"),
+                reader_queue_bytes=cfg["VIDEO"].get("READER_QUEUE_MB", 64) * 1024**2,
+                realtime=cfg["VIDEO"].get("REALTIME", False),
+                **read_tracker_cfg(cfg),
             )
             macaw(**execute_cfg)
+        case "process":
+            if cfg["VIDEO"]["DOWNLOAD"]:
+                download_weights(cfg["VIDEO"]["MODEL_CHECKPOINT"])
+            process_cfg = dict(
+                input_file=cfg["VIDEO"]["FILE_NAME"],
+                output_file=cfg["VIDEO"]["OUTPUT_FILE"],
+                results_file=cfg["VIDEO"]["RESULTS_FILE"],
+                path_overlays=cfg["VIDEO"]["OVERLAYS_PATH"],
+                workers=cfg["VIDEO"].get("PROCESS_WORKERS", 1),
+                **read_tracker_cfg(cfg),
+            )
+            start = time.time()
+            frames = process(**process_cfg)
+            elapsed = time.time() - start
+            print(
+                f"Processed {frames} frames in {elapsed:.1f}s "
+                f"({frames / max(elapsed, 1e-6):.1f} FPS)."
+            )
+        case "streams":
+            if cfg["VIDEO"]["DOWNLOAD"]:
+                download_weights(cfg["VIDEO"]["MODEL_CHECKPOINT"])
+            streams_cfg = dict(
+                input_files=cfg["VIDEO"]["STREAMS"],
+                output_path=cfg["VIDEO"]["OUTPUT_PATH"],
+                path_overlays=cfg["VIDEO"]["OVERLAYS_PATH"],
+                max_batch=cfg["VIDEO"].get("BATCH_SIZE", 4),
+                batch_window=cfg["VIDEO"].get("BATCH_WINDOW", 0.01),
+                pipeline_queue_size=cfg["VIDEO"].get("PIPELINE_QUEUE_SIZE", 2),
+                async_detection=cfg["VIDEO"].get("ASYNC_DETECTION", True),
+                **read_tracker_cfg(cfg),
+            )
+            frames = process_streams(**streams_cfg)
+            print(f"Processed {frames} frames.")
+        case "serve":
+            if cfg["VIDEO"]["DOWNLOAD"]:
+                download_weights(cfg["VIDEO"]["MODEL_CHECKPOINT"])
+            serve_cfg = dict(
+                host=cfg["SERVICE"].get("HOST", "127.0.0.1"),
+                port=cfg["SERVICE"].get("PORT", 8080),
+                workers=cfg["SERVICE"].get("WORKERS", 2),
+                queue_size=cfg["SERVICE"].get("QUEUE_SIZE", 8),
+                **read_tracker_cfg(cfg),
+            )
+            service.serve(**serve_cfg)
+        case "benchmark":
+            benchmark_cfg = dict(
+                videos=cfg["BENCHMARK"]["VIDEOS"],
+                path_overlays=cfg["VIDEO"]["OVERLAYS_PATH"],
+                output_file=cfg["BENCHMARK"].get("OUTPUT_FILE"),
+                baseline_file=cfg["BENCHMARK"].get("BASELINE_FILE"),
+                tolerance=cfg["BENCHMARK"].get("TOLERANCE", benchmark.TOLERANCE),
+                max_frames=cfg["BENCHMARK"].get("MAX_FRAMES", 100),
+                update_baseline=cfg["BENCHMARK"].get("UPDATE_BASELINE", False),
+                **read_tracker_cfg(cfg),
+            )
+            regressions = benchmark_pipeline(**benchmark_cfg)
+            for regression in regressions:
+                print(f"[REGRESSION] {regression}")
+            if len(regressions) > 0:
+                exit(1)
         case "train":
+            import methods.object_detection as object_detection
+
             object_detection.train(cfg)
         case "view":
             if cfg["EVALUATION"]["DOWNLOAD"]:
-                weights_loader = WeightsLoader(cfg["EVALUATION"]["MODEL_CHECKPOINT"])
-                weights_loader()
+                download_weights(cfg["EVALUATION"]["MODEL_CHECKPOINT"])
             eval_cfg = dict(
                 root=cfg["DATA"]["PATH"],
                 annotations=cfg["DATA"]["ANNOTATIONS_PATH"],
@@ -285,10 +1143,15 @@ if __name__ == "__main__":
                 batch_size=cfg["EVALUATION"]["BATCH_SIZE"],
                 num_workers=cfg["EVALUATION"]["NUM_WORKERS"],
             )
+            from methods.eval import TorchImageProvider
+            from methods.viewing import ImageViewer
+
             image_provider = TorchImageProvider(**eval_cfg)
             viewer = ImageViewer(image_provider)
             viewer()
         case "label":
+            import methods.labeling as labeling
+
             labeler = labeling.Labeler(cfg["DATA"]["ANNOTATIONS_PATH"])
             # We NEED to load all data, otherwise we won't have correct labels
             labeler(
@@ -300,6 +1163,6 @@ if __name__ == "__main__":
         case _:
             print(
                 f"Unknown method: {cfg['METHOD']['NAME']}. Please use one of the"
-                + "following: train, visualise, execute, label"
+                + "following: train, visualise, execute, process, streams, serve, benchmark, label"
             )
             exit(-1)
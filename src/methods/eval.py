@@ -3,12 +3,14 @@ import time
 import torch
 from numpy.typing import ArrayLike, NDArray
 from torch.utils.data import DataLoader
-from typing import Any, Tuple
+from typing import Any, List, Tuple
 
+import tracing
 import vision.references.detection.utils as utils
 from datasets.campus_dataset import CampusDataset
 from utils.image_loader import ImageProvider
 from utils.preprocess import get_transform
+from utils_macaw import vote
 
 
 class TorchImageProvider(ImageProvider):
@@ -111,6 +113,7 @@ class PredictionsProvider(ImageProvider):
         model_checkpoint: str,
         device: str = "cpu",
         queue_size: int = 10,
+        top_k: int = 1,
     ) -> None:
         """Initialises the PredictionsProvider with a path to the model checkpoint and
         another path, to the annotation file.
@@ -124,6 +127,8 @@ class PredictionsProvider(ImageProvider):
                 "cpu" and "mps". Defaults to "cpu".
             queue_size (int, optional): Size of the queue to store the last predictions
             for a majority vote on the current label
+            top_k (int, optional): Number of distinct labels of the last prediction,
+                that are stored in top_labels as candidates for matching. Defaults to 1.
 
         Raises:
             ValueError: _description_
@@ -133,6 +138,8 @@ class PredictionsProvider(ImageProvider):
         self.device = device
         self.queue = []
         self.queue_size = queue_size
+        self.top_k = top_k
+        self.top_labels = []
         if model_checkpoint is not None:
             self.model = torch.load(model_checkpoint, map_location=self.device)
             self.model.eval()
@@ -164,42 +171,66 @@ class PredictionsProvider(ImageProvider):
             Tuple[bool, list, str, float]: Boolean showing if there were any predicted
                 boxes, the box, label and score of the best prediction.
         """
-        image_float = image.astype(np.float32) / 255.0
-        image_tensor = torch.from_numpy(image_float).to(self.device).permute((2, 0, 1))
-        self.images = [image_tensor]
+        with tracing.span("detector"):
+            res, self.top_labels = self.predict([image], silent=silent)[0]
+            return vote(self.queue, res, self.queue_size)
 
-        start_time = time.time()
-        predictions = self.model(self.images)
-        inference_time = time.time() - start_time
-
-        score_best = 0.0
-        if len(predictions[0]["boxes"]) > 0:
-            score_best = predictions[0]["scores"][0].item()
-        if len(predictions[0]["boxes"]) > 0 and score_best > 0.70:
-            bbox_best = np.array(
-                predictions[0]["boxes"][0].detach().to("cpu"), dtype=np.int32
-            )
-            label_best = self.category_labels[predictions[0]["labels"][0].item()]
-            res = (True, bbox_best, label_best, score_best)
+    def predict(
+        self, images: List[NDArray[np.uint8]], silent: bool = True
+    ) -> List[Tuple[Tuple[bool, list, str, float], List[str]]]:
+        """Runs inference on a batch of images in a single forward pass of the model.
+        Unlike __call__, the predictions are not smoothed by the majority vote.
 
-            log_msg = f"[INFO] Inference time: {inference_time} | {label_best} | Confidence: {score_best} | Box: {bbox_best}"
-        else:
-            res = (False, [0, 0, 0, 0], "None", None)
-            log_msg = f"[INFO] Inference time: {inference_time}"
+        Args:
+            images (List[NDArray[np.uint8]]): The input images, with values in range
+                [0; 255]
+            silent (bool, optional): Whether or not to print the inference time.
+                Defaults to True.
 
-        if not silent:
-            print(log_msg)
+        Returns:
+            List[Tuple[Tuple[bool, list, str, float], List[str]]]: For every image, the
+                best prediction (hit, box, label, score) and the distinct labels of the
+                top_k best predictions, best first.
+        """
+        self.images = [
+            torch.from_numpy(image.astype(np.float32) / 255.0)
+            .to(self.device)
+            .permute((2, 0, 1))
+            for image in images
+        ]
 
-        if len(self.queue) == self.queue_size:
-            self.queue.pop(0)
+        start_time = time.time()
+        with tracing.span("inference", batch=len(images)):
+            predictions = self.model(self.images)
+        inference_time = time.time() - start_time
 
-        self.queue.append(res)
-        labels = [item[2] for item in self.queue]
-        unique, count = np.unique(labels, return_counts=True)
-        label = unique[np.argmax(count)]
-        return (
-            True if label != "None" else False,
-            res[1],
-            None if label == "None" else label,
-            res[3],
-        )
+        results = []
+        for prediction in predictions:
+            score_best = 0.0
+            if len(prediction["boxes"]) > 0:
+                score_best = prediction["scores"][0].item()
+            if len(prediction["boxes"]) > 0 and score_best > 0.70:
+                bbox_best = np.array(
+                    prediction["boxes"][0].detach().to("cpu"), dtype=np.int32
+                )
+                label_best = self.category_labels[prediction["labels"][0].item()]
+                res = (True, bbox_best, label_best, score_best)
+
+                log_msg = f"[INFO] Inference time: {inference_time} | {label_best} | Confidence: {score_best} | Box: {bbox_best}"
+            else:
+                res = (False, [0, 0, 0, 0], "None", None)
+                log_msg = f"[INFO] Inference time: {inference_time}"
+
+            if not silent:
+                print(log_msg)
+
+            # Distinct labels of the best predictions, best first
+            top_labels = []
+            for label_id in prediction["labels"].tolist():
+                label_name = self.category_labels[label_id]
+                if label_name not in top_labels:
+                    top_labels.append(label_name)
+                if len(top_labels) == self.top_k:
+                    break
+            results.append((res, top_labels))
+        return results
@@ -0,0 +1,298 @@
+import time
+from collections import deque, namedtuple
+from threading import Condition, Thread
+
+import tracing
+
+"""
+A frame travelling through the pipeline. seq is the index of the frame in the stream
+and timestamp the time it was captured (time.monotonic()); data is the output of the
+last stage and timings the time (in seconds) every stage spent on the frame.
+"""
+Packet = namedtuple("Packet", ["seq", "timestamp", "data", "timings"])
+
+
+class FrameQueue:
+    """
+    Bounded queue between two stages of the pipeline. If the queue is full, put either
+    drops the oldest frame (drop_oldest=True), so the consumer always gets the most
+    recent frames, or waits until there is room again.
+    """
+
+    def __init__(self, maxsize=2, drop_oldest=True):
+        """
+        Initializes the FrameQueue.
+
+        Args:
+            maxsize (int, optional): The maximum number of frames. Defaults to 2.
+            drop_oldest (bool, optional): Whether put drops the oldest frame of a full
+                queue instead of waiting. Defaults to True.
+
+        Returns:
+            None
+        """
+        self.maxsize = maxsize
+        self.drop_oldest = drop_oldest
+        self.items = deque()
+        self.condition = Condition()
+        self.closed = False
+        self.dropped = 0
+
+    def put(self, item):
+        """
+        Adds a frame to the queue.
+
+        Args:
+            item (Packet): The frame.
+
+        Returns:
+            bool: False if the queue was closed, True otherwise.
+        """
+        with self.condition:
+            while (
+                not self.drop_oldest
+                and len(self.items) >= self.maxsize
+                and not self.closed
+            ):
+                self.condition.wait()
+            if self.closed:
+                return False
+            if len(self.items) >= self.maxsize:
+                self.items.popleft()
+                self.dropped += 1
+            self.items.append(item)
+            self.condition.notify_all()
+            return True
+
+    def get(self, timeout=None):
+        """
+        Removes the oldest frame from the queue. Waits until a frame is available.
+
+        Args:
+            timeout (float, optional): The maximum time to wait in seconds. Defaults
+                to None, i.e. wait until a frame is available or the queue is closed.
+
+        Returns:
+            Packet: The frame, or None if the queue is closed and empty or the timeout
+            expired.
+        """
+        with self.condition:
+            if not self.condition.wait_for(
+                lambda: self.items or self.closed, timeout=timeout
+            ):
+                return None
+            if not self.items:
+                return None
+            item = self.items.popleft()
+            self.condition.notify_all()
+            return item
+
+    def close(self, discard=False):
+        """
+        Closes the queue. The remaining frames can still be taken, afterwards get
+        returns None.
+
+        Args:
+            discard (bool, optional): Whether the remaining frames are discarded.
+                Defaults to False.
+
+        Returns:
+            None
+        """
+        with self.condition:
+            self.closed = True
+            if discard:
+                self.items.clear()
+            self.condition.notify_all()
+
+    def __len__(self):
+        return len(self.items)
+
+
+class Pipeline:
+    """
+    Runs the processing of a video as a chain of stages, each in its own thread. The
+    stages are connected by bounded FrameQueues, so the stages work on different frames
+    at the same time and the throughput is set by the slowest stage. Every frame is
+    tagged with its sequence number, which lets the stages detect dropped frames.
+    """
+
+    def __init__(self, source, stages, sink, queue_size=2, drop_oldest=True):
+        """
+        Initializes the Pipeline.
+
+        Args:
+            source (callable): Returns the next frame, or None at the end of the stream.
+                A source that knows when its frames were captured returns a Packet
+                with the sequence number and the capture time instead.
+            stages (list[tuple[str, callable]]): The name and function of the stages.
+                A function is called with the Packet of a frame and returns the new
+                data of the frame, or None to skip the frame.
+            sink (callable): Is called with the Packet of every processed frame.
+            queue_size (int, optional): The size of the queues. Defaults to 2.
+            drop_oldest (bool | list[bool], optional): The policy of the queues, either
+                for all queues or one per queue (in front of every stage and of the
+                sink). Defaults to True.
+
+        Returns:
+            None
+        """
+        names = [name for name, _ in stages] + ["sink"]
+        functions = [function for _, function in stages] + [sink]
+        if isinstance(drop_oldest, bool):
+            drop_oldest = [drop_oldest] * len(names)
+        self.queues = [FrameQueue(queue_size, drop) for drop in drop_oldest]
+        self.source = source
+        self.running = False
+        self.error = None
+        self.threads = [Thread(target=self.capture, name="capture", daemon=True)]
+        for i, (name, function) in enumerate(zip(names, functions)):
+            outbox = self.queues[i + 1] if i + 1 < len(self.queues) else None
+            self.threads.append(
+                Thread(
+                    target=self.work,
+                    args=(name, function, self.queues[i], outbox),
+                    name=name,
+                    daemon=True,
+                )
+            )
+
+    def capture(self):
+        """
+        Main loop of the source stage.
+
+        Returns:
+            None
+        """
+        seq = 0
+        try:
+            while self.running:
+                start = time.time()
+                tracing.set_frame(seq, None)
+                with tracing.span("capture"):
+                    frame = self.source()
+                if frame is None:
+                    break
+                timings = {"capture": time.time() - start}
+                if isinstance(frame, Packet):
+                    seq = frame.seq
+                    packet = frame._replace(timings={**frame.timings, **timings})
+                else:
+                    packet = Packet(seq, time.monotonic(), frame, timings)
+                self.queues[0].put(packet)
+                seq += 1
+        except Exception as e:
+            self.fail(e)
+        self.queues[0].close()
+
+    def work(self, name, function, inbox, outbox):
+        """
+        Main loop of a stage.
+
+        Args:
+            name (str): The name of the stage.
+            function (callable): The function of the stage.
+            inbox (FrameQueue): The queue of the incoming frames.
+            outbox (FrameQueue): The queue of the outgoing frames, None for the sink.
+
+        Returns:
+            None
+        """
+        try:
+            while True:
+                packet = inbox.get()
+                if packet is None:
+                    break
+                start = time.time()
+                tracing.set_frame(packet.seq, packet.timestamp)
+                with tracing.span(name):
+                    data = function(packet)
+                packet.timings[name] = time.time() - start
+                if data is not None and outbox is not None:
+                    outbox.put(packet._replace(data=data))
+        except Exception as e:
+            self.fail(e)
+        if outbox is not None:
+            outbox.close()
+        else:
+            self.running = False
+
+    def fail(self, error):
+        """
+        Stops the pipeline after an error in one of the stages.
+
+        Args:
+            error (Exception): The error.
+
+        Returns:
+            None
+        """
+        if self.error is None:
+            self.error = error
+        self.running = False
+        for queue in self.queues:
+            queue.close(discard=True)
+
+    def start(self):
+        """
+        Starts the threads of all stages.
+
+        Returns:
+            Pipeline: self.
+        """
+        self.running = True
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops the pipeline and waits for all stages to finish. Frames that are still
+        queued are discarded. An error of one of the stages is not raised here, so the
+        pipeline can be stopped during the cleanup after it; see join.
+
+        Returns:
+            None
+        """
+        self.running = False
+        for queue in self.queues:
+            queue.close(discard=True)
+        for thread in self.threads:
+            thread.join()
+
+    def join(self, timeout=None):
+        """
+        Waits until the stream is processed or the pipeline is stopped.
+
+        Args:
+            timeout (float, optional): The maximum time to wait in seconds. Defaults
+                to None.
+
+        Returns:
+            bool: True if the pipeline finished, False if the timeout expired.
+
+        Raises:
+            Exception: The error that stopped the pipeline.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        for thread in self.threads:
+            remaining = None if deadline is None else max(deadline - time.time(), 0)
+            thread.join(remaining)
+            if thread.is_alive():
+                return False
+        if self.error is not None:
+            raise self.error
+        return True
+
+    @property
+    def dropped(self):
+        """
+        The number of frames dropped by each queue.
+
+        Returns:
+            dict[str, int]: The dropped frames per stage.
+        """
+        return {
+            thread.name: queue.dropped
+            for thread, queue in zip(self.threads[1:], self.queues)
+        }
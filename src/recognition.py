@@ -0,0 +1,313 @@
+import hashlib
+from pathlib import Path
+
+import cv2 as cv
+import numpy as np
+
+import features
+import utils_macaw as utils
+
+"""
+The following parameters are used for the visual vocabulary.
+"""
+VOCABULARY_SIZE = 1000
+TRAINING_DESCRIPTORS = 50000
+CANDIDATES = 3
+PYRAMID_WIDTHS = (600, 450, 300, 200)  # widths of the masks around the processing width
+
+
+class VocabularyIndex:
+    """
+    Bag-of-visual-words index over the descriptors of all masks. The descriptors of a
+    frame are quantised into visual words and compared with the tf-idf weighted word
+    histograms of the masks, which gives a ranked list of candidate masks without
+    running the detector. The frames are queried at the processing width, so the
+    histograms of the masks are built from their features at the widths a building
+    has in such a frame (PYRAMID_WIDTHS), not from the full-resolution descriptors.
+    """
+
+    def __init__(
+        self,
+        masks,
+        feature_type,
+        images=None,
+        compute_feature=None,
+        vocabulary=None,
+        histograms=None,
+        size=VOCABULARY_SIZE,
+    ):
+        """
+        Initializes the VocabularyIndex. If no histograms are given, the features of
+        the mask images are computed at PYRAMID_WIDTHS; if no vocabulary is given
+        either, it is trained with k-means on a subset of these descriptors.
+
+        Args:
+            masks (dict): The masks per label, as returned by load_masks.
+            feature_type (str): The feature type of the descriptors.
+            images (dict, optional): The images of the masks per label, in the order of
+                masks, see utils.load_mask_images. Required without histograms.
+                Defaults to None.
+            compute_feature (FeatureExtractor, optional): The feature extractor of the
+                frames. Required without histograms. Defaults to None.
+            vocabulary (np.ndarray, optional): The visual words. Defaults to None.
+            histograms (np.ndarray, optional): The word histograms of the masks, computed
+                with the given vocabulary. Defaults to None.
+            size (int, optional): The number of visual words to train. Defaults to
+                VOCABULARY_SIZE.
+
+        Returns:
+            None
+        """
+        self.binary = features.is_binary(feature_type)
+        self.entries = [
+            (label, idx)
+            for label, label_masks in masks.items()
+            for idx in range(len(label_masks))
+        ]
+        if histograms is None:
+            descriptors = [
+                self.to_float(pyramid_descriptors(image, compute_feature))
+                for label in masks
+                for image in images[label]
+            ]
+            if vocabulary is None:
+                vocabulary = train_vocabulary(descriptors, size)
+        self.vocabulary = vocabulary
+
+        FLANN_INDEX_KDTREE = 1
+        self.index = cv.flann_Index(
+            self.vocabulary, dict(algorithm=FLANN_INDEX_KDTREE, trees=4)
+        )
+
+        if histograms is None:
+            histograms = np.stack([self.histogram(d) for d in descriptors])
+        self.histograms = histograms
+        document_frequency = np.count_nonzero(histograms, axis=0)
+        self.idf = np.log(len(self.entries) / np.maximum(document_frequency, 1))
+        self.weights = normalize(histograms * self.idf)
+
+    @classmethod
+    def from_masks(
+        cls, masks, path, compute_feature, cache_path=None, check_width=None
+    ):
+        """
+        Creates the VocabularyIndex for the given masks. If a cache path is given, the
+        trained vocabulary and the word histograms of the masks are stored there and
+        reused as long as the descriptors of the masks do not change; the mask images
+        are only read if the index is built. The entries of other mask folders and
+        extractors are kept. A built index is checked with the mask
+        images at the processing width, see VocabularyIndex.check.
+
+        Args:
+            masks (dict): The masks per label, as returned by load_masks.
+            path (str): Path to the masks folder.
+            compute_feature (FeatureExtractor): The feature extractor of the frames.
+            cache_path (str, optional): Path to the cache folder. Defaults to None.
+            check_width (int, optional): The processing width of the frames. Defaults
+                to None, i.e. the index is not checked.
+
+        Returns:
+            VocabularyIndex: The index.
+        """
+        feature_type = compute_feature.name
+        if cache_path is None:
+            images = utils.load_mask_images(path)
+            index = cls(masks, feature_type, images, compute_feature)
+            index.warn_missed(images, compute_feature, check_width)
+            return index
+
+        # One entry per masks folder and extractor, named after the hash of the mask
+        # descriptors; only older entries of the same masks and extractor are pruned
+        key = hashlib.sha1(
+            f"{compute_feature.cache_key}|{Path(path).resolve()}".encode()
+        ).hexdigest()[:12]
+        digest = hashlib.sha1(repr(PYRAMID_WIDTHS).encode())
+        for label in sorted(masks):
+            for mask in masks[label]:
+                digest.update(features.to_array(mask.des).tobytes())
+        file = Path(cache_path) / f"vocabulary-{key}.{digest.hexdigest()[:20]}.npz"
+        if file.is_file():
+            data = np.load(file)
+            return cls(
+                masks,
+                feature_type,
+                vocabulary=data["vocabulary"],
+                histograms=data["histograms"],
+            )
+
+        images = utils.load_mask_images(path)
+        index = cls(masks, feature_type, images, compute_feature)
+        index.warn_missed(images, compute_feature, check_width)
+        Path(cache_path).mkdir(parents=True, exist_ok=True)
+        for stale in Path(cache_path).glob(f"vocabulary-{key}.*.npz"):
+            stale.unlink(missing_ok=True)
+        np.savez(file, vocabulary=index.vocabulary, histograms=index.histograms)
+        return index
+
+    def check(self, images, compute_feature, width, top_k=CANDIDATES):
+        """
+        Queries the index with every mask image at the given width and returns the
+        masks whose label is not among the candidates, i.e. the masks the vocabulary
+        cannot recognise in a frame of that width.
+
+        Args:
+            images (dict): The images of the masks per label, see
+                utils.load_mask_images.
+            compute_feature (FeatureExtractor): The feature extractor of the frames.
+            width (int): The processing width of the frames.
+            top_k (int, optional): The number of candidates. Defaults to CANDIDATES.
+
+        Returns:
+            list[tuple[str, int]]: The label and mask id of the missed masks.
+        """
+        missed = []
+        for label, idx in self.entries:
+            image = images[label][idx]
+            h, w = image.shape[:2]
+            scaled = cv.resize(
+                image, (width, round(h * width / w)), interpolation=cv.INTER_AREA
+            )
+            candidates = self.query(compute_feature(scaled)[1], top_k)
+            if label not in [candidate for candidate, _, _ in candidates]:
+                missed.append((label, idx))
+        return missed
+
+    def warn_missed(self, images, compute_feature, width):
+        """
+        Prints a warning with the masks that the index misses at the given width, see
+        check.
+
+        Args:
+            images (dict): The images of the masks per label.
+            compute_feature (FeatureExtractor): The feature extractor of the frames.
+            width (int): The processing width of the frames, None to skip the check.
+
+        Returns:
+            None
+        """
+        if width is None:
+            return
+        missed = self.check(images, compute_feature, width)
+        if missed:
+            names = ", ".join(f"{label}_{idx}" for label, idx in missed)
+            print(
+                f"[WARNING] The visual vocabulary does not rank {len(missed)} of "
+                f"{len(self.entries)} masks among the top {CANDIDATES} at {width}px: "
+                f"{names}"
+            )
+
+    def to_float(self, des):
+        """
+        Converts the descriptors to float32. Binary descriptors are unpacked into bits,
+        so the euclidean distance between them corresponds to the hamming distance.
+
+        Args:
+            des (np.ndarray): The descriptors.
+
+        Returns:
+            np.ndarray: The float32 descriptors.
+        """
+        if des is None:
+            return None
+        if self.binary:
+            return np.unpackbits(des, axis=1).astype(np.float32)
+        return np.float32(des)
+
+    def histogram(self, des):
+        """
+        Quantises the given (float) descriptors and counts the visual words.
+
+        Args:
+            des (np.ndarray): The descriptors.
+
+        Returns:
+            np.ndarray: The histogram of visual words.
+        """
+        if des is None or len(des) == 0:
+            return np.zeros(len(self.vocabulary), dtype=np.float32)
+        words, _ = self.index.knnSearch(des, 1, params=dict(checks=32))
+        return np.bincount(words.ravel(), minlength=len(self.vocabulary)).astype(
+            np.float32
+        )
+
+    def query(self, des, top_k=CANDIDATES):
+        """
+        Ranks the masks by the similarity of their word histograms with the given
+        descriptors of a frame.
+
+        Args:
+            des (np.ndarray): The descriptors of the frame.
+            top_k (int, optional): The number of candidates to return. Defaults to
+                CANDIDATES.
+
+        Returns:
+            list[tuple[str, int, float]]: The label, mask id and score of the best
+            candidates, best first.
+        """
+        des = features.to_array(des)
+        if des is None or len(des) == 0:
+            return []
+        query = normalize(self.histogram(self.to_float(des)) * self.idf)
+        scores = self.weights @ query
+        ranked = np.argsort(-scores)[:top_k]
+        return [(*self.entries[i], float(scores[i])) for i in ranked if scores[i] > 0]
+
+
+def pyramid_descriptors(image, compute_feature, widths=PYRAMID_WIDTHS):
+    """
+    Computes the descriptors of the image at the given widths, the image is not
+    enlarged.
+
+    Args:
+        image (np.ndarray): The image, e.g. of a mask.
+        compute_feature (FeatureExtractor): The feature extractor.
+        widths (tuple[int], optional): The widths. Defaults to PYRAMID_WIDTHS.
+
+    Returns:
+        np.ndarray: The descriptors of all widths, or None if there are none.
+    """
+    h, w = image.shape[:2]
+    descriptors = []
+    for width in sorted({min(width, w) for width in widths}):
+        scaled = cv.resize(
+            image, (width, round(h * width / w)), interpolation=cv.INTER_AREA
+        )
+        des = features.to_array(compute_feature(scaled)[1])
+        if des is not None and len(des):
+            descriptors.append(des)
+    return np.vstack(descriptors) if descriptors else None
+
+
+def train_vocabulary(descriptors, size=VOCABULARY_SIZE):
+    """
+    Trains the visual words with k-means on a random subset of the given descriptors.
+
+    Args:
+        descriptors (list[np.ndarray]): The (float) descriptors of all masks.
+        size (int, optional): The number of visual words. Defaults to VOCABULARY_SIZE.
+
+    Returns:
+        np.ndarray: The visual words.
+    """
+    data = np.vstack([d for d in descriptors if d is not None])
+    if len(data) > TRAINING_DESCRIPTORS:
+        rng = np.random.default_rng(0)
+        data = data[rng.choice(len(data), TRAINING_DESCRIPTORS, replace=False)]
+    size = min(size, len(data))
+    criteria = (cv.TERM_CRITERIA_EPS + cv.TERM_CRITERIA_MAX_ITER, 10, 1.0)
+    _, _, centers = cv.kmeans(data, size, None, criteria, 1, cv.KMEANS_PP_CENTERS)
+    return centers
+
+
+def normalize(histograms):
+    """
+    L2-normalizes the given histogram(s) along the last axis.
+
+    Args:
+        histograms (np.ndarray): The histogram(s).
+
+    Returns:
+        np.ndarray: The normalized histogram(s).
+    """
+    norm = np.linalg.norm(histograms, axis=-1, keepdims=True)
+    return histograms / np.maximum(norm, 1e-12)
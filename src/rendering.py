@@ -1,9 +1,16 @@
 import cv2 as cv
 import numpy as np
+from collections import namedtuple
 
 
 DEFAULT_COLOR = (0, 255, 0)
 
+"""
+An overlay prepared for blending, see premultiply_overlay: color is the color
+premultiplied with the opacity, inverse the weight (0-255) of the frame per channel.
+"""
+PreparedOverlay = namedtuple("PreparedOverlay", ["color", "inverse"])
+
 
 def render_contours(img: np.ndarray, contours, color=DEFAULT_COLOR) -> np.ndarray:
     """
@@ -20,23 +27,6 @@ def render_contours(img: np.ndarray, contours, color=DEFAULT_COLOR) -> np.ndarra
     return cv.drawContours(img, [contours], 0, color, 2)
 
 
-def render_fill_contours(img: np.ndarray, contours, color=DEFAULT_COLOR, alpha=0.5) -> np.ndarray:
-    """
-    Renders the filled contours on the image.
-
-    Args:
-        img (np.ndarray): The image to render the contours on.
-        contours (np.ndarray): The contours to render.
-        color (tuple, optional): The color of the contours. Defaults to DEFAULT_COLOR.
-        alpha (float, optional): The alpha value of the fill. Defaults to 0.5.
-
-    Returns:
-        np.ndarray: The image with the filled contours rendered on it.
-    """
-    layer = cv.fillPoly(img.get(), [contours], color=color)
-    return cv.addWeighted(img, alpha, layer, 1-alpha, 0)
-
-
 def render_matches(img, kp, img2, kp2, matches):
     """
     Renders the matches between two images.
@@ -54,36 +44,133 @@ def render_matches(img, kp, img2, kp2, matches):
     return cv.drawMatches(img, kp, img2, kp2, matches, None)
 
 
-def render_metadata(img: cv.UMat, label: str, overlays, pos=np.array((40, 40)), alpha=0.75):
+def premultiply_overlay(overlay: np.ndarray, alpha=1.0) -> PreparedOverlay:
     """
-    Renders the overlay with the metadata on the image.
+    Prepares an overlay for blending: the color is premultiplied with the opacity of
+    every pixel, and the remaining weight of the frame is stored as second plane.
 
     Args:
-        img (cv.UMat): The image to render the overlay on.
-        label (str): The label of the overlay.
-        overlays (dict): The overlays to render.
-        pos (np.array, optional): The position of the overlay. Defaults to np.array((40, 40)).
-        alpha (float, optional): The alpha value for the overlay. Defaults to 0.75.
+        overlay (np.ndarray): The overlay (BGRA).
+        alpha (float, optional): The opacity of the whole overlay. Defaults to 1.0.
 
     Returns:
-        cv.UMat: The image with the overlay rendered on it.
+        PreparedOverlay: The premultiplied color and the inverse opacity, as uint8.
     """
-    idx = label.rindex('_')
-    name = label[:idx]
-    overlay = overlays[name]
-
-    overlay_color = overlay[:, :, :3]
-    overlay_alpha = overlay[:, :, 3] / 255
-    alpha_mask = np.dstack((overlay_alpha, overlay_alpha, overlay_alpha))
-    h, w = overlay.shape[:2]
-    frame = img.get()
+    opacity = overlay[:, :, 3:].astype(np.float32) * np.float32(alpha / 255)
+    color = np.uint8(np.round(overlay[:, :, :3] * opacity))
+    inverse = np.uint8(np.round(255 * (1 - opacity)))
+    return PreparedOverlay(color, np.ascontiguousarray(np.repeat(inverse, 3, axis=2)))
 
-    frame_subsection = frame[pos[0]:pos[0] + h, pos[1]:pos[1] + w, :]
 
-    combine_fr_ov = frame_subsection * (1 - alpha_mask) + overlay_color * alpha_mask
-    frame[pos[0]:pos[0] + h, pos[1]:pos[1] + w] = (1 - alpha) * frame_subsection + alpha * combine_fr_ov
+class Compositor:
+    """
+    Renders the result of the tracker on a frame in place: the outline, the
+    translucent fill, the overlay with the metadata and the text are drawn into the
+    buffer of the frame itself, and the blending is limited to the bounding rectangles
+    of the drawn shapes. The frame is not copied, so it must not be used for anything
+    else afterwards.
+    """
 
-    return cv.UMat(frame)
+    def __init__(self, overlays, overlay_pos, fill_alpha=0.5, overlay_alpha=0.9):
+        """
+        Initializes the Compositor.
+
+        Args:
+            overlays (dict): The overlays (BGRA) per building, sized for the frame.
+                They are premultiplied once, see premultiply_overlay.
+            overlay_pos (np.array): The position (row, column) of the overlays.
+            fill_alpha (float, optional): The weight of the frame in the fill of the
+                outline. Defaults to 0.5.
+            overlay_alpha (float, optional): The opacity of the overlay. Defaults to
+                0.9.
+
+        Returns:
+            None
+        """
+        self.overlay_pos = overlay_pos
+        self.fill_alpha = fill_alpha
+        self.overlays = {
+            name: premultiply_overlay(overlay, overlay_alpha)
+            for name, overlay in overlays.items()
+        }
+        self.label_overlays = {}  # the overlay of every label, once it was looked up
+
+    def __call__(self, frame: np.ndarray, result, ratio) -> np.ndarray:
+        """
+        Renders the outline of the building (or the box of the detector, if there is
+        no outline), filled, and the overlay with the metadata of the building.
+
+        Args:
+            frame (np.ndarray): The frame at full resolution, drawn on in place.
+            result (TrackingResult): The result of the tracker for the frame.
+            ratio (float): The ratio between the full and the processing resolution.
+
+        Returns:
+            np.ndarray: The frame.
+        """
+        if result.bbox is not None:
+            contour, color = np.int32(result.bbox * ratio), (255, 255, 210)
+        elif result.detection is not None:
+            x0, y0, x1, y1 = result.detection * ratio
+            contour = np.int32([[[x0, y0]], [[x1, y0]], [[x1, y1]], [[x0, y1]]])
+            color = (255, 0, 0)
+        else:
+            return frame
+
+        render_contours(frame, contour, color=color)
+        self.fill(frame, contour, color)
+        self.overlay(frame, result.label)
+        return frame
+
+    def fill(self, frame: np.ndarray, contour, color):
+        """
+        Fills the contour translucently, blending only its bounding rectangle.
+
+        Args:
+            frame (np.ndarray): The frame, drawn on in place.
+            contour (np.ndarray): The contour.
+            color (tuple): The color of the fill.
+
+        Returns:
+            None
+        """
+        x, y, w, h = cv.boundingRect(contour)
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + w, frame.shape[1]), min(y + h, frame.shape[0])
+        if x1 <= x0 or y1 <= y0:
+            return
+        roi = frame[y0:y1, x0:x1]
+        layer = cv.fillPoly(roi.copy(), [contour], color, offset=(-x0, -y0))
+        cv.addWeighted(roi, self.fill_alpha, layer, 1 - self.fill_alpha, 0, dst=roi)
+
+    def overlay(self, frame: np.ndarray, label: str):
+        """
+        Blends the overlay with the metadata of the building into its region of the
+        frame.
+
+        Args:
+            frame (np.ndarray): The frame, drawn on in place.
+            label (str): The label of the building (mask), e.g. "piloty_front".
+
+        Returns:
+            None
+        """
+        if label is None:
+            return
+        if label not in self.label_overlays:
+            self.label_overlays[label] = self.overlays.get(label[: label.rfind("_")])
+        overlay = self.label_overlays[label]
+        if overlay is None:
+            return
+        y, x = self.overlay_pos
+        h = min(overlay.color.shape[0], frame.shape[0] - y)
+        w = min(overlay.color.shape[1], frame.shape[1] - x)
+        if h <= 0 or w <= 0:
+            return
+        # frame * (255 - opacity) / 255 + premultiplied color, in 8-bit fixed point
+        roi = frame[y : y + h, x : x + w]
+        cv.multiply(roi, overlay.inverse[:h, :w], dst=roi, scale=1 / 255)
+        cv.add(roi, overlay.color[:h, :w], dst=roi)
 
 
 def render_text(img: np.ndarray, txt: str, pos, color=DEFAULT_COLOR) -> np.ndarray:
@@ -103,6 +190,26 @@ def render_text(img: np.ndarray, txt: str, pos, color=DEFAULT_COLOR) -> np.ndarr
     return img
 
 
+def render_hud(img: np.ndarray, lines, pos, line_height=22, color=DEFAULT_COLOR) -> np.ndarray:
+    """
+    Renders lines of text below each other, e.g. the timings of the tracing.
+
+    Args:
+        img (np.ndarray): The image to render the text on.
+        lines (list[str]): The lines to render.
+        pos (tuple): The position of the first line.
+        line_height (int, optional): The distance between the lines. Defaults to 22.
+        color (tuple, optional): The color of the text. Defaults to DEFAULT_COLOR.
+
+    Returns:
+        np.ndarray: The image with the text rendered on it.
+    """
+    x, y = pos
+    for i, line in enumerate(lines):
+        render_text(img, line, (x, y + i * line_height), color)
+    return img
+
+
 def display_image(image):
     """
     Displays the image.
@@ -0,0 +1,243 @@
+import json
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import BoundedSemaphore
+
+import cv2 as cv
+import numpy as np
+
+import features
+
+"""
+The following parameters are used by the recognition service.
+"""
+FRAME_WIDTH = 450
+REQUEST_TIMEOUT = 30.0  # seconds
+MAX_IMAGE_BYTES = 20 * 1024 * 1024
+
+# The models of a worker process, loaded once by init_worker
+_models = None
+_tracker = None
+
+
+def init_worker(tracker_params):
+    """
+    Loads the masks and the recognition models of a worker process.
+
+    Args:
+        tracker_params (dict): The parameters of the tracker, see
+            macaw.load_recognition and macaw.create_tracker.
+
+    Returns:
+        None
+    """
+    # macaw imports this module, so it is only imported in the worker processes
+    from macaw import create_tracker, load_recognition, split_tracker_params
+
+    global _models, _tracker
+    cv.setNumThreads(1)
+    recognition_params, tracking_params = split_tracker_params(tracker_params)
+    tracking_params["async_detection"] = False
+    _models = load_recognition(**recognition_params)
+    _tracker = create_tracker(_models, **tracking_params)
+
+
+def ping():
+    """
+    Returns once the worker process is initialised.
+
+    Returns:
+        bool: True.
+    """
+    return True
+
+
+def recognise(data):
+    """
+    Recognises the building in an encoded image. The building is detected with the
+    detector (or the visual vocabulary), the features inside the box are matched with
+    the masks and the outline of the best mask is projected into the image.
+
+    Args:
+        data (bytes): The JPEG/PNG image.
+
+    Returns:
+        dict: The label, score, outline (polygon) and detector box of the building, in
+        pixels of the image, or None if the image cannot be decoded. The score is the
+        confidence of the detector or, if the building was recognised with the visual
+        vocabulary, the vocabulary similarity of the label (cosine similarity of the
+        TF-IDF word histograms, between 0 and 1), see BuildingTracker.recognise.
+    """
+    start = time.time()
+    frame = cv.imdecode(np.frombuffer(data, dtype=np.uint8), cv.IMREAD_COLOR)
+    if frame is None:
+        return None
+    prepared = features.PreparedFrame(frame, width=min(FRAME_WIDTH, frame.shape[1]))
+
+    _tracker.reset()
+    label, score, bbox, box = None, None, None, None
+    if _models.vocabulary is not None:
+        bbox = _tracker.recognise(prepared)
+        label = _tracker.label
+        if bbox is not None:
+            score = _tracker.similarity
+    if bbox is None and _models.model_predictor is not None:
+        (hit, box, label, score), top_labels = _models.model_predictor.predict(
+            [prepared.frame]
+        )[0]
+        if hit and label in _models.masks:
+            bbox = _tracker.match_box(prepared, box, label, top_labels)
+            label = _tracker.label
+        elif not hit:
+            label, box = None, None
+
+    polygon = None
+    if bbox is not None:
+        polygon = (np.float64(bbox).reshape(-1, 2) * prepared.ratio).round(1).tolist()
+    return dict(
+        label=label,
+        score=score,
+        polygon=polygon,
+        box=None if box is None else (np.float64(box) * prepared.ratio).tolist(),
+        time_ms=round(1000 * (time.time() - start), 3),
+    )
+
+
+class RecognitionService(ThreadingHTTPServer):
+    """
+    HTTP server for the recognition of single images on localhost. The requests are
+    spread across a pool of worker processes, which are started (and load their models)
+    before the server accepts requests. At most workers + queue_size requests are in
+    flight; further requests are rejected with 503, so clients back off instead of
+    piling up.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, workers, queue_size, tracker_params):
+        """
+        Initializes the RecognitionService and starts the worker processes.
+
+        Args:
+            address (tuple[str, int]): The host and port to listen on.
+            workers (int): The number of worker processes.
+            queue_size (int): The number of requests that wait for a free worker.
+            tracker_params (dict): The parameters of the tracker, see
+                macaw.load_recognition and macaw.create_tracker.
+
+        Returns:
+            None
+        """
+        self.executor = ProcessPoolExecutor(
+            workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker,
+            initargs=(tracker_params,),
+        )
+        # Start all workers now, so the first requests do not wait for the models
+        for future in [self.executor.submit(ping) for _ in range(workers)]:
+            future.result()
+        self.slots = BoundedSemaphore(workers + queue_size)
+        super().__init__(address, RecognitionHandler)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(cancel_futures=True)
+
+
+class RecognitionHandler(BaseHTTPRequestHandler):
+    """
+    Handles the requests of the RecognitionService:
+    POST /recognise with a JPEG/PNG image as body returns the result as JSON,
+    GET /health returns 200 once the service is running.
+    """
+
+    def do_GET(self):
+        if self.path != "/health":
+            self.respond(404, dict(error="Not found."))
+            return
+        self.respond(200, dict(status="ok"))
+
+    def do_POST(self):
+        if self.path != "/recognise":
+            self.respond(404, dict(error="Not found."))
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        if length <= 0 or length > MAX_IMAGE_BYTES:
+            self.respond(413 if length > 0 else 400, dict(error="Invalid image size."))
+            return
+        data = self.rfile.read(length)
+
+        if not self.server.slots.acquire(blocking=False):
+            self.respond(503, dict(error="Overloaded."), {"Retry-After": "1"})
+            return
+        try:
+            future = self.server.executor.submit(recognise, data)
+        except Exception as e:
+            self.server.slots.release()
+            self.respond(500, dict(error=str(e)))
+            return
+        # The slot is held until the worker is done, even if the request timed out
+        future.add_done_callback(lambda _: self.server.slots.release())
+        try:
+            result = future.result(REQUEST_TIMEOUT)
+        except Exception as e:
+            self.respond(500, dict(error=str(e)))
+            return
+
+        if result is None:
+            self.respond(400, dict(error="The image cannot be decoded."))
+            return
+        self.respond(200, result)
+
+    def respond(self, status, body, headers=None):
+        """
+        Sends a JSON response.
+
+        Args:
+            status (int): The HTTP status code.
+            body (dict): The body of the response.
+            headers (dict, optional): Additional headers. Defaults to None.
+
+        Returns:
+            None
+        """
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host="127.0.0.1", port=8080, workers=2, queue_size=8, **tracker_params):
+    """
+    Runs the recognition service until it is interrupted.
+
+    Args:
+        host (str, optional): The host to listen on. Defaults to "127.0.0.1".
+        port (int, optional): The port to listen on. Defaults to 8080.
+        workers (int, optional): The number of worker processes. Defaults to 2.
+        queue_size (int, optional): The number of requests that wait for a free
+            worker, before further requests are rejected. Defaults to 8.
+        **tracker_params: The parameters of the tracker, see macaw.load_recognition
+            and macaw.create_tracker.
+
+    Returns:
+        None
+    """
+    server = RecognitionService((host, port), workers, queue_size, tracker_params)
+    print(f"[INFO] Serving on http://{host}:{port}/recognise with {workers} workers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
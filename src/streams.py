@@ -0,0 +1,295 @@
+import time
+from concurrent.futures import Future
+from threading import Condition, Thread
+
+import pipeline
+from utils_macaw import vote
+
+
+class BatchedDetector:
+    """
+    Shares one detector between several streams. Requests are collected for at most
+    batch_window seconds (or until max_batch requests are waiting) and run in a single
+    forward pass of the model, as the torchvision detection models accept lists of
+    images.
+    """
+
+    def __init__(self, model_predictor, max_batch=4, batch_window=0.01, silent=True):
+        """
+        Initializes the BatchedDetector.
+
+        Args:
+            model_predictor (PredictionsProvider): The detector.
+            max_batch (int, optional): The maximum number of images per batch. Defaults
+                to 4.
+            batch_window (float, optional): The time in seconds the first request of a
+                batch waits for further requests. Defaults to 0.01.
+            silent (bool, optional): Whether the detector runs silently. Defaults to
+                True.
+
+        Returns:
+            None
+        """
+        self.model_predictor = model_predictor
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self.silent = silent
+        self.condition = Condition()
+        self.requests = []
+        self.batches = 0
+        self.running = False
+        self.thread = Thread(target=self.run, args=())
+        self.thread.daemon = True
+
+    def run(self):
+        """
+        Main loop of the detector's thread.
+
+        Returns:
+            None
+        """
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.requests or not self.running)
+                if not self.running:
+                    break
+                # Wait for further requests, until the window of the oldest one closes
+                deadline = self.requests[0][0] + self.batch_window
+                while len(self.requests) < self.max_batch and self.running:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                batch = self.requests[: self.max_batch]
+                self.requests = self.requests[self.max_batch :]
+
+            futures = [future for _, _, future in batch]
+            try:
+                results = self.model_predictor.predict(
+                    [image for _, image, _ in batch], silent=self.silent
+                )
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            for future, result in zip(futures, results):
+                future.set_result(result)
+
+        with self.condition:
+            for _, _, future in self.requests:
+                future.cancel()
+            self.requests = []
+
+    def submit(self, image):
+        """
+        Requests the detection of the given image.
+
+        Args:
+            image (np.ndarray): The image.
+
+        Returns:
+            Future: Resolves to the best prediction (hit, box, label, score) and the
+            distinct labels of the best predictions, see PredictionsProvider.predict.
+        """
+        future = Future()
+        with self.condition:
+            self.requests.append((time.time(), image, future))
+            self.condition.notify_all()
+        return future
+
+    def start(self):
+        """
+        Starts the thread.
+
+        Returns:
+            BatchedDetector: self.
+        """
+        self.running = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops the thread after the current batch. Waiting requests are cancelled.
+
+        Returns:
+            None
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join()
+
+
+class StreamPredictor:
+    """
+    The detector of one stream. It has the interface of PredictionsProvider, but runs
+    the images on a shared BatchedDetector; the majority vote over the last predictions
+    is kept per stream.
+    """
+
+    def __init__(self, detector, queue_size=10):
+        """
+        Initializes the StreamPredictor.
+
+        Args:
+            detector (BatchedDetector): The shared detector.
+            queue_size (int, optional): Size of the queue to store the last predictions
+                for a majority vote on the current label. Defaults to 10.
+
+        Returns:
+            None
+        """
+        self.detector = detector
+        self.queue = []
+        self.queue_size = queue_size
+        self.top_labels = []
+
+    def __call__(self, image, silent=True):
+        """
+        Runs inference on the input image and waits for the result.
+
+        Args:
+            image (np.ndarray): The input image, with values in range [0; 255].
+            silent (bool, optional): Unused, the shared detector decides. Defaults to
+                True.
+
+        Returns:
+            tuple[bool, list, str, float]: Boolean showing if there were any predicted
+            boxes, the box, label and score of the best prediction.
+        """
+        res, self.top_labels = self.detector.submit(image).result()
+        return vote(self.queue, res, self.queue_size)
+
+
+class MultiStreamRunner:
+    """
+    Runs several streams in one process, each with its own frame pipeline and tracker.
+    The trackers usually share one BatchedDetector.
+    """
+
+    def __init__(
+        self,
+        sources,
+        trackers,
+        sink,
+        queue_size=2,
+        drop_oldest=True,
+    ):
+        """
+        Initializes the MultiStreamRunner.
+
+        Args:
+            sources (list[callable]): Return the next frame of each stream, together
+                with its features.PreparedFrame, or None at the end of the stream,
+                e.g. the read method of a video_player.VideoReaderAsync.
+            trackers (list[tracking.BuildingTracker]): The tracker of each stream.
+            sink (callable): Is called with the index of the stream and the Packet of
+                every processed frame; its data is the frame, the ratio between the
+                full and the processing resolution and the tracking.TrackingResult.
+            queue_size (int, optional): The size of the queues. Defaults to 2.
+            drop_oldest (bool | list[bool], optional): The policy of the queues, either
+                for all streams or one per stream. Defaults to True.
+
+        Returns:
+            None
+        """
+        if isinstance(drop_oldest, bool):
+            drop_oldest = [drop_oldest] * len(sources)
+        self.trackers = trackers
+        self.pipelines = [
+            pipeline.Pipeline(
+                source,
+                [("track", self.track_stage(tracker))],
+                self.sink_stage(sink, i),
+                queue_size=queue_size,
+                drop_oldest=drop,
+            )
+            for i, (source, tracker, drop) in enumerate(
+                zip(sources, trackers, drop_oldest)
+            )
+        ]
+
+    @staticmethod
+    def track_stage(tracker):
+        """
+        Returns the tracking stage of a stream.
+
+        Args:
+            tracker (tracking.BuildingTracker): The tracker of the stream.
+
+        Returns:
+            callable: The stage function.
+        """
+
+        def track(packet):
+            frame, prepared = packet.data
+            return frame, prepared.ratio, tracker(prepared)
+
+        return track
+
+    @staticmethod
+    def sink_stage(sink, stream):
+        """
+        Returns the sink of a stream.
+
+        Args:
+            sink (callable): The sink of all streams.
+            stream (int): The index of the stream.
+
+        Returns:
+            callable: The stage function.
+        """
+        return lambda packet: sink(stream, packet)
+
+    @property
+    def running(self):
+        """
+        Whether any of the streams is still running.
+
+        Returns:
+            bool: True if a stream is running, False otherwise.
+        """
+        return any(p.running for p in self.pipelines)
+
+    def start(self):
+        """
+        Starts all streams.
+
+        Returns:
+            MultiStreamRunner: self.
+        """
+        for p in self.pipelines:
+            p.start()
+        return self
+
+    def join(self, timeout=None):
+        """
+        Waits until all streams are processed.
+
+        Args:
+            timeout (float, optional): The maximum time to wait in seconds. Defaults
+                to None.
+
+        Returns:
+            bool: True if all streams finished, False if the timeout expired.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        for p in self.pipelines:
+            remaining = None if deadline is None else max(deadline - time.time(), 0)
+            if not p.join(remaining):
+                return False
+        return True
+
+    def stop(self):
+        """
+        Stops all streams and their trackers.
+
+        Returns:
+            None
+        """
+        for p in self.pipelines:
+            p.stop()
+        for tracker in self.trackers:
+            tracker.close()
@@ -0,0 +1,275 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import nullcontext
+from pathlib import Path
+
+"""
+The following parameters are used for the tracing.
+"""
+MAX_EVENTS = 200000  # the oldest spans are dropped, once this many are recorded
+HUD_WINDOW = 2.0  # seconds of spans the HUD averages over
+AGGREGATE_INTERVAL = 0.1  # seconds of spans summed up in one aggregate for the HUD
+MAX_AGGREGATES = 600  # aggregates kept per span name, i.e. the longest HUD window
+
+_enabled = False
+_events = deque(maxlen=MAX_EVENTS)
+_latencies = deque(maxlen=MAX_EVENTS)
+_aggregates = {}  # the [interval, total, count] of the recent intervals per span name
+_lock = threading.Lock()
+_local = threading.local()
+_disabled_span = nullcontext()
+
+
+class Span:
+    """
+    A timed section of the hot path. The span records the frame that the current
+    thread works on (see set_frame).
+    """
+
+    __slots__ = ("name", "args", "start")
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.time()
+        seq, timestamp = current_frame()
+        _events.append(
+            (
+                self.name,
+                threading.current_thread().name,
+                self.start,
+                end,
+                seq,
+                timestamp,
+                self.args,
+            )
+        )
+        aggregate(self.name, end, end - self.start)
+        return False
+
+
+def aggregate(name, t, value):
+    """
+    Adds a value to the running aggregate of its interval, which the HUD averages
+    over without going through the recorded spans.
+
+    Args:
+        name (str): The name of the span, "latency" for the capture-to-display
+            latency.
+        t (float): The time the value was measured.
+        value (float): The value, e.g. the duration of the span in seconds.
+
+    Returns:
+        None
+    """
+    interval = int(t / AGGREGATE_INTERVAL)
+    with _lock:
+        aggregates = _aggregates.get(name)
+        if aggregates is None:
+            aggregates = _aggregates[name] = deque(maxlen=MAX_AGGREGATES)
+        if aggregates and aggregates[-1][0] == interval:
+            aggregates[-1][1] += value
+            aggregates[-1][2] += 1
+        else:
+            aggregates.append([interval, value, 1])
+
+
+def enable(enabled=True):
+    """
+    Enables (or disables) the tracing. While disabled, span returns a shared no-op
+    context manager, so the instrumentation costs almost nothing.
+
+    Args:
+        enabled (bool, optional): Whether spans are recorded. Defaults to True.
+
+    Returns:
+        None
+    """
+    global _enabled
+    _enabled = enabled
+
+
+def is_enabled():
+    """
+    Returns:
+        bool: Whether spans are recorded.
+    """
+    return _enabled
+
+
+def span(name, **args):
+    """
+    Returns a context manager that records the time spent in it.
+
+    Args:
+        name (str): The name of the span.
+        **args: Further information on the span, shown in the trace viewer.
+
+    Returns:
+        Span: The span, or a no-op context manager if the tracing is disabled.
+    """
+    if not _enabled:
+        return _disabled_span
+    return Span(name, args)
+
+
+def set_frame(seq, timestamp):
+    """
+    Sets the frame the current thread works on, it is recorded with every span.
+
+    Args:
+        seq (int): The index of the frame in the stream.
+        timestamp (float): The time the frame was captured.
+
+    Returns:
+        None
+    """
+    if _enabled:
+        _local.frame = (seq, timestamp)
+
+
+def current_frame():
+    """
+    Returns:
+        tuple[int, float]: The index and capture time of the frame the current thread
+        works on, (None, None) if unknown.
+    """
+    return getattr(_local, "frame", (None, None))
+
+
+def record_latency(seq, timestamp):
+    """
+    Records the capture-to-display latency of a frame that is displayed now.
+
+    Args:
+        seq (int): The index of the frame in the stream.
+        timestamp (float): The time the frame was captured (time.monotonic()).
+
+    Returns:
+        None
+    """
+    if _enabled and timestamp is not None:
+        t, latency = time.time(), time.monotonic() - timestamp
+        _latencies.append((t, seq, latency))
+        aggregate("latency", t, latency)
+
+
+def summary(window=HUD_WINDOW):
+    """
+    Returns the mean duration of every span and the mean capture-to-display latency
+    over the last seconds. The means are taken from the running aggregates of the
+    last intervals, so the cost does not grow with the number of recorded spans.
+
+    Args:
+        window (float, optional): The number of seconds, at most MAX_AGGREGATES
+            intervals. Defaults to HUD_WINDOW.
+
+    Returns:
+        dict[str, float]: The mean duration (in ms) of every span name and the latency
+        ("latency"), if any were recorded.
+    """
+    since = int((time.time() - window) / AGGREGATE_INTERVAL)
+    means = {}
+    with _lock:
+        for name, aggregates in _aggregates.items():
+            total, count = 0.0, 0
+            for interval, interval_total, interval_count in reversed(aggregates):
+                if interval < since:
+                    break
+                total += interval_total
+                count += interval_count
+            if count:
+                means[name] = 1000 * total / count
+    return means
+
+
+def hud_lines(window=HUD_WINDOW):
+    """
+    Returns the lines of the on-screen HUD: the capture-to-display latency first,
+    then the spans, slowest first.
+
+    Args:
+        window (float, optional): The number of seconds the HUD averages over.
+            Defaults to HUD_WINDOW.
+
+    Returns:
+        list[str]: The lines.
+    """
+    means = summary(window)
+    lines = []
+    if "latency" in means:
+        lines.append(f"capture->display: {means.pop('latency'):.1f}ms")
+    for name, mean in sorted(means.items(), key=lambda item: -item[1]):
+        lines.append(f"{name}: {mean:.1f}ms")
+    return lines
+
+
+def export_chrome_trace(file):
+    """
+    Writes the recorded spans as a Chrome trace (chrome://tracing, Perfetto). The
+    capture-to-display latency is written as a counter.
+
+    Args:
+        file (str): Path to the JSON file.
+
+    Returns:
+        None
+    """
+    pid = os.getpid()
+    threads = {}
+    events = []
+    for name, thread, start, end, seq, timestamp, args in list(_events):
+        tid = threads.setdefault(thread, len(threads) + 1)
+        if seq is not None:
+            args = dict(args, frame=seq, capture=timestamp)
+        events.append(
+            dict(
+                name=name,
+                ph="X",
+                ts=round(start * 1e6),
+                dur=round((end - start) * 1e6),
+                pid=pid,
+                tid=tid,
+                args=args,
+            )
+        )
+    for t, seq, latency in list(_latencies):
+        events.append(
+            dict(
+                name="capture->display latency",
+                ph="C",
+                ts=round(t * 1e6),
+                pid=pid,
+                args=dict(ms=round(1000 * latency, 3)),
+            )
+        )
+    for thread, tid in threads.items():
+        events.append(
+            dict(name="thread_name", ph="M", pid=pid, tid=tid, args=dict(name=thread))
+        )
+
+    Path(file).parent.mkdir(parents=True, exist_ok=True)
+    with open(file, "w") as f:
+        json.dump(dict(traceEvents=events, displayTimeUnit="ms"), f)
+
+
+def clear():
+    """
+    Removes all recorded spans and latencies.
+
+    Returns:
+        None
+    """
+    _events.clear()
+    _latencies.clear()
+    with _lock:
+        _aggregates.clear()
@@ -0,0 +1,582 @@
+from collections import namedtuple
+from threading import Condition, Thread
+
+import cv2 as cv
+import numpy as np
+
+import features
+import tracing
+
+"""
+Result of the tracker for one frame. The boxes are in the coordinates of the prepared
+(reduced) frame: bbox is the projected outline of the building, detection the XYXY box
+of the detector (or None, if the detector did not run on this frame). mode tells how
+the building was found: "track", "vocabulary", "detect" or None.
+"""
+TrackingResult = namedtuple("TrackingResult", ["label", "bbox", "detection", "mode"])
+
+"""
+Result of the detector for the frame with the given index. top_labels are the distinct
+labels of the predictions, best first.
+"""
+Detection = namedtuple(
+    "Detection", ["index", "hit", "box", "label", "score", "top_labels"]
+)
+
+
+class DetectorWorker:
+    """
+    Runs the detector on a background thread. Only the latest submitted frame is kept
+    (a frame that was submitted while the detector was busy replaces the previous
+    one), and the results are tagged with the index of their frame.
+    """
+
+    def __init__(self, model_predictor, silent=True):
+        """
+        Initializes the DetectorWorker.
+
+        Args:
+            model_predictor (PredictionsProvider): The detector.
+            silent (bool, optional): Whether the detector runs silently. Defaults to
+                True.
+
+        Returns:
+            None
+        """
+        self.model_predictor = model_predictor
+        self.silent = silent
+        self.condition = Condition()
+        self.request = None
+        self.detection = None
+        self.error = None
+        self.working = False
+        self.running = False
+        self.thread = Thread(target=self.run, args=(), name="detector")
+        self.thread.daemon = True
+
+    def run(self):
+        """
+        Main loop of the detector's thread.
+
+        Returns:
+            None
+        """
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.request or not self.running)
+                if not self.running:
+                    break
+                (index, frame, trace_frame), self.request = self.request, None
+                self.working = True
+            tracing.set_frame(*trace_frame)
+            try:
+                hit, box, label, score = self.model_predictor(
+                    frame, silent=self.silent
+                )[:4]
+                detection = Detection(
+                    index,
+                    hit,
+                    None if box is None else np.asarray(box),
+                    label,
+                    score,
+                    list(self.model_predictor.top_labels),
+                )
+            except Exception as e:
+                detection = None
+                self.error = e
+            with self.condition:
+                self.detection = detection
+                self.working = False
+
+    def submit(self, index, frame):
+        """
+        Requests the detection of the given frame.
+
+        Args:
+            index (int): The index of the frame.
+            frame (np.ndarray): The frame.
+
+        Returns:
+            None
+        """
+        with self.condition:
+            self.request = (index, frame, tracing.current_frame())
+            self.condition.notify_all()
+
+    def result(self):
+        """
+        Returns the latest detection, without waiting.
+
+        Returns:
+            Detection: The detection, or None if no new detection is available.
+
+        Raises:
+            Exception: The error raised by the detector.
+        """
+        if self.error is not None:
+            raise self.error
+        with self.condition:
+            detection, self.detection = self.detection, None
+            return detection
+
+    @property
+    def busy(self):
+        """
+        Whether a frame is waiting for or in the detection.
+
+        Returns:
+            bool: True if the detector is busy, False otherwise.
+        """
+        with self.condition:
+            return self.request is not None or self.working
+
+    def start(self):
+        """
+        Starts the thread.
+
+        Returns:
+            DetectorWorker: self.
+        """
+        self.running = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops the thread after the current detection.
+
+        Returns:
+            None
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join()
+
+
+class BuildingTracker:
+    """
+    Recognises a building and tracks it across frames. The state that is carried from
+    one frame to the next (tracked points, matches, homography, label) lives here, so
+    the tracker can run in its own stage of the frame pipeline.
+    """
+
+    def __init__(
+        self,
+        masks,
+        matcher,
+        compute_feature,
+        vocabulary=None,
+        model_predictor=None,
+        homography_tracking="incremental",
+        max_tracked_points=features.MAX_TRACKED_POINTS,
+        matching_rate=30,
+        detector_logging=True,
+        async_detection=False,
+    ):
+        """
+        Initializes the BuildingTracker.
+
+        Args:
+            masks (dict): The masks per label, as returned by load_masks.
+            matcher (features.MaskMatcher): The matcher over the masks.
+            compute_feature (features.FeatureExtractor): The feature extractor.
+            vocabulary (recognition.VocabularyIndex, optional): The visual vocabulary
+                used to recognise buildings without the detector. Defaults to None.
+            model_predictor (PredictionsProvider, optional): The detector. Defaults to
+                None.
+            homography_tracking (str, optional): How the homography is updated while
+                tracking. Either "incremental" or "ransac". Defaults to "incremental".
+            max_tracked_points (int, optional): Point budget of the tracker. Defaults
+                to features.MAX_TRACKED_POINTS.
+            matching_rate (int, optional): Number of frames after which the building is
+                recognised again, even if the tracking succeeds. Defaults to 30.
+            detector_logging (bool, optional): Whether the detector runs silently.
+                Defaults to True.
+            async_detection (bool, optional): Whether the detector runs on a background
+                thread, while the tracker continues on the newer frames. Defaults to
+                False.
+
+        Returns:
+            None
+        """
+        self.masks = masks
+        self.matcher = matcher
+        self.compute_feature = compute_feature
+        self.vocabulary = vocabulary
+        self.model_predictor = model_predictor
+        self.homography_tracking = homography_tracking
+        self.max_tracked_points = max_tracked_points
+        self.matching_rate = matching_rate
+        self.detector_logging = detector_logging
+        self.detector = None
+        if async_detection and model_predictor is not None:
+            self.detector = DetectorWorker(model_predictor, detector_logging).start()
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets the tracked building.
+
+        Returns:
+            None
+        """
+        self.last_frame = None
+        self.pts_f = None
+        self.pts_m = None
+        self.mask_id = None
+        self.matches = None
+        self.homography = None
+        self.label = None
+        self.similarity = None
+        self.count = -1
+        self.index = -1
+        self.flow = None
+        self.flow_index = None
+
+    def __call__(self, prepared):
+        """
+        Tracks the building into the given frame. If the tracking fails, or every
+        matching_rate frames, the building is recognised again. With the background
+        detector, the tracking continues until the detection is available.
+
+        Args:
+            prepared (features.PreparedFrame): The frame.
+
+        Returns:
+            TrackingResult: The label and boxes of the building in the frame.
+        """
+        self.count += 1
+        self.index += 1
+        detection = None
+
+        # The processing width may be changed between frames, e.g. by budget.py
+        if (
+            self.last_frame is not None
+            and self.last_frame.frame.shape[:2] != prepared.frame.shape[:2]
+        ):
+            self.rescale(prepared)
+
+        # Follow the frame the detector is working on into this frame
+        if self.flow is not None:
+            with tracing.span("flow"):
+                self.flow.update(self.last_frame.gray, prepared.gray)
+
+        with tracing.span("lk_track"):
+            bbox = self.track(prepared)
+        self.last_frame = prepared
+        mode = "track"
+
+        # Recognise the building without the detector, by ranking the masks with the
+        # visual vocabulary and verifying the candidates by matching
+        if bbox is None and self.vocabulary is not None:
+            with tracing.span("recognise"):
+                bbox = self.recognise(prepared)
+            mode = "vocabulary"
+
+        if bbox is None and self.detector is not None:
+            with tracing.span("detect_async"):
+                bbox, detection = self.detect_async(prepared)
+            mode = "detect"
+        elif bbox is None and self.model_predictor is not None:
+            with tracing.span("detect"):
+                bbox, detection = self.detect(prepared)
+            mode = "detect"
+        elif bbox is not None and self.detector is not None:
+            # The building is recognised again by the background detector while the
+            # tracking goes on; its result replaces the tracked one once available
+            with tracing.span("detect_async"):
+                redetected, box = self.redetect_async(
+                    prepared, submit=mode == "track" and self.count == 0
+                )
+            if redetected is not None:
+                bbox, detection, mode = redetected, box, "detect"
+
+        if bbox is not None:
+            # Detect new points to track inside the projected template
+            with tracing.span("replenish"):
+                self.pts_f, self.pts_m, self.matches = features.replenish(
+                    prepared.gray,
+                    self.pts_f,
+                    self.pts_m,
+                    self.matches,
+                    self.homography,
+                    bbox,
+                    max_points=self.max_tracked_points,
+                )
+        return TrackingResult(
+            self.label, bbox, detection, mode if bbox is not None else None
+        )
+
+    def rescale(self, prepared):
+        """
+        Maps the tracked points and the homography into the resolution of the given
+        frame, so the tracking continues across a change of the processing width. A
+        detection that is still running is discarded.
+
+        Args:
+            prepared (features.PreparedFrame): The frame at the new resolution.
+
+        Returns:
+            None
+        """
+        h, w = prepared.frame.shape[:2]
+        h_old, w_old = self.last_frame.frame.shape[:2]
+        scale = np.float32([w / w_old, h / h_old])
+        if self.pts_f is not None:
+            self.pts_f = self.pts_f * scale
+        if self.homography is not None:
+            self.homography = self.homography @ np.diag([1 / scale[0], 1 / scale[1], 1])
+        self.last_frame = features.PreparedFrame(
+            cv.resize(self.last_frame.frame, (w, h), interpolation=cv.INTER_AREA)
+        )
+        self.flow = None
+
+    def track(self, prepared):
+        """
+        Tracks the points of the last frame into the given frame and projects the
+        outline of the mask.
+
+        Args:
+            prepared (features.PreparedFrame): The frame.
+
+        Returns:
+            np.ndarray: The outline of the building, or None if the tracking failed.
+        """
+        valid = False
+        tracking = self.pts_f is not None and len(self.pts_f) > 0
+        if self.count >= self.matching_rate or not tracking:
+            self.count = 0
+            # The background detector recognises the building again while the
+            # tracking continues, see redetect_async
+            tracking = tracking and self.detector is not None
+        if tracking:
+            self.pts_f, self.pts_m, self.matches, valid = features.track(
+                self.last_frame.gray,
+                prepared.gray,
+                self.pts_f,
+                self.pts_m,
+                self.matches,
+                self.label,
+                max_points=self.max_tracked_points,
+            )
+
+        if not valid:
+            self.homography = None
+            return None
+
+        if self.homography_tracking == "incremental":
+            # Update the homography and stop tracking the points it rejects
+            self.homography, inliers = features.update_homography(
+                self.pts_f, self.pts_m, self.homography
+            )
+            if inliers is not None:
+                self.pts_f, self.pts_m = self.pts_f[inliers], self.pts_m[inliers]
+                self.matches = self.matches[inliers]
+        else:
+            self.homography = None
+        return features.calc_bounding_box(
+            self.matches,
+            self.masks[self.label][self.mask_id],
+            self.pts_f,
+            self.pts_m,
+            self.label,
+            homography=self.homography,
+        )
+
+    def recognise(self, prepared):
+        """
+        Recognises the building with the visual vocabulary. The vocabulary similarity
+        of the recognised label, i.e. the cosine similarity of the TF-IDF word
+        histograms of the frame and of its best ranked mask, is kept in similarity.
+
+        Args:
+            prepared (features.PreparedFrame): The frame.
+
+        Returns:
+            np.ndarray: The outline of the building, or None if no mask was verified.
+        """
+        bbox = None
+        kp, des = prepared.features(self.compute_feature)
+        ranked = self.vocabulary.query(des)
+        candidates = [candidate for candidate, _, _ in ranked]
+        matches, mask_id, candidate, homography = features.match(
+            des, self.matcher, candidates, kp
+        )
+        if candidate is not None:
+            pts_f, pts_m = features.get_points_from_matches(
+                matches, kp, self.masks[candidate][mask_id].pts
+            )
+            bbox = features.calc_bounding_box(
+                matches,
+                self.masks[candidate][mask_id],
+                pts_f,
+                pts_m,
+                candidate,
+                homography=homography,
+            )
+        if bbox is None:
+            self.pts_f, self.pts_m, self.matches = None, None, None
+            return None
+        self.pts_f, self.pts_m, self.matches = pts_f, pts_m, matches
+        self.mask_id, self.label, self.homography = mask_id, candidate, homography
+        # The candidates are ranked best first
+        self.similarity = next(score for c, _, score in ranked if c == candidate)
+        return bbox
+
+    def detect(self, prepared):
+        """
+        Detects the building with the detector and matches the features inside the
+        predicted box.
+
+        Args:
+            prepared (features.PreparedFrame): The frame.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The outline of the building (or None) and the
+            predicted XYXY box (or None, if nothing was detected).
+        """
+        # Boxes are in the format XYXY
+        hit, box_pixel, label, _ = self.model_predictor(
+            prepared.frame, silent=self.detector_logging
+        )[:4]
+        if label is None:
+            label = self.label
+        if (
+            not hit
+            or label not in self.masks
+            or (box_pixel[2] - box_pixel[0]) * (box_pixel[3] - box_pixel[1]) <= 0
+        ):
+            return None, None
+
+        # hit and non-zero patch: match the features inside the predicted box
+        bbox = self.match_box(
+            prepared, box_pixel, label, self.model_predictor.top_labels
+        )
+        return bbox, np.asarray(box_pixel)
+
+    def detect_async(self, prepared, submit=True):
+        """
+        Detects the building with the detector on the background thread. If the
+        detector is idle, the frame is submitted and its motion is followed with
+        optical flow. Once the detection is available, its box is propagated to the
+        current frame and the features inside are matched.
+
+        Args:
+            prepared (features.PreparedFrame): The frame.
+            submit (bool, optional): Whether the frame is submitted if no detection is
+                available. Defaults to True.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The outline of the building (or None) and the
+            propagated XYXY box (or None, if no detection is available).
+        """
+        detection = self.detector.result()
+        # Detections of frames the tracker no longer follows are discarded
+        if (
+            detection is None
+            or self.flow is None
+            or detection.index != self.flow_index
+        ):
+            if submit and not self.detector.busy:
+                self.detector.submit(self.index, prepared.frame)
+                self.flow = features.FlowAccumulator(prepared.gray)
+                self.flow_index = self.index
+            return None, None
+
+        flow, self.flow = self.flow, None
+        label = detection.label if detection.label is not None else self.label
+        box = detection.box
+        if (
+            not detection.hit
+            or label not in self.masks
+            or (box[2] - box[0]) * (box[3] - box[1]) <= 0
+        ):
+            return None, None
+
+        # Boxes are in the format XYXY
+        h, w = prepared.frame.shape[:2]
+        box = np.int32(np.round(flow.propagate(box)))
+        box = np.clip(box, 0, [w, h, w, h])
+        if (box[2] - box[0]) * (box[3] - box[1]) <= 0:
+            return None, None
+        return self.match_box(prepared, box, label, detection.top_labels), box
+
+    def redetect_async(self, prepared, submit):
+        """
+        Recognises the tracked building again with the detector on the background
+        thread, see detect_async. If the detection is not verified by the matching,
+        the tracked state is kept.
+
+        Args:
+            prepared (features.PreparedFrame): The frame.
+            submit (bool): Whether the frame is submitted if no detection is
+                available.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The outline of the building (or None) and the
+            propagated XYXY box (or None), as for detect_async.
+        """
+        state = (
+            self.pts_f,
+            self.pts_m,
+            self.matches,
+            self.homography,
+            self.label,
+            self.mask_id,
+        )
+        bbox, box = self.detect_async(prepared, submit=submit)
+        if bbox is None:
+            (
+                self.pts_f,
+                self.pts_m,
+                self.matches,
+                self.homography,
+                self.label,
+                self.mask_id,
+            ) = state
+        return bbox, box
+
+    def close(self):
+        """
+        Stops the background detector, if there is one.
+
+        Returns:
+            None
+        """
+        if self.detector is not None:
+            self.detector.stop()
+
+    def match_box(self, prepared, box, label, top_labels=()):
+        """
+        Matches the features inside the given box with the masks of the label and of
+        the detector's other best labels.
+
+        Args:
+            prepared (features.PreparedFrame): The frame.
+            box (np.ndarray): The XYXY box of the building.
+            label (str): The label of the building.
+            top_labels (list[str], optional): The detector's best labels. Defaults to
+                ().
+
+        Returns:
+            np.ndarray: The outline of the building, or None if the matching failed.
+        """
+        kp, des = prepared.features(self.compute_feature, box=box)
+        candidates = [label] + [l for l in top_labels if l != label]
+        self.matches, self.mask_id, self.label, self.homography = features.match(
+            des, self.matcher, candidates, kp
+        )
+        self.pts_f, self.pts_m = features.get_points_from_matches(
+            self.matches, kp, self.masks[self.label][self.mask_id].pts
+        )
+
+        # get the bounding box (None, with/without homography -> depends on number of hits)
+        return features.calc_bounding_box(
+            self.matches,
+            self.masks[self.label][self.mask_id],
+            self.pts_f,
+            self.pts_m,
+            self.label,
+            homography=self.homography,
+        )
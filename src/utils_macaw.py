@@ -1,17 +1,21 @@
 import numpy as np
 import yaml
 import glob
+import hashlib
 from pathlib import Path
 
 from imutils.video import FileVideoStream
 from imutils.video import WebcamVideoStream
 
 import cv2 as cv
-import pickle
 import imutils
 from collections import namedtuple
 
-Mask = namedtuple("Mask", ["name", "kp", "des", "box", "box_points", "img"])
+"""
+A template of a building: kp holds the keypoints as array (see keypoints_to_array),
+des the descriptors and pts the positions of the keypoints.
+"""
+Mask = namedtuple("Mask", ["name", "kp", "des", "box", "box_points", "img", "pts"])
 DATA = namedtuple("DATA", ["name", "id", "address", "info", "box_size"])
 
 
@@ -41,31 +45,128 @@ def webcam_handler(src):
     return WebcamVideoStream(src=src).start()
 
 
+def keypoints_to_array(kp) -> np.ndarray:
+    """
+    Converts the given keypoints into an array, so they can be stored on disk.
+
+    Args:
+        kp (list[cv.KeyPoint]): keypoints to be converted.
+
+    Returns:
+        np.ndarray: array of shape (N, 7) with the columns x, y, size, angle, response,
+        octave and class_id.
+    """
+    return np.array(
+        [(*k.pt, k.size, k.angle, k.response, k.octave, k.class_id) for k in kp],
+        dtype=np.float64,
+    ).reshape(-1, 7)
+
+
+def array_to_keypoints(arr: np.ndarray) -> list[cv.KeyPoint]:
+    """
+    Converts an array created by keypoints_to_array back into keypoints.
+
+    Args:
+        arr (np.ndarray): array of shape (N, 7).
+
+    Returns:
+        list[cv.KeyPoint]: keypoints.
+    """
+    return [
+        cv.KeyPoint(x, y, size, angle, response, int(octave), int(class_id))
+        for x, y, size, angle, response, octave, class_id in arr.tolist()
+    ]
+
+
 def save_descriptor_to_file(file, data):
     """
-    Saves the given descriptor data to the given file.
+    Saves the given descriptor data to the given file. Every array is written to its
+    own .npy file, so they can be memory-mapped when loading them.
 
     Args:
-        file (str): path to the file.
-        data (dict): data to be saved.
+        file (str): path to the file, without extension.
+        data (dict): data to be saved, containing the keypoints as array ("kp"), the
+            descriptors ("des") and the shape of the image ("shape").
 
     Returns:
         None
     """
-    pickle.dump(file, data)
+    data = dict(data)
+    if data["des"] is None:
+        data["des"] = np.empty((0, 0), dtype=np.float32)
+    # Write to temporary files first, so an interrupted run never leaves a broken entry.
+    # The keypoints are written last, since their presence marks a complete entry.
+    for key in sorted(data, key=lambda k: k == "kp"):
+        tmp = Path(f"{file}.{key}.npy.tmp")
+        with open(tmp, "wb") as f:
+            np.save(f, np.ascontiguousarray(data[key]))
+        tmp.replace(f"{file}.{key}.npy")
+
+
+def load_descriptor_from_file(file, mmap=True):
+    """
+    Loads the descriptor data from the given file.
 
+    Args:
+        file (str): path to the file, without extension.
+        mmap (bool, optional): whether to memory-map the arrays. Defaults to True.
 
-def load_descriptor_from_file(file):
+    Returns:
+        dict: descriptor data, containing the keypoints as array ("kp"), the
+        descriptors ("des") and the shape of the image ("shape"). None if there is no
+        complete entry for the file.
     """
-    Loads the descriptor data from the given file.
+    mmap_mode = "r" if mmap else None
+    try:
+        data = {
+            key: np.load(f"{file}.{key}.npy", mmap_mode=mmap_mode)
+            for key in ("shape", "des", "kp")
+        }
+    except (OSError, ValueError):
+        return None
+    if data["des"].size == 0:
+        data["des"] = None
+    return data
+
+
+def descriptor_cache_file(cache_path, filename, content, cache_key):
+    """
+    Returns the cache entry for the given mask file. Entries are grouped in one folder
+    per cache_key (feature type and extractor parameters) and named after the mask and
+    the hash of its content, so a changed mask image never hits an old entry.
+
+    Args:
+        cache_path (str): path to the cache folder.
+        filename (str): path to the mask image.
+        content (bytes): content of the mask image.
+        cache_key (str): description of the feature type and extractor parameters.
+
+    Returns:
+        str: path to the cache entry, without extension.
+    """
+    key = hashlib.sha1(f"{cache_key}|{cv.__version__}".encode()).hexdigest()[:12]
+    folder = Path(cache_path) / key
+    folder.mkdir(parents=True, exist_ok=True)
+    digest = hashlib.sha1(content).hexdigest()[:20]
+    return str(folder / f"{Path(filename).stem}.{digest}")
+
+
+def prune_descriptor_cache(entry):
+    """
+    Removes all stale entries of the same mask file, i.e. entries of an older version
+    of the mask image.
 
     Args:
-        file (str): path to the file.
+        entry (str): path to the current cache entry, without extension.
 
     Returns:
-        dict: descriptor data.
+        None
     """
-    return pickle.load(file)
+    entry = Path(entry)
+    stem = entry.name.rsplit(".", 1)[0]
+    for file in entry.parent.glob(f"{stem}.*.npy"):
+        if not file.name.startswith(entry.name + "."):
+            file.unlink(missing_ok=True)
 
 
 def load_img(filename: str, size: tuple = None) -> tuple[np.ndarray, np.ndarray]:
@@ -132,31 +233,73 @@ def to_grayscale(img):
     return cv.cvtColor(img, cv.COLOR_BGR2GRAY)
 
 
-def load_masks(path, compute_feature):
+def load_masks(path, compute_feature, cache_path=None, cache_key=None):
     """
     Loads all images from the given path, calculates keypoints
     and feature-descriptors and returns them as a dictionary of template objects.
+    If a cache path is given, the keypoints and descriptors are read from (and written
+    to) an on-disk cache instead of being recomputed on every start. Masks loaded from
+    the cache are not decoded, so their img is None, and their keypoints and
+    descriptors stay memory-mapped. The keypoints are kept as array, array_to_keypoints
+    converts them into cv.KeyPoint objects where they are needed.
 
     Args:
         path (str): path to the images.
         compute_feature (function): function to compute the feature-descriptors.
+        cache_path (str, optional): path to the descriptor cache. Defaults to None.
+        cache_key (str, optional): description of the feature type and extractor
+            parameters, used to separate the cache entries. Defaults to the name of
+            compute_feature.
 
     Returns:
         dict: dictionary of template objects with their keypoints and feature-descriptors.
     """
+    if cache_key is None:
+        cache_key = getattr(compute_feature, "__name__", str(compute_feature))
+
     masks = {}
-    for filename in glob.glob(path + "*.jpg"):
-        img_mask, gray_mask = load_img(filename)
-        kp_mask, des_mask = compute_feature(img_mask)
-        h, w = gray_mask.shape
+    for filename in sorted(glob.glob(path + "*.jpg")):
+        with open(filename, "rb") as f:
+            content = f.read()
+
+        entry = None
+        cached = None
+        if cache_path is not None:
+            entry = descriptor_cache_file(cache_path, filename, content, cache_key)
+            cached = load_descriptor_from_file(entry)
+
+        if cached is not None:
+            img_mask = None
+            kp_array = cached["kp"]
+            des_mask = cached["des"]
+            h, w = (int(v) for v in cached["shape"][:2])
+        else:
+            img_mask = cv.imdecode(np.frombuffer(content, np.uint8), cv.IMREAD_UNCHANGED)
+            kp_mask, des_mask = compute_feature(img_mask)
+            kp_array = keypoints_to_array(kp_mask)
+            h, w = img_mask.shape[:2]
+            if entry is not None:
+                save_descriptor_to_file(
+                    entry,
+                    {
+                        "kp": kp_array,
+                        "des": des_mask,
+                        "shape": np.array(img_mask.shape[:2]),
+                    },
+                )
+                prune_descriptor_cache(entry)
+
         name = Path(filename).stem[:-2]  # every mask is numbered _0-9 -> remove _%d
+        if des_mask is not None and not des_mask.flags.c_contiguous:
+            des_mask = np.ascontiguousarray(des_mask)
         new_mask = Mask(
             name,
-            kp_mask,
-            cv.UMat(des_mask),
-            img_mask.shape[:2],
+            kp_array,
+            des_mask,
+            (h, w),
             np.float32([[0, 0], [0, h - 1], [w - 1, h - 1], [w - 1, 0]]).reshape(-1, 1, 2),
             img_mask,
+            np.float32(kp_array[:, :2]),
         )
         if name in masks:
             masks[name].append(new_mask)
@@ -165,6 +308,24 @@ def load_masks(path, compute_feature):
     return masks
 
 
+def load_mask_images(path):
+    """
+    Loads the images of the masks from the given path, grouped by their name in the
+    same order as load_masks.
+
+    Args:
+        path (str): path to the images.
+
+    Returns:
+        dict: dictionary of the images (BGR) per mask name.
+    """
+    images = {}
+    for filename in sorted(glob.glob(path + "*.jpg")):
+        name = Path(filename).stem[:-2]  # every mask is numbered _0-9 -> remove _%d
+        images.setdefault(name, []).append(cv.imread(filename))
+    return images
+
+
 def load_overlays(path, width=None, height=None):
     """
     Loads all images from the given path and returns them as a dictionary of overlay images.
@@ -199,3 +360,33 @@ def read_yaml(filepath: str) -> dict:
     with open(filepath, "r") as file:
         data = yaml.safe_load(file)
     return data
+
+
+def vote(
+    queue: list, res: tuple[bool, list, str, float], queue_size: int
+) -> tuple[bool, list, str, float]:
+    """Adds the prediction to the queue of the last predictions and replaces its label
+    by the majority vote over the queue.
+
+    Args:
+        queue (list): The last predictions, is updated in place.
+        res (tuple[bool, list, str, float]): The prediction (hit, box, label, score).
+        queue_size (int): The number of predictions in the majority vote.
+
+    Returns:
+        tuple[bool, list, str, float]: Boolean showing if the voted label is a building,
+            the box, voted label and score of the prediction.
+    """
+    if len(queue) == queue_size:
+        queue.pop(0)
+
+    queue.append(res)
+    labels = [item[2] for item in queue]
+    unique, count = np.unique(labels, return_counts=True)
+    label = unique[np.argmax(count)]
+    return (
+        True if label != "None" else False,
+        res[1],
+        None if label == "None" else label,
+        res[3],
+    )
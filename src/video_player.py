@@ -1,37 +1,304 @@
 import numpy as np
 import cv2 as cv
+from collections import deque
+from multiprocessing import shared_memory
 from queue import Queue
 import time
-from threading import Thread
+from threading import Condition, Thread
 
-import utils_macaw as utils
+import features
+import tracing
+from pipeline import Packet
+
+
+class WindowSink:
+    """
+    Sink of the VideoPlayerAsync that shows the frames in a window. The window scales
+    the frames itself, so they are not resized on the display thread.
+    """
+    def __init__(self, default_size, name="MACAW"):
+        """
+        Initializes the WindowSink. The window is created on the display thread.
+
+        Args:
+            default_size (tuple): default size of the window (height, width).
+            name (str, optional): name of the window. Defaults to "MACAW".
+
+        Returns:
+            None
+        """
+        self.name = name
+        self.window_size = np.array(default_size)  # (height, width)
+        self.ratio = float(self.window_size[0]) / float(self.window_size[1])
+        self.opened = False
+        self.w_old = 0
+        self.h_old = 0
+
+    def poll(self):
+        """
+        Handles the events of the window and keeps its aspect ratio.
+
+        Returns:
+            bool: False if the window was closed, True otherwise.
+        """
+        if not self.opened:
+            cv.namedWindow(self.name, cv.WINDOW_KEEPRATIO)
+            cv.resizeWindow(self.name, self.window_size[1], self.window_size[0])
+            self.opened = True
+        cv.waitKey(1)
+        # Stop the program, if the window is closed
+        if cv.getWindowProperty(self.name, cv.WND_PROP_VISIBLE) < 1:
+            return False
+
+        # Resize the Window to keep the aspect ratio of the frames
+        _, _, w, h = cv.getWindowImageRect(self.name)
+        if h != self.h_old:
+            w = int(h / self.ratio)
+        elif w != self.w_old:
+            h = int(w * self.ratio)
+        if (w, h) != (self.w_old, self.h_old) and w != 0 and h != 0:
+            cv.resizeWindow(self.name, w, h)
+        self.w_old, self.h_old = w, h
+        return True
+
+    def write(self, frame, seq, timestamp):
+        """
+        Shows the frame.
+
+        Args:
+            frame (np.ndarray): frame to be shown.
+            seq (int): index of the frame in the stream.
+            timestamp (float): time the frame was captured.
+
+        Returns:
+            bool: False if the window was closed, True otherwise.
+        """
+        cv.imshow(self.name, frame)
+        return self.poll()
+
+    def close(self):
+        """
+        Closes the window.
+
+        Returns:
+            None
+        """
+        if self.opened:
+            cv.destroyWindow(self.name)
+
+
+class WriterSink:
+    """
+    Sink of the VideoPlayerAsync that encodes the displayed frames to a video file.
+    """
+    def __init__(self, filename, fps, size, fourcc="mp4v"):
+        """
+        Initializes the WriterSink and starts its VideoWriterAsync.
+
+        Args:
+            filename (str): path to the video file.
+            fps (float): frame rate of the video.
+            size (tuple): size of the frames (height, width).
+            fourcc (str, optional): codec of the video. Defaults to "mp4v".
+
+        Returns:
+            None
+        """
+        self.writer = VideoWriterAsync(filename, fps, size, fourcc).start()
+
+    def poll(self):
+        return True
+
+    def write(self, frame, seq, timestamp):
+        self.writer.add(frame)
+        return True
+
+    def close(self):
+        self.writer.stop()
+
+
+class NullSink:
+    """
+    Sink of the VideoPlayerAsync that only counts the frames, e.g. for benchmarks.
+    """
+    def __init__(self):
+        self.frames = 0
+
+    def poll(self):
+        return True
+
+    def write(self, frame, seq, timestamp):
+        self.frames += 1
+        return True
+
+    def close(self):
+        pass
+
+
+class SharedMemorySink:
+    """
+    Sink of the VideoPlayerAsync that exports the latest frame to shared memory, for
+    other processes. The block starts with a header of four int64 values (a counter
+    that is odd while a frame is written, the index of the frame, its height and
+    width) and the float64 capture time; the BGR frame follows. See
+    read_shared_frame.
+    """
+    HEADER_SIZE = 40
+
+    def __init__(self, name, size):
+        """
+        Initializes the SharedMemorySink and creates the shared memory block.
+
+        Args:
+            name (str): name of the shared memory block.
+            size (tuple): size of the frames (height, width).
+
+        Returns:
+            None
+        """
+        self.size = tuple(size[:2])
+        self.memory = shared_memory.SharedMemory(
+            name=name, create=True, size=self.HEADER_SIZE + size[0] * size[1] * 3
+        )
+        self.header = np.ndarray((4,), dtype=np.int64, buffer=self.memory.buf)
+        self.timestamp = np.ndarray((1,), dtype=np.float64, buffer=self.memory.buf[32:])
+        self.frame = np.ndarray(
+            self.size + (3,), dtype=np.uint8, buffer=self.memory.buf[self.HEADER_SIZE :]
+        )
+        self.header[:] = (0, -1) + self.size
+        self.timestamp[0] = np.nan
+
+    def poll(self):
+        return True
+
+    def write(self, frame, seq, timestamp):
+        """
+        Copies the frame into the shared memory block.
+
+        Args:
+            frame (np.ndarray): frame to be exported, of the size of the block.
+            seq (int): index of the frame in the stream.
+            timestamp (float): time the frame was captured.
+
+        Returns:
+            bool: True.
+        """
+        self.header[0] += 1
+        self.header[1] = -1 if seq is None else seq
+        self.timestamp[0] = np.nan if timestamp is None else timestamp
+        np.copyto(self.frame, frame[: self.size[0], : self.size[1]])
+        self.header[0] += 1
+        return True
+
+    def close(self):
+        """
+        Releases and removes the shared memory block.
+
+        Returns:
+            None
+        """
+        del self.header, self.timestamp, self.frame
+        self.memory.close()
+        self.memory.unlink()
+
+
+def read_shared_frame(memory):
+    """
+    Reads the latest frame exported by a SharedMemorySink.
+
+    Args:
+        memory (shared_memory.SharedMemory): the shared memory block, opened with its
+            name.
+
+    Returns:
+        tuple[np.ndarray, int, float]: a copy of the frame, its index and capture time,
+        or None if no frame was exported yet or a frame is being written.
+    """
+    header = np.ndarray((4,), dtype=np.int64, buffer=memory.buf)
+    counter, seq, h, w = header.tolist()
+    if counter == 0 or counter % 2 == 1:
+        return None
+    timestamp = float(np.ndarray((1,), dtype=np.float64, buffer=memory.buf[32:])[0])
+    frame = np.ndarray(
+        (h, w, 3), dtype=np.uint8, buffer=memory.buf[SharedMemorySink.HEADER_SIZE :]
+    ).copy()
+    if header[0] != counter:
+        return None
+    return frame, seq, timestamp
+
+
+def create_sinks(names, size, fps=30, filename=None, shared_memory_name="macaw"):
+    """
+    Creates the sinks of the VideoPlayerAsync.
+
+    Args:
+        names (list[str]): the sinks, any of "window", "video", "shared_memory" and
+            "null".
+        size (tuple): size of the frames (height, width).
+        fps (float, optional): frame rate of the video. Defaults to 30.
+        filename (str, optional): path to the video file of the "video" sink.
+            Defaults to None.
+        shared_memory_name (str, optional): name of the shared memory block of the
+            "shared_memory" sink. Defaults to "macaw".
+
+    Returns:
+        list: the sinks.
+
+    Raises:
+        ValueError: If a sink is unknown, or the "video" sink has no file.
+    """
+    sinks = []
+    for name in names:
+        if name == "window":
+            sinks.append(WindowSink(size))
+        elif name == "video":
+            if filename is None:
+                raise ValueError("The video sink needs a file.")
+            sinks.append(WriterSink(filename, fps, size))
+        elif name == "shared_memory":
+            sinks.append(SharedMemorySink(shared_memory_name, size))
+        elif name == "null":
+            sinks.append(NullSink())
+        else:
+            raise ValueError(f"Unknown display sink: {name}.")
+    return sinks
 
 
 class VideoPlayerAsync:
     """
-    Class for displaying a video stream asynchronously.
+    Class for displaying a video stream asynchronously. The player holds only the
+    latest frame (a mailbox): a frame that arrives before the previous one was shown
+    replaces it and is counted as dropped, so the display never lags behind the
+    processing and never blocks it. The frames are passed to pluggable sinks, by
+    default a window.
     """
-    def __init__(self, default_size, target_fps=30, queue_size=30):
+    def __init__(self, default_size, target_fps=30, sinks=None):
         """
         Initializes the VideoPlayerAsync object.
 
         Args:
-            default_size (tuple): default size of the window.
-            target_fps (int, optional): target fps of the video. Defaults to 30.
-            queue_size (int, optional): size of the queue. Defaults to 30.
+            default_size (tuple): default size of the window (height, width).
+            target_fps (int, optional): maximum frame rate of the display. Defaults to
+                30.
+            sinks (list, optional): the outputs of the frames, see WindowSink,
+                WriterSink, NullSink and SharedMemorySink. Defaults to None, i.e. a
+                window.
 
         Returns:
             None
         """
         self.running = False
-        self.Q = Queue(maxsize=queue_size)
-        self.thread = Thread(target=self.main_window, args=())
+        self.condition = Condition()
+        self.pending = None  # the latest frame, that was not shown yet
+        self.shown = 0
+        self.dropped = 0
+        self.latency = 0.0  # summed capture-to-display latency of the timed frames
+        self.timed = 0
+        self.thread = Thread(target=self.main_window, args=(), name="display")
         self.thread.daemon = True
         self.fps = target_fps
         self.dt = 1.0 / self.fps
-        self.default_size = np.array(default_size)
-        self.window_size = self.default_size  # (height, width)
-        self.ratio = float(self.window_size[0]) / float(self.window_size[1])
+        self.sinks = [WindowSink(default_size)] if sinks is None else sinks
 
     def main_window(self):
         """
@@ -40,73 +307,80 @@ class VideoPlayerAsync:
         Returns:
             None
         """
-        # create display window
-        cv.namedWindow("MACAW", cv.WINDOW_KEEPRATIO)
-        cv.resizeWindow("MACAW", self.window_size[0], self.window_size[1])
+        t_old = 0.0
+        try:
+            while self.running or self.pending is not None:
+                # Wait for the next frame, handle the events of the sinks meanwhile
+                with self.condition:
+                    if self.pending is None:
+                        self.condition.wait(self.dt)
+                    item, self.pending = self.pending, None
+                if item is None:
+                    if not all([sink.poll() for sink in self.sinks]):
+                        break
+                    continue
 
-        t_old = time.time()
-        w_old = 0
-        h_old = 0
-        # keep looping infinitely
-        while self.running or not self.Q.empty():
-            # Break if the Window is closed -> Stop the Thread and Stop the program
-            if cv.getWindowProperty("MACAW", cv.WND_PROP_VISIBLE) < 1:
-                break
+                # Cap the Framerate
+                elapsed = time.time() - t_old
+                if elapsed < self.dt:
+                    time.sleep(self.dt - elapsed)
+                t_old = time.time()
 
-            # Resize the Window to fit the image
-            _, _, w, h = cv.getWindowImageRect("MACAW")
-            if h != h_old:
-                w = int(h / self.ratio)
-                w_old = w
-                h_old = h
-            if w != w_old:
-                h = int(w * self.ratio)
-                h_old = h
-                w_old = w
-            if w != 0 and h != 0:
-                cv.resizeWindow("MACAW", w, h)
-
-            # Cap the Framerate
-            t = time.time()
-            elapsed = t - t_old
-            t_old = t
-
-            if elapsed < self.dt:
-                time.sleep(self.dt - elapsed)
-
-            if self.Q.empty():
-                continue
-
-            # Render the next frame
-            frame = self.Q.get()
-            if w != 0 and h != 0:
-                frame = utils.resize(frame.get(), w, h)
-
-            # display the size of the queue on the frame
-            cv.imshow("MACAW", frame)
-            cv.waitKey(1)
-        self.running = False
+                frame, seq, timestamp = item
+                if isinstance(frame, cv.UMat):
+                    frame = frame.get()
+                tracing.set_frame(seq, timestamp)
+                with tracing.span("display"):
+                    keep = all(
+                        [sink.write(frame, seq, timestamp) for sink in self.sinks]
+                    )
+                tracing.record_latency(seq, timestamp)
+                if timestamp is not None:
+                    self.latency += time.monotonic() - timestamp
+                    self.timed += 1
+                self.shown += 1
+                if not keep:
+                    break
+        finally:
+            self.running = False
+            for sink in self.sinks:
+                sink.close()
 
-    def add(self, frame):
+    def add(self, frame, seq=None, timestamp=None):
         """
-        Adds a frame to the queue.
+        Hands a frame to the player, without waiting. A frame that was not shown yet
+        is replaced.
 
         Args:
             frame (np.ndarray): frame to be added.
+            seq (int, optional): index of the frame in the stream, for the tracing.
+                Defaults to None.
+            timestamp (float, optional): time the frame was captured
+                (time.monotonic()), for the capture-to-display latency. Defaults to
+                None.
 
         Returns:
-            bool: True if the frame was added, False otherwise.
+            bool: False if the player was stopped, True otherwise.
         """
-        # For now manual waiting due to bugs with the player
-        count = 0
-        while self.Q.full() and count < 10:
-            time.sleep(self.dt)
-            count += 1
-        if self.Q.full():
-            return False
-        self.Q.put(frame, timeout=10 * self.dt)
+        with self.condition:
+            if not self.running:
+                return False
+            if self.pending is not None:
+                self.dropped += 1
+            self.pending = (frame, seq, timestamp)
+            self.condition.notify_all()
         return True
 
+    @property
+    def mean_latency(self):
+        """
+        The mean capture-to-display latency of the shown frames.
+
+        Returns:
+            float: the latency in seconds, or None if no frame had a timestamp.
+        """
+        return self.latency / self.timed if self.timed else None
+
     def start(self):
         """
         Starts the thread.
@@ -120,13 +394,401 @@ class VideoPlayerAsync:
 
     def stop(self):
         """
-        Stops the thread.
+        Shows the latest frame, stops the thread and closes the sinks.
 
         Returns:
             None
         """
         # indicate that the thread should be stopped
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        # wait until the sinks are closed
+        self.thread.join()
+
+
+class VideoWriterAsync:
+    """
+    Class for encoding a video file asynchronously.
+    """
+    def __init__(self, filename, fps, size, fourcc="mp4v", queue_size=64):
+        """
+        Initializes the VideoWriterAsync object.
+
+        Args:
+            filename (str): path to the video file.
+            fps (float): frame rate of the video.
+            size (tuple): size of the frames (height, width).
+            fourcc (str, optional): codec of the video. Defaults to "mp4v".
+            queue_size (int, optional): size of the queue. Defaults to 64.
+
+        Returns:
+            None
+        """
+        self.running = False
+        self.Q = Queue(maxsize=queue_size)
+        self.thread = Thread(target=self.encode, args=())
+        self.thread.daemon = True
+        self.writer = cv.VideoWriter(
+            filename, cv.VideoWriter_fourcc(*fourcc), fps, (size[1], size[0])
+        )
+        if not self.writer.isOpened():
+            raise IOError(f"Failed to open the video writer for {filename}.")
+
+    def encode(self):
+        """
+        Main loop of the video writer's thread.
+
+        Returns:
+            None
+        """
+        while self.running or not self.Q.empty():
+            frame = self.Q.get()
+            if frame is None:
+                break
+            if isinstance(frame, cv.UMat):
+                frame = frame.get()
+            self.writer.write(frame)
+        self.writer.release()
+
+    def add(self, frame):
+        """
+        Adds a frame to the queue. Waits while the queue is full, so no frame is lost.
+
+        Args:
+            frame (np.ndarray): frame to be added.
+
+        Returns:
+            None
+        """
+        self.Q.put(frame)
+
+    def start(self):
+        """
+        Starts the thread.
+
+        Returns:
+            VideoWriterAsync: self.
+        """
+        self.running = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Encodes the remaining frames and closes the video file.
+
+        Returns:
+            None
+        """
+        self.running = False
+        self.Q.put(None)
+        self.thread.join()
+
+
+class VideoReaderAsync:
+    """
+    Class for decoding a video asynchronously. Every frame is prepared for the
+    processing on the reader's thread, so it emits the frame at full resolution for
+    the display together with the reduced, gray frame (features.PreparedFrame),
+    tagged with its index in the video and the time it was decoded.
+    The queue is bounded in bytes, not frames. When it is full, a video file waits
+    until there is room again, so no frame is lost. In realtime mode the video is
+    played at its frame rate from the first read() on, and the reader skips the
+    frames that are late while the processing has not taken the previous one yet,
+    or that do not fit into the queue, with grab() (without retrieving them).
+    """
+    def __init__(self, source, width=None, realtime=False, max_bytes=64 * 1024**2):
+        """
+        Initializes the VideoReaderAsync object and opens the video.
+
+        Args:
+            source (str | int): path to the video file, or index of the webcam, see
+                WebcamReaderAsync for a live camera.
+            width (int, optional): processing width of the frames, can be changed
+                while reading. Defaults to None, i.e. the frames are not reduced.
+            realtime (bool, optional): whether the video is played at its frame rate
+                and frames are skipped instead of queued, when the processing falls
+                behind. Defaults to False.
+            max_bytes (int, optional): size of the queue in bytes. Defaults to 64 MiB.
+
+        Returns:
+            None
+
+        Raises:
+            IOError: If the video cannot be opened.
+        """
+        self.capture = cv.VideoCapture(source)
+        if not self.capture.isOpened():
+            raise IOError(f"Failed to open {source}.")
+        self.width = width
+        self.realtime = realtime
+        self.max_bytes = max_bytes
+        self.condition = Condition()
+        self.items = deque()
+        self.bytes = 0
+        self.seq = 0  # index of the next frame, skipped frames included
+        self.skipped = 0
+        self.frame_time = 1.0 / (self.capture.get(cv.CAP_PROP_FPS) or 30.0)
+        self.clock = None  # the time of the first read, the start of the playback
+        self.shape = None
+        self.finished = False
+        self.running = False
+        self.thread = Thread(target=self.decode, args=(), name="reader")
+        self.thread.daemon = True
+
+    def decode(self):
+        """
+        Main loop of the video reader's thread.
+
+        Returns:
+            None
+        """
+        try:
+            while self.running:
+                with self.condition:
+                    if not self.realtime:
+                        self.condition.wait_for(
+                            lambda: self.bytes < self.max_bytes or not self.running
+                        )
+                    elif self.seq > 0:
+                        # The playback starts with the first read, not while loading
+                        self.condition.wait_for(
+                            lambda: self.clock is not None or not self.running
+                        )
+                    skip = self.bytes >= self.max_bytes
+                    if self.realtime and self.clock is not None:
+                        due = self.clock + self.seq * self.frame_time
+                        delay = due - time.monotonic()
+                        skip = skip or (delay < -self.frame_time and bool(self.items))
+                if not self.running:
+                    break
+                if self.realtime and self.clock is not None and delay > 0:
+                    time.sleep(delay)
+                if skip:
+                    # Realtime: skip the frame without converting and preparing it
+                    if not self.capture.grab():
+                        break
+                    self.seq += 1
+                    self.skipped += 1
+                    continue
+
+                grabbed, frame = self.capture.read()
+                if not grabbed:
+                    break
+                timestamp = time.monotonic()
+                prepared = features.PreparedFrame(frame, width=self.width)
+                h, w = prepared.frame.shape[:2]
+                size = frame.nbytes + prepared.frame.nbytes + h * w  # with the gray
+                with self.condition:
+                    if self.shape is None:
+                        self.shape = frame.shape
+                    self.items.append(
+                        (Packet(self.seq, timestamp, (frame, prepared), {}), size)
+                    )
+                    self.seq += 1
+                    self.bytes += size
+                    self.condition.notify_all()
+        finally:
+            self.capture.release()
+            with self.condition:
+                self.finished = True
+                self.condition.notify_all()
+
+    def read(self, timeout=None):
+        """
+        Removes the next frame from the queue. Waits until a frame is available.
+
+        Args:
+            timeout (float, optional): the maximum time to wait in seconds. Defaults to
+                None.
+
+        Returns:
+            pipeline.Packet: the index and decoding time of the frame, with the frame
+            and the prepared frame as data, or None at the end of the video or if the
+            timeout expired.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.items or self.finished, timeout)
+            if not self.items:
+                return None
+            packet, size = self.items.popleft()
+            self.bytes -= size
+            if self.clock is None:
+                self.clock = time.monotonic()
+            self.condition.notify_all()
+            return packet
+
+    def frame_shape(self):
+        """
+        Waits for the first frame and returns its shape, without removing it.
+
+        Returns:
+            tuple: shape of the frames at full resolution, or None if the video has no
+            frames.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.shape is not None or self.finished)
+            return self.shape
+
+    def start(self):
+        """
+        Starts the thread.
+
+        Returns:
+            VideoReaderAsync: self.
+        """
+        self.running = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops the thread and releases the video.
+
+        Returns:
+            None
+        """
+        with self.condition:
+            self.running = False
+            self.items.clear()
+            self.bytes = 0
+            self.condition.notify_all()
+        self.thread.join()
+
+
+class WebcamReaderAsync:
+    """
+    Class for capturing a webcam with low latency. The device is asked for the
+    processing resolution and a buffer of a single frame; the capture thread grabs
+    continuously and keeps only the newest frame, tagged with its sequence number and
+    the monotonic time it was grabbed. read() returns every frame at most once, so a
+    consumer never processes a repeated frame, and the frames that were replaced
+    before they were read are counted as skipped. The frames are prepared for the
+    processing when they are read, not for every grabbed frame.
+    """
+    def __init__(self, source, width=None, height=None, buffer_size=1):
+        """
+        Initializes the WebcamReaderAsync object and opens the webcam.
+
+        Args:
+            source (int): index of the webcam.
+            width (int, optional): width requested from the webcam, which is also the
+                processing width of the frames and can be changed while reading.
+                Defaults to None, i.e. the device's default.
+            height (int, optional): height requested from the webcam. Defaults to None,
+                i.e. the device's default.
+            buffer_size (int, optional): number of frames buffered by the driver.
+                Defaults to 1.
+
+        Returns:
+            None
+
+        Raises:
+            IOError: If the webcam cannot be opened.
+        """
+        self.capture = cv.VideoCapture(source)
+        if not self.capture.isOpened():
+            raise IOError(f"Failed to open {source}.")
+        # The device picks the nearest resolution it supports, or ignores the request
+        if width is not None:
+            self.capture.set(cv.CAP_PROP_FRAME_WIDTH, width)
+        if height is not None:
+            self.capture.set(cv.CAP_PROP_FRAME_HEIGHT, height)
+        self.capture.set(cv.CAP_PROP_BUFFERSIZE, buffer_size)
+        self.width = width
+        self.condition = Condition()
+        self.latest = None  # (seq, timestamp, frame) of the newest frame
+        self.last_read = -1
+        self.seq = 0
+        self.skipped = 0
+        self.finished = False
+        self.running = False
+        self.thread = Thread(target=self.grab_frames, args=(), name="webcam")
+        self.thread.daemon = True
+
+    def grab_frames(self):
+        """
+        Main loop of the webcam's thread.
+
+        Returns:
+            None
+        """
+        try:
+            while self.running:
+                if not self.capture.grab():
+                    break
+                timestamp = time.monotonic()
+                grabbed, frame = self.capture.retrieve()
+                if not grabbed:
+                    break
+                with self.condition:
+                    if self.latest is not None and self.latest[0] > self.last_read:
+                        self.skipped += 1
+                    self.latest = (self.seq, timestamp, frame)
+                    self.seq += 1
+                    self.condition.notify_all()
+        finally:
+            self.capture.release()
+            with self.condition:
+                self.finished = True
+                self.condition.notify_all()
+
+    def read(self, timeout=None):
+        """
+        Returns the newest frame, once it was not returned before. Waits until a new
+        frame is captured.
+
+        Args:
+            timeout (float, optional): the maximum time to wait in seconds. Defaults to
+                None.
+
+        Returns:
+            pipeline.Packet: the sequence number and capture time of the frame, with
+            the frame and the prepared frame (features.PreparedFrame) as data, or None
+            if the webcam stopped or the timeout expired.
+        """
+        def new_frame():
+            return self.latest is not None and self.latest[0] > self.last_read
+
+        with self.condition:
+            self.condition.wait_for(lambda: new_frame() or self.finished, timeout)
+            if not new_frame():
+                return None
+            seq, timestamp, frame = self.latest
+            self.last_read = seq
+        prepared = features.PreparedFrame(frame, width=self.width)
+        return Packet(seq, timestamp, (frame, prepared), {})
+
+    def frame_shape(self):
+        """
+        Waits for the first frame and returns its shape, without removing it.
+
+        Returns:
+            tuple: shape of the frames as delivered by the webcam, or None if it
+            stopped before the first frame.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.latest is not None or self.finished)
+            return None if self.latest is None else self.latest[2].shape
+
+    def start(self):
+        """
+        Starts the thread.
+
+        Returns:
+            WebcamReaderAsync: self.
+        """
+        self.running = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops the thread and releases the webcam.
+
+        Returns:
+            None
+        """
         self.running = False
-        # wait until stream resources are released (producer thread might be still grabbing frame)
         self.thread.join()
-        cv.destroyAllWindows()
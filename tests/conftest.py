@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The modules of macaw are imported from src, as when running src/macaw.py
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
@@ -0,0 +1,106 @@
+import shutil
+import time
+from pathlib import Path
+
+import cv2 as cv
+import numpy as np
+import pytest
+
+import features
+import tracking
+import utils_macaw as utils
+
+MASK = Path(__file__).resolve().parents[1] / "masks" / "hauptgebaeude_front_0.jpg"
+LABEL = "hauptgebaeude_front"
+WIDTH = 300  # of the building in the frames
+MATCHING_RATE = 5
+
+
+class SlowDetector:
+    """
+    Stands in for PredictionsProvider: finds the building by template matching, but
+    takes longer than a frame, so the results arrive while the tracker continues.
+    """
+
+    def __init__(self, template, delay=0.1):
+        self.template = template
+        self.delay = delay
+        self.top_labels = [LABEL]
+        self.calls = 0
+
+    def __call__(self, frame, silent=True):
+        self.calls += 1
+        time.sleep(self.delay)
+        result = cv.matchTemplate(frame, self.template, cv.TM_SQDIFF)
+        x, y = cv.minMaxLoc(result)[2]
+        h, w = self.template.shape[:2]
+        return True, np.int32([x, y, x + w, y + h]), LABEL, 0.9
+
+
+@pytest.fixture
+def building(tmp_path):
+    shutil.copy(MASK, tmp_path)
+    compute_feature = features.create_feature_extractor("SIFT")
+    masks = utils.load_masks(str(tmp_path) + "/", compute_feature)
+    template = cv.imread(str(MASK))
+    h, w = template.shape[:2]
+    template = cv.resize(
+        template, (WIDTH, int(h * WIDTH / w)), interpolation=cv.INTER_AREA
+    )
+    return masks, compute_feature, template
+
+
+def render(template, index):
+    """
+    Returns the frame with the given index, in which the building moves right by one
+    pixel per frame, and the XYXY box of the building.
+    """
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 255, (480, 640, 3), dtype=np.uint8)
+    frame = cv.GaussianBlur(frame, (7, 7), 0)
+    h, w = template.shape[:2]
+    x, y = 100 + index, 60
+    frame[y : y + h, x : x + w] = template
+    return frame, np.int32([x, y, x + w, y + h])
+
+
+def test_async_redetection_keeps_tracking(building):
+    masks, compute_feature, template = building
+    detector = SlowDetector(template)
+    tracker = tracking.BuildingTracker(
+        masks,
+        features.MaskMatcher(masks, compute_feature.name),
+        compute_feature,
+        model_predictor=detector,
+        matching_rate=MATCHING_RATE,
+        async_detection=True,
+    )
+    try:
+        # Wait for the first detection
+        index = 0
+        result = tracker(features.PreparedFrame(render(template, index)[0]))
+        while result.bbox is None and index < 100:
+            time.sleep(0.01)
+            index += 1
+            result = tracker(features.PreparedFrame(render(template, index)[0]))
+        assert result.mode == "detect"
+
+        calls = detector.calls
+        redetections = []
+        for index in range(index + 1, index + 8 * MATCHING_RATE):
+            frame, box = render(template, index)
+            result = tracker(features.PreparedFrame(frame))
+            # The forced re-detection does not interrupt the tracking
+            assert result.bbox is not None
+            assert result.label == LABEL
+            if result.mode == "detect":
+                redetections.append((result.detection, box))
+            time.sleep(0.02)
+    finally:
+        tracker.close()
+
+    # The detections requested while tracking are applied, at the current position
+    assert detector.calls > calls
+    assert redetections
+    for detection, box in redetections:
+        assert np.abs(detection - box).max() <= 2